@@ -0,0 +1,14 @@
+"""
+_ollama_pool.py
+Ollamaクライアントの共有インスタンス
+各モジュールはここからクライアントを使い、HTTP接続（キープアライブ）を使い回す
+"""
+
+import ollama
+
+
+# 同期呼び出し用
+client = ollama.Client()
+
+# 非同期呼び出し用（FastAPIのイベントループ上で共有）
+async_client = ollama.AsyncClient()
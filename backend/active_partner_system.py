@@ -5,12 +5,218 @@ AIが能動的に話しかけ、毎日の記録をサポートし、適切なタ
 """
 
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, time
-from typing import Dict, Optional, List
+from pathlib import Path
+from queue import Queue
+from time import monotonic
+from typing import Dict, Iterator, Optional, List
 import json
 import random
 from enum import Enum
 
+# orjson があれば使う（標準のjsonより高速）
+try:
+    import orjson
+    
+    def _jdumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+    
+    _jloads = orjson.loads
+except ImportError:
+    _jdumps = json.dumps
+    _jloads = json.loads
+
+# メタデータなしの場合の共通値
+_EMPTY_META = "{}"
+
+
+# 頻繁に実行されるSQL（同一文字列にして接続の文のキャッシュを再利用する）
+_SQL_INSERT_MSG = """
+    INSERT INTO ai_messages_queue
+    (user_id, message_type, priority, message_content,
+     scheduled_time, metadata, created_at,
+     related_task_id, related_goal_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_MARK_SENT = """
+    UPDATE ai_messages_queue
+    SET sent = 1, sent_at = ?
+    WHERE id = ?
+"""
+
+_SQL_MARK_ACK = """
+    UPDATE ai_messages_queue
+    SET acknowledged = 1, acknowledged_at = ?
+    WHERE id = ?
+"""
+
+# 送信待ちの取得（優先度・予定時刻・IDの順に batch_size 件ずつ）
+_SQL_PENDING_SELECT = """
+    SELECT id, message_type, priority, message_content,
+           scheduled_time, metadata
+    FROM ai_messages_queue
+    WHERE user_id = ?
+      AND sent = 0
+      AND scheduled_time <= ?
+"""
+_SQL_PENDING_ORDER = """
+    ORDER BY priority ASC, scheduled_time ASC, id ASC
+    LIMIT ?
+"""
+_SQL_PENDING_FIRST = _SQL_PENDING_SELECT + _SQL_PENDING_ORDER
+# 前のバッチの最後の行より後ろだけを読む
+_SQL_PENDING_NEXT = (
+    _SQL_PENDING_SELECT
+    + "      AND (priority, scheduled_time, id) > (?, ?, ?)\n"
+    + _SQL_PENDING_ORDER
+)
+
+
+# 活動時間の集計（user_activity_agg）を conversations の変更に追従させるトリガー
+# 会話1件は (user_id, 日, 時) の1行に count 1件・0時からの経過分として入る
+_ACTIVITY_KEY_OLD = """
+    user_id = OLD.user_id
+    AND day = date(OLD.timestamp)
+    AND bucket_hour = CAST(strftime('%H', OLD.timestamp) AS INTEGER)
+"""
+_ACTIVITY_MINUTES_OLD = """
+    (CAST(strftime('%H', OLD.timestamp) AS INTEGER) * 60
+     + CAST(strftime('%M', OLD.timestamp) AS INTEGER))
+"""
+_SQL_ACTIVITY_ADD_NEW = """
+    INSERT INTO user_activity_agg
+    (user_id, day, bucket_hour, count, sum_minutes)
+    VALUES (
+        NEW.user_id,
+        date(NEW.timestamp),
+        CAST(strftime('%H', NEW.timestamp) AS INTEGER),
+        1,
+        CAST(strftime('%H', NEW.timestamp) AS INTEGER) * 60
+            + CAST(strftime('%M', NEW.timestamp) AS INTEGER)
+    )
+    ON CONFLICT(user_id, day, bucket_hour) DO UPDATE SET
+        count = count + 1,
+        sum_minutes = sum_minutes + excluded.sum_minutes;
+"""
+# 件数が0になった行は消す（集計に空の時間帯を残さない）
+_SQL_ACTIVITY_REMOVE_OLD = f"""
+    UPDATE user_activity_agg
+    SET count = count - 1,
+        sum_minutes = sum_minutes - {_ACTIVITY_MINUTES_OLD}
+    WHERE {_ACTIVITY_KEY_OLD};
+    DELETE FROM user_activity_agg
+    WHERE {_ACTIVITY_KEY_OLD} AND count <= 0;
+"""
+
+# トリガー名 -> 作成SQL（どれかがなければ作成し、集計を作り直す）
+_SQL_ACTIVITY_AGG_TRIGGERS = {
+    "trg_conversations_activity_agg": f"""
+        CREATE TRIGGER trg_conversations_activity_agg
+        AFTER INSERT ON conversations
+        BEGIN
+            {_SQL_ACTIVITY_ADD_NEW}
+        END
+    """,
+    "trg_conversations_activity_agg_delete": f"""
+        CREATE TRIGGER trg_conversations_activity_agg_delete
+        AFTER DELETE ON conversations
+        BEGIN
+            {_SQL_ACTIVITY_REMOVE_OLD}
+        END
+    """,
+    # 時刻やユーザーの付け替えは、元の時間帯から引いて新しい時間帯に足す
+    "trg_conversations_activity_agg_update": f"""
+        CREATE TRIGGER trg_conversations_activity_agg_update
+        AFTER UPDATE OF user_id, timestamp ON conversations
+        WHEN OLD.user_id IS NOT NEW.user_id OR OLD.timestamp IS NOT NEW.timestamp
+        BEGIN
+            {_SQL_ACTIVITY_REMOVE_OLD}
+            {_SQL_ACTIVITY_ADD_NEW}
+        END
+    """,
+}
+
+# 会話履歴から集計を作り直す
+_SQL_ACTIVITY_AGG_REBUILD = """
+    INSERT INTO user_activity_agg
+    (user_id, day, bucket_hour, count, sum_minutes)
+    SELECT user_id,
+           date(timestamp),
+           CAST(strftime('%H', timestamp) AS INTEGER) AS h,
+           COUNT(*),
+           SUM(CAST(strftime('%H', timestamp) AS INTEGER) * 60
+               + CAST(strftime('%M', timestamp) AS INTEGER))
+    FROM conversations
+    GROUP BY user_id, date(timestamp), h
+"""
+
+# ==================== メッセージテンプレート ====================
+
+_MORNING_GREETINGS = (
+    "おはようございます!",
+    "おはようございます! 今日も良い一日にしましょう。",
+    "おはよう! 新しい一日の始まりです。"
+)
+
+# メッセージ選択用の乱数生成器（グローバルの random の状態を共有しない）
+_rng = random.Random()
+
+# 状況 -> 励ましメッセージ
+_ENCOURAGEMENTS = {
+    "struggling": "大丈夫、うまくいかない日もあります。明日また頑張りましょう。一緒に乗り越えていきましょう!",
+    "tired": "お疲れのようですね。無理せず、今日はゆっくり休みましょう。休むことも大切な仕事です。",
+    "procrastinating": "始めるのが一番大変ですよね。まずは5分だけやってみませんか? 小さな一歩から始めましょう!",
+    "celebrating": "素晴らしい! よく頑張りましたね。この成功を喜びましょう! 🎉"
+}
+
+# 残り日数 -> (期限表示, 絵文字)
+_URGENCY_TABLE = {
+    0: ("今日が期限", "⚠️"),
+    1: ("明日が期限", "📌")
+}
+
+_EVENING_REFLECTION_BODY = "".join((
+    "少しだけ今日を振り返りませんか?\n\n",
+    "📝 今日の出来事:\n",
+    "・うまくいったこと\n",
+    "・学んだこと\n",
+    "・感謝したいこと\n\n",
+    "何でも大丈夫です。気軽に話してください😊"
+))
+
+_BREAK_SUGGESTION_BODY = "".join((
+    "そろそろ休憩を取りませんか?\n\n",
+    "おすすめの休憩方法:\n",
+    "・5分間のストレッチ\n",
+    "・窓の外を見る\n",
+    "・水を飲む\n",
+    "・軽く歩く\n\n",
+    "リフレッシュして、また集中しましょう!"
+))
+
+_WEEKLY_REVIEW_MESSAGE = "".join((
+    "🎉 今週もお疲れ様でした!\n\n",
+    "1週間を振り返ってみませんか?\n\n",
+    "以下について教えてください:\n",
+    "1. 今週の一番の成果は?\n",
+    "2. 新しく学んだことは?\n",
+    "3. 来週改善したいことは?\n\n",
+    "振り返ることで、成長を実感できますよ😊"
+))
+
+
+# ユーザーパターンのキャッシュ有効期間（秒）
+_PATTERN_CACHE_TTL = 60
+
+
+def _to_hhmm(value: str) -> int:
+    """"HH:MM" を HHMM の整数に変換"""
+    hour, minute = value.split(":")
+    return int(hour) * 100 + int(minute)
+
 
 class MessagePriority(Enum):
     """メッセージの優先度"""
@@ -28,83 +234,273 @@ class ConversationInitiator:
         db_connection,
         goal_manager,
         journal_system,
-        schedule_manager
+        schedule_manager,
+        read_pool_size: int = 4
     ):
-        self.conn = db_connection
+        """
+        db_connection: DBファイルのパス、または既存の sqlite3.Connection
+        
+        パスを渡した場合は、書き込み用の接続1本（ロックで直列化）と
+        読み取り専用の接続 read_pool_size 本を持ち、複数スレッドから
+        同時に呼ばれても SQLITE_BUSY にならないようにする。
+        既存の接続を渡した場合は、そのDBファイルに自前の接続を開く
+        （渡された接続の設定は変えない）。ファイルのないインメモリDBだけは
+        渡された接続を読み書きで共用する。
+        """
         self.goal_mgr = goal_manager
         self.journal_sys = journal_system
         self.schedule_mgr = schedule_manager
-        if self.conn is not None:  # ← この行を追加
+        # user_id -> (取得時刻, パターン, 解析済みの時刻)
+        self._pattern_cache: Dict[str, tuple] = {}
+        self._write_lock = threading.RLock()
+        self._write_conn = None
+        self._read_pool: Queue = Queue()
+        self._read_pool_size = read_pool_size
+        
+        if isinstance(db_connection, (str, Path)):
+            self._open_connections(str(db_connection), read_pool_size)
+        elif db_connection is not None:
+            self.conn = db_connection
+    
+    @property
+    def conn(self):
+        """書き込み用の接続"""
+        return self._write_conn
+    
+    @conn.setter
+    def conn(self, connection):
+        """既存の接続のDBを使う（ファイルがあれば自前の接続を開き、なければ共用する）"""
+        self._read_pool = Queue()
+        db_path = None
+        if connection is not None:
+            # main のファイルパス（インメモリDBでは空文字）
+            for _, name, path in connection.execute("PRAGMA database_list"):
+                if name == "main":
+                    db_path = path or None
+        
+        if db_path is not None:
+            self._open_connections(db_path, self._read_pool_size)
+            return
+        
+        self._write_conn = connection
+        if connection is not None:
+            self._read_pool.put(connection)
             self._init_tables()
     
+    def _open_connections(self, db_path: str, read_pool_size: int):
+        """書き込み用接続と読み取り専用の接続プールを開く"""
+        self._write_conn = sqlite3.connect(
+            db_path, isolation_level=None, check_same_thread=False
+        )
+        
+        # 読み取り用接続はWAL有効化後に開く
+        self._init_tables()
+        
+        read_uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+        for _ in range(max(1, read_pool_size)):
+            reader = sqlite3.connect(read_uri, uri=True, check_same_thread=False)
+            reader.execute("PRAGMA busy_timeout=5000")
+            self._read_pool.put(reader)
+    
+    @contextmanager
+    def _reader(self):
+        """読み取り用の接続をプールから借りる"""
+        conn = self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+    
+    @contextmanager
+    def _write_transaction(self):
+        """
+        書き込み接続を占有し、1つのトランザクションで書き込む
+        
+        isolation_level に関係なく BEGIN IMMEDIATE / COMMIT を明示する。
+        すでにトランザクション中なら、それに含める（確定は外側で行う）
+        """
+        with self._write_lock:
+            conn = self._write_conn
+            if conn.in_transaction:
+                yield conn
+                return
+            
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.execute("COMMIT")
+    
+    def close(self):
+        """すべての接続を閉じる"""
+        with self._write_lock:
+            readers = set()
+            while not self._read_pool.empty():
+                readers.add(self._read_pool.get())
+            for reader in readers:
+                if reader is not self._write_conn:
+                    reader.close()
+            if self._write_conn is not None:
+                self._write_conn.close()
+            self._write_conn = None
+    
     def _init_tables(self):
         """テーブル初期化"""
-        c = self.conn.cursor()
-        
-        # AIからのメッセージキュー
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS ai_messages_queue (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                message_type TEXT NOT NULL,
-                priority INTEGER NOT NULL,
-                message_content TEXT NOT NULL,
-                scheduled_time TEXT NOT NULL,
-                sent INTEGER DEFAULT 0,
-                sent_at TEXT,
-                acknowledged INTEGER DEFAULT 0,
-                acknowledged_at TEXT,
-                metadata TEXT,
-                created_at TEXT NOT NULL
-            )
-        """)
-        
-        # ユーザーの活動パターン
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS user_activity_patterns (
-                user_id TEXT PRIMARY KEY,
-                typical_morning_time TEXT,
-                typical_evening_time TEXT,
-                typical_work_hours TEXT,
-                preferred_reminder_times TEXT,
-                quiet_hours_start TEXT,
-                quiet_hours_end TEXT,
-                last_updated TEXT
-            )
-        """)
-        
-        # リマインダー設定
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS reminders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                reminder_type TEXT NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                remind_at TEXT NOT NULL,
-                repeat_pattern TEXT,
-                enabled INTEGER DEFAULT 1,
-                related_goal_id INTEGER,
-                related_task_id INTEGER,
-                created_at TEXT NOT NULL
-            )
-        """)
-        
-        # 会話開始履歴
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS conversation_initiations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                initiated_at TEXT NOT NULL,
-                message_type TEXT NOT NULL,
-                user_responded INTEGER DEFAULT 0,
-                response_time_seconds INTEGER,
-                user_sentiment TEXT
-            )
-        """)
+        with self._write_lock:
+            c = self._write_conn.cursor()
+
+            # 接続設定（WAL + 書き込み時のfsyncを削減）
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute("PRAGMA temp_store=MEMORY")
+            c.execute("PRAGMA mmap_size=268435456")
+            c.execute("PRAGMA cache_size=-65536")
+            c.execute("PRAGMA busy_timeout=5000")
+            c.execute("PRAGMA foreign_keys=ON")
+
+            # AIからのメッセージキュー
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS ai_messages_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    message_type TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    message_content TEXT NOT NULL,
+                    scheduled_time TEXT NOT NULL,
+                    sent INTEGER DEFAULT 0,
+                    sent_at TEXT,
+                    acknowledged INTEGER DEFAULT 0,
+                    acknowledged_at TEXT,
+                    metadata TEXT,
+                    created_at TEXT NOT NULL,
+                    related_task_id INTEGER,
+                    related_goal_id INTEGER
+                )
+            """)
+            
+            # 既存DBへのマイグレーション（metadataから関連IDを移す）
+            for column, key in (("related_task_id", "task_id"), ("related_goal_id", "goal_id")):
+                try:
+                    c.execute(f"ALTER TABLE ai_messages_queue ADD COLUMN {column} INTEGER")
+                    c.execute(f"""
+                        UPDATE ai_messages_queue
+                        SET {column} = json_extract(metadata, '$.{key}')
+                        WHERE metadata LIKE '%"{key}"%'
+                    """)
+                except sqlite3.OperationalError:
+                    pass
+            
+            # ユーザーの活動パターン
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS user_activity_patterns (
+                    user_id TEXT PRIMARY KEY,
+                    typical_morning_time TEXT,
+                    typical_evening_time TEXT,
+                    typical_work_hours TEXT,
+                    preferred_reminder_times TEXT,
+                    quiet_hours_start TEXT,
+                    quiet_hours_end TEXT,
+                    last_updated TEXT
+                )
+            """)
+            
+            # リマインダー設定
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS reminders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    reminder_type TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    remind_at TEXT NOT NULL,
+                    repeat_pattern TEXT,
+                    enabled INTEGER DEFAULT 1,
+                    related_goal_id INTEGER,
+                    related_task_id INTEGER,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            
+            # 会話開始履歴
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_initiations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    initiated_at TEXT NOT NULL,
+                    message_type TEXT NOT NULL,
+                    user_responded INTEGER DEFAULT 0,
+                    response_time_seconds INTEGER,
+                    user_sentiment TEXT
+                )
+            """)
+
+            # インデックス（送信待ち取得・送信頻度チェック用）
+            # 送信待ち取得はポーリングで頻繁に呼ばれるため、取得列をすべて含む
+            # カバリングインデックスにしてテーブル本体を読まずに済ませる
+            c.execute("DROP INDEX IF EXISTS idx_msgq_pending")
+            c.execute("""
+                CREATE INDEX IF NOT EXISTS idx_msgq_pending_cov
+                ON ai_messages_queue(user_id, sent, scheduled_time, priority, id,
+                                     message_type, message_content, metadata)
+            """)
+            c.execute("""
+                CREATE INDEX IF NOT EXISTS idx_msgq_rate
+                ON ai_messages_queue(user_id, sent, sent_at)
+            """)
+            c.execute("""
+                CREATE INDEX IF NOT EXISTS idx_msgq_task
+                ON ai_messages_queue(user_id, message_type, related_task_id, scheduled_time)
+            """)
+
+            # 活動時間の集計（日・時間帯ごとの会話数と 0時からの経過分の合計）
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS user_activity_agg (
+                    user_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    bucket_hour INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    sum_minutes INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, day, bucket_hour)
+                )
+            """)
+
+            # パターン学習用（conversationsテーブルはmain.pyで作成される）
+            conversations_exists = c.execute("""
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'table' AND name = 'conversations'
+            """).fetchone()
+            existing_triggers = {
+                row[0] for row in c.execute("""
+                    SELECT name FROM sqlite_master
+                    WHERE type = 'trigger' AND tbl_name = 'conversations'
+                """)
+            }
+            missing_triggers = [
+                name for name in _SQL_ACTIVITY_AGG_TRIGGERS if name not in existing_triggers
+            ]
+
+            if not conversations_exists:
+                print("⚠️ conversationsテーブルがないため、活動時間の集計は次回の初期化で作成します")
+            elif missing_triggers:
+                # トリガーがなかった間の追加・削除・変更は集計に入っていないので、作り直す
+                with self._write_transaction():
+                    c.execute("""
+                        CREATE INDEX IF NOT EXISTS idx_conversations_user_ts
+                        ON conversations(user_id, timestamp)
+                    """)
+
+                    # 会話の追加・削除・時刻の変更時に集計を更新する
+                    for name in missing_triggers:
+                        c.execute(_SQL_ACTIVITY_AGG_TRIGGERS[name])
+
+                    c.execute("DELETE FROM user_activity_agg")
+                    c.execute(_SQL_ACTIVITY_AGG_REBUILD)
+
+                # 索引を作った直後だけ統計を取る（毎回の全体ANALYZEはしない）
+                c.execute("ANALYZE")
         
-        self.conn.commit()
-    
     # ==================== ユーザーパターン学習 ====================
     
     def learn_user_patterns(self, user_id: str):
@@ -114,60 +510,55 @@ class ConversationInitiator:
         - いつが忙しいか
         - どの時間帯に反応が良いか
         """
-        c = self.conn.cursor()
-        
-        # 過去30日間の会話を分析
-        start_date = (datetime.now() - timedelta(days=30)).isoformat()
-        
-        c.execute("""
-            SELECT timestamp
-            FROM conversations
-            WHERE user_id = ? AND timestamp >= ?
-            ORDER BY timestamp
-        """, (user_id, start_date))
-        
-        timestamps = [datetime.fromisoformat(row[0]) for row in c.fetchall()]
-        
-        if not timestamps:
+        # 過去30日間の会話を分析（集計テーブルから時間帯ごとに合算）
+        start_day = (datetime.now() - timedelta(days=30)).date().isoformat()
+        
+        with self._reader() as conn:
+            row = conn.execute("""
+                SELECT
+                    SUM(CASE WHEN bucket_hour BETWEEN 6 AND 11 THEN count END),
+                    SUM(CASE WHEN bucket_hour BETWEEN 6 AND 11 THEN sum_minutes END),
+                    SUM(CASE WHEN bucket_hour BETWEEN 18 AND 23 THEN count END),
+                    SUM(CASE WHEN bucket_hour BETWEEN 18 AND 23 THEN sum_minutes END),
+                    SUM(count)
+                FROM user_activity_agg
+                WHERE user_id = ? AND day >= ?
+            """, (user_id, start_day)).fetchone()
+        
+        morning_count, morning_minutes, evening_count, evening_minutes, total = row
+        
+        if not total:
             return self._get_default_patterns()
         
-        # 朝の会話時間を抽出
-        morning_times = [
-            t.time() for t in timestamps
-            if 6 <= t.hour <= 11
-        ]
-        
-        # 夜の会話時間を抽出
-        evening_times = [
-            t.time() for t in timestamps
-            if 18 <= t.hour <= 23
-        ]
-        
         # 平均時間を計算
-        typical_morning = self._calculate_average_time(morning_times) if morning_times else "08:00"
-        typical_evening = self._calculate_average_time(evening_times) if evening_times else "20:00"
-        
-        # パターンを保存
-        c.execute("""
-            INSERT OR REPLACE INTO user_activity_patterns
-            (user_id, typical_morning_time, typical_evening_time, last_updated)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, typical_morning, typical_evening, datetime.now().isoformat()))
-        
-        self.conn.commit()
+        typical_morning = self._calculate_average_time(morning_minutes, morning_count) if morning_count else "08:00"
+        typical_evening = self._calculate_average_time(evening_minutes, evening_count) if evening_count else "20:00"
+        
+        # パターンを保存（quiet hours など他の設定は残す）
+        with self._write_transaction() as conn:
+            conn.execute("""
+                INSERT INTO user_activity_patterns
+                (user_id, typical_morning_time, typical_evening_time, last_updated)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    typical_morning_time = excluded.typical_morning_time,
+                    typical_evening_time = excluded.typical_evening_time,
+                    last_updated = excluded.last_updated
+            """, (user_id, typical_morning, typical_evening, datetime.now().isoformat()))
+        
+        self.invalidate_user_patterns(user_id)
         
         return {
             "typical_morning_time": typical_morning,
             "typical_evening_time": typical_evening
         }
     
-    def _calculate_average_time(self, times: List[time]) -> str:
-        """時刻の平均を計算"""
-        if not times:
+    def _calculate_average_time(self, total_minutes: int, count: int) -> str:
+        """時刻の平均を計算（total_minutes は 0時からの経過分の合計）"""
+        if not count:
             return "08:00"
         
-        total_minutes = sum(t.hour * 60 + t.minute for t in times)
-        avg_minutes = total_minutes // len(times)
+        avg_minutes = total_minutes // count
         
         hour = avg_minutes // 60
         minute = avg_minutes % 60
@@ -183,83 +574,124 @@ class ConversationInitiator:
     
     def get_user_patterns(self, user_id: str) -> Dict:
         """ユーザーパターン取得"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            SELECT typical_morning_time, typical_evening_time,
-                   quiet_hours_start, quiet_hours_end
-            FROM user_activity_patterns
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        row = c.fetchone()
+        return self._load_user_patterns(user_id)[0]
+    
+    def invalidate_user_patterns(self, user_id: str):
+        """パターンのキャッシュを破棄（パターン更新時に呼ぶ）"""
+        self._pattern_cache.pop(user_id, None)
+    
+    def _load_user_patterns(self, user_id: str) -> tuple:
+        """
+        パターンと、時刻文字列を解析済みの値を取得
+        DBへの問い合わせと strptime は _PATTERN_CACHE_TTL 秒に1回だけ行う
+        """
+        cached = self._pattern_cache.get(user_id)
+        if cached and monotonic() - cached[0] < _PATTERN_CACHE_TTL:
+            return cached[1], cached[2]
+        
+        with self._reader() as conn:
+            row = conn.execute("""
+                SELECT typical_morning_time, typical_evening_time,
+                       quiet_hours_start, quiet_hours_end
+                FROM user_activity_patterns
+                WHERE user_id = ?
+            """, (user_id,)).fetchone()
         
         if not row:
-            return self._get_default_patterns()
+            patterns = self._get_default_patterns()
+        else:
+            patterns = {
+                "typical_morning_time": row[0],
+                "typical_evening_time": row[1],
+                "quiet_hours_start": row[2],
+                "quiet_hours_end": row[3]
+            }
         
-        return {
-            "typical_morning_time": row[0],
-            "typical_evening_time": row[1],
-            "quiet_hours_start": row[2],
-            "quiet_hours_end": row[3]
+        # quiet hours は HHMM の整数で持つ（"22:30" -> 2230）
+        quiet_hours = None
+        if patterns.get('quiet_hours_start') and patterns.get('quiet_hours_end'):
+            quiet_hours = (
+                _to_hhmm(patterns['quiet_hours_start']),
+                _to_hhmm(patterns['quiet_hours_end'])
+            )
+        
+        parsed = {
+            "morning": datetime.strptime(patterns.get('typical_morning_time') or "08:00", "%H:%M").time(),
+            "evening": datetime.strptime(patterns.get('typical_evening_time') or "20:00", "%H:%M").time(),
+            "quiet_hours": quiet_hours
         }
+        
+        self._pattern_cache[user_id] = (monotonic(), patterns, parsed)
+        return patterns, parsed
     
     # ==================== メッセージ生成 ====================
     
-    def generate_morning_checkin(self, user_id: str) -> Dict:
-        """朝のチェックインメッセージ"""
+    def _fetch_daily_context(self, user_id: str, include_goals: bool = True) -> Dict:
+        """
+        朝・夜のメッセージ生成とタスクリマインダーに使うデータを1回で取得
+        1回の定期チェックの中で同じ問い合わせを繰り返さないようにする
+        """
+        return {
+            # 今日の予定
+            "schedules": self.schedule_mgr.get_today_schedule(user_id),
+            # 未完了タスク
+            "tasks": self.schedule_mgr.get_pending_tasks(user_id),
+            # アクティブな目標
+            "goals": self.goal_mgr.get_active_goals(user_id) if include_goals else []
+        }
+    
+    def generate_morning_checkin(self, user_id: str, context: Optional[Dict] = None) -> Dict:
+        """
+        朝のチェックインメッセージ
+        context: _fetch_daily_context の結果（省略時はここで取得）
+        """
+        if context is None:
+            context = self._fetch_daily_context(user_id)
         
-        # 今日の予定
-        schedules = self.schedule_mgr.get_today_schedule(user_id)
+        schedules = context["schedules"]
         
         # 優先タスク
-        tasks = self.schedule_mgr.get_pending_tasks(user_id)
-        urgent_tasks = [t for t in tasks if t["priority"] == "high"][:2]
+        urgent_tasks = [t for t in context["tasks"] if t["priority"] == "high"][:2]
         
-        # アクティブな目標
-        goals = self.goal_mgr.get_active_goals(user_id)
+        goals = context["goals"]
         
-        greetings = [
-            "おはようございます!",
-            "おはようございます! 今日も良い一日にしましょう。",
-            "おはよう! 新しい一日の始まりです。"
-        ]
-        
-        message = random.choice(greetings) + "\n\n"
+        parts = [_rng.choice(_MORNING_GREETINGS), "\n\n"]
         
         # 予定がある場合
         if schedules:
-            message += f"📅 今日は{len(schedules)}件の予定があります\n"
             first = schedules[0]
             start_time = datetime.fromisoformat(first["start_time"]).strftime("%H:%M")
-            message += f"最初の予定: {start_time} - {first['title']}\n\n"
+            parts.append(f"📅 今日は{len(schedules)}件の予定があります\n")
+            parts.append(f"最初の予定: {start_time} - {first['title']}\n\n")
         else:
-            message += "📅 今日は予定のない日ですね\n\n"
+            parts.append("📅 今日は予定のない日ですね\n\n")
         
         # 優先タスク
         if urgent_tasks:
-            message += "✅ 今日取り組むべきこと:\n"
-            for task in urgent_tasks:
-                message += f"・{task['title']}\n"
-            message += "\n"
+            parts.append("✅ 今日取り組むべきこと:\n")
+            parts.extend(f"・{task['title']}\n" for task in urgent_tasks)
+            parts.append("\n")
         
         # 目標の進捗
         if goals:
             goal = goals[0]
             if goal['progress_percentage'] > 0:
-                message += f"🎯 「{goal['title']}」: {goal['progress_percentage']}%\n"
+                parts.append(f"🎯 「{goal['title']}」: {goal['progress_percentage']}%\n")
         
-        message += "\n今日は何に挑戦しますか? 応援しています! 💪"
+        parts.append("\n今日は何に挑戦しますか? 応援しています! 💪")
         
         return {
             "type": "morning_checkin",
             "priority": MessagePriority.MEDIUM.value,
-            "content": message,
+            "content": "".join(parts),
             "requires_response": False
         }
     
-    def generate_evening_reflection(self, user_id: str) -> Dict:
-        """夕方の振り返りプロンプト"""
+    def generate_evening_reflection(self, user_id: str, context: Optional[Dict] = None) -> Dict:
+        """
+        夕方の振り返りプロンプト
+        context: _fetch_daily_context の結果（省略時は予定だけ取得）
+        """
         
         # 今日の日記エントリをチェック
         today_entry = self.journal_sys.get_journal_entry(user_id)
@@ -274,24 +706,22 @@ class ConversationInitiator:
             }
         
         # 今日の予定を確認
-        schedules = self.schedule_mgr.get_today_schedule(user_id)
+        if context is not None:
+            schedules = context["schedules"]
+        else:
+            schedules = self.schedule_mgr.get_today_schedule(user_id)
         
-        message = "今日も1日お疲れ様でした! ✨\n\n"
+        parts = ["今日も1日お疲れ様でした! ✨\n\n"]
         
         if schedules:
-            message += f"今日は{len(schedules)}件の予定をこなしましたね。\n\n"
+            parts.append(f"今日は{len(schedules)}件の予定をこなしましたね。\n\n")
         
-        message += "少しだけ今日を振り返りませんか?\n\n"
-        message += "📝 今日の出来事:\n"
-        message += "・うまくいったこと\n"
-        message += "・学んだこと\n"
-        message += "・感謝したいこと\n\n"
-        message += "何でも大丈夫です。気軽に話してください😊"
+        parts.append(_EVENING_REFLECTION_BODY)
         
         return {
             "type": "evening_reflection",
             "priority": MessagePriority.HIGH.value,
-            "content": message,
+            "content": "".join(parts),
             "requires_response": True
         }
     
@@ -300,24 +730,22 @@ class ConversationInitiator:
         
         progress = goal['progress_percentage']
         
-        message = f"「{goal['title']}」の進捗チェックです\n\n"
-        message += f"📊 現在の進捗: {progress}%\n\n"
-        
         if progress < 20:
-            message += "まだ始めたばかりですね。\n"
-            message += "最初の一歩が一番大変ですが、焦らず進めていきましょう。\n\n"
+            comment = "まだ始めたばかりですね。\n最初の一歩が一番大変ですが、焦らず進めていきましょう。\n\n"
         elif progress < 50:
-            message += "順調に進んでいますね!\n"
-            message += "この調子で続けていきましょう。\n\n"
+            comment = "順調に進んでいますね!\nこの調子で続けていきましょう。\n\n"
         elif progress < 80:
-            message += "素晴らしい進捗です!\n"
-            message += "ゴールが見えてきましたね。\n\n"
+            comment = "素晴らしい進捗です!\nゴールが見えてきましたね。\n\n"
         else:
-            message += "もうすぐ完成です!\n"
-            message += "あと少し、頑張りましょう!\n\n"
-        
-        message += "最近の取り組みはいかがですか?\n"
-        message += "何か困っていることがあれば教えてください。"
+            comment = "もうすぐ完成です!\nあと少し、頑張りましょう!\n\n"
+        
+        message = "".join((
+            f"「{goal['title']}」の進捗チェックです\n\n",
+            f"📊 現在の進捗: {progress}%\n\n",
+            comment,
+            "最近の取り組みはいかがですか?\n",
+            "何か困っていることがあれば教えてください。"
+        ))
         
         return {
             "type": "goal_checkin",
@@ -336,32 +764,26 @@ class ConversationInitiator:
             today = datetime.now().date()
             days_left = (due - today).days
             
-            if days_left == 0:
-                urgency = "今日が期限"
-                emoji = "⚠️"
-            elif days_left == 1:
-                urgency = "明日が期限"
-                emoji = "📌"
-            else:
-                urgency = f"あと{days_left}日"
-                emoji = "📅"
+            urgency, emoji = _URGENCY_TABLE.get(days_left, (f"あと{days_left}日", "📅"))
         else:
             urgency = "期限なし"
             emoji = "✅"
         
-        message = f"{emoji} タスクのリマインダーです\n\n"
-        message += f"「{task['title']}」\n"
-        message += f"期限: {urgency}\n\n"
+        parts = [
+            f"{emoji} タスクのリマインダーです\n\n",
+            f"「{task['title']}」\n",
+            f"期限: {urgency}\n\n"
+        ]
         
         if task.get('priority') == 'high':
-            message += "優先度が高いタスクです。\n"
+            parts.append("優先度が高いタスクです。\n")
         
-        message += "取り組みましょうか?"
+        parts.append("取り組みましょうか?")
         
         return {
             "type": "task_reminder",
             "priority": MessagePriority.HIGH.value,
-            "content": message,
+            "content": "".join(parts),
             "requires_response": True,
             "metadata": {"task_id": task['id']}
         }
@@ -369,20 +791,22 @@ class ConversationInitiator:
     def generate_habit_reminder(self, user_id: str, habit: Dict) -> Dict:
         """習慣リマインダー"""
         
-        message = f"🔔 習慣のリマインダー\n\n"
-        message += f"「{habit['title']}」\n"
-        message += f"今日はもうやりましたか?\n\n"
+        parts = [
+            "🔔 習慣のリマインダー\n\n",
+            f"「{habit['title']}」\n",
+            "今日はもうやりましたか?\n\n"
+        ]
         
         if habit.get('current_streak', 0) > 0:
-            message += f"現在{habit['current_streak']}日連続です!\n"
-            message += "この調子で続けましょう! 🔥"
+            parts.append(f"現在{habit['current_streak']}日連続です!\n")
+            parts.append("この調子で続けましょう! 🔥")
         else:
-            message += "今日から再スタートしましょう!"
+            parts.append("今日から再スタートしましょう!")
         
         return {
             "type": "habit_reminder",
             "priority": MessagePriority.MEDIUM.value,
-            "content": message,
+            "content": "".join(parts),
             "requires_response": True,
             "metadata": {"habit_id": habit.get('id')}
         }
@@ -390,15 +814,11 @@ class ConversationInitiator:
     def generate_break_suggestion(self, user_id: str, work_duration: int) -> Dict:
         """休憩提案"""
         
-        message = f"💡 休憩のおすすめ\n\n"
-        message += f"もう{work_duration}分集中していますね。\n"
-        message += "そろそろ休憩を取りませんか?\n\n"
-        message += "おすすめの休憩方法:\n"
-        message += "・5分間のストレッチ\n"
-        message += "・窓の外を見る\n"
-        message += "・水を飲む\n"
-        message += "・軽く歩く\n\n"
-        message += "リフレッシュして、また集中しましょう!"
+        message = "".join((
+            "💡 休憩のおすすめ\n\n",
+            f"もう{work_duration}分集中していますね。\n",
+            _BREAK_SUGGESTION_BODY
+        ))
         
         return {
             "type": "break_suggestion",
@@ -410,32 +830,17 @@ class ConversationInitiator:
     def generate_weekly_review_prompt(self, user_id: str) -> Dict:
         """週次振り返りプロンプト"""
         
-        message = "🎉 今週もお疲れ様でした!\n\n"
-        message += "1週間を振り返ってみませんか?\n\n"
-        message += "以下について教えてください:\n"
-        message += "1. 今週の一番の成果は?\n"
-        message += "2. 新しく学んだことは?\n"
-        message += "3. 来週改善したいことは?\n\n"
-        message += "振り返ることで、成長を実感できますよ😊"
-        
         return {
             "type": "weekly_review",
             "priority": MessagePriority.HIGH.value,
-            "content": message,
+            "content": _WEEKLY_REVIEW_MESSAGE,
             "requires_response": True
         }
     
     def generate_encouragement(self, user_id: str, context: str) -> Dict:
         """励ましメッセージ"""
         
-        encouragements = {
-            "struggling": "大丈夫、うまくいかない日もあります。明日また頑張りましょう。一緒に乗り越えていきましょう!",
-            "tired": "お疲れのようですね。無理せず、今日はゆっくり休みましょう。休むことも大切な仕事です。",
-            "procrastinating": "始めるのが一番大変ですよね。まずは5分だけやってみませんか? 小さな一歩から始めましょう!",
-            "celebrating": "素晴らしい! よく頑張りましたね。この成功を喜びましょう! 🎉"
-        }
-        
-        message = encouragements.get(context, "応援しています! 一緒に頑張りましょう!")
+        message = _ENCOURAGEMENTS.get(context, "応援しています! 一緒に頑張りましょう!")
         
         return {
             "type": "encouragement",
@@ -466,30 +871,28 @@ class ConversationInitiator:
         if current_hour < 6 or current_hour >= 23:
             return False
         
-        # ユーザーパターンを取得
-        patterns = self.get_user_patterns(user_id)
+        # ユーザーパターンを取得（解析済みの時刻を使う）
+        _, parsed = self._load_user_patterns(user_id)
         
         # quiet hours チェック
-        if patterns.get('quiet_hours_start') and patterns.get('quiet_hours_end'):
-            quiet_start = datetime.strptime(patterns['quiet_hours_start'], "%H:%M").time()
-            quiet_end = datetime.strptime(patterns['quiet_hours_end'], "%H:%M").time()
+        if parsed['quiet_hours']:
+            quiet_start, quiet_end = parsed['quiet_hours']
             
-            if quiet_start <= now.time() <= quiet_end:
+            if quiet_start <= now.hour * 100 + now.minute <= quiet_end:
                 return False
         
         # 最近のメッセージ頻度チェック
-        c = self.conn.cursor()
-        
         # 過去1時間以内に送ったメッセージ
         one_hour_ago = (now - timedelta(hours=1)).isoformat()
         
-        c.execute("""
-            SELECT COUNT(*)
-            FROM ai_messages_queue
-            WHERE user_id = ? AND sent = 1 AND sent_at >= ?
-        """, (user_id, one_hour_ago))
-        
-        recent_count = c.fetchone()[0]
+        # 上限の判定に必要な件数だけ読む
+        with self._reader() as conn:
+            recent_count = len(conn.execute("""
+                SELECT 1
+                FROM ai_messages_queue
+                WHERE user_id = ? AND sent = 1 AND sent_at >= ?
+                LIMIT 3
+            """, (user_id, one_hour_ago)).fetchall())
         
         # 1時間に3件以上は送らない
         if recent_count >= 3:
@@ -519,81 +922,100 @@ class ConversationInitiator:
         scheduled_time: Optional[str] = None,
         metadata: Optional[Dict] = None
     ) -> int:
-        """メッセージをキューに追加"""
-        c = self.conn.cursor()
-        
+        """
+        メッセージをキューに追加
+        単発の呼び出しはこの1文で確定する。
+        呼び出し側が BEGIN 済みならそのトランザクションに含まれる
+        """
         if not scheduled_time:
             scheduled_time = datetime.now().isoformat()
         
-        c.execute("""
-            INSERT INTO ai_messages_queue
-            (user_id, message_type, priority, message_content, 
-             scheduled_time, metadata, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id, message_type, priority, content,
-            scheduled_time, json.dumps(metadata or {}),
-            datetime.now().isoformat()
-        ))
-        
-        message_id = c.lastrowid
-        self.conn.commit()
+        if metadata:
+            metadata_json = _jdumps(metadata)
+            task_id, goal_id = metadata.get('task_id'), metadata.get('goal_id')
+        else:
+            metadata_json = _EMPTY_META
+            task_id = goal_id = None
+        
+        with self._write_transaction() as conn:
+            c = conn.execute(_SQL_INSERT_MSG, (
+                user_id, message_type, priority, content,
+                scheduled_time, metadata_json,
+                datetime.now().isoformat(),
+                task_id, goal_id
+            ))
+            
+            message_id = c.lastrowid
         
         return message_id
     
+    def iter_pending_messages(self, user_id: str, batch_size: int = 64) -> Iterator[Dict]:
+        """
+        送信待ちのメッセージを1件ずつ返す
+        全件のdictを一度に作らないので、溜まったキューでもメモリを抑えられる。
+        batch_size 件ずつ読み、読み取り用の接続は yield の前に返す
+        （途中でやめても、イテレート中に他の読み取りをしても詰まらない）
+        """
+        now = datetime.now().isoformat()
+        last_key = None
+        
+        while True:
+            with self._reader() as conn:
+                if last_key is None:
+                    rows = conn.execute(
+                        _SQL_PENDING_FIRST, (user_id, now, batch_size)
+                    ).fetchall()
+                else:
+                    rows = conn.execute(
+                        _SQL_PENDING_NEXT, (user_id, now, *last_key, batch_size)
+                    ).fetchall()
+            
+            for row in rows:
+                yield {
+                    "id": row[0],
+                    "message_type": row[1],
+                    "priority": row[2],
+                    "content": row[3],
+                    "scheduled_time": row[4],
+                    "metadata": _jloads(row[5]) if row[5] and row[5] != _EMPTY_META else {}
+                }
+            
+            if len(rows) < batch_size:
+                break
+            
+            # 次のバッチは並び順で最後の行より後から（priority, scheduled_time, id）
+            last_key = (rows[-1][2], rows[-1][4], rows[-1][0])
+    
     def get_pending_messages(self, user_id: str) -> List[Dict]:
         """送信待ちのメッセージを取得"""
-        c = self.conn.cursor()
-        
-        now = datetime.now().isoformat()
-        
-        c.execute("""
-            SELECT id, message_type, priority, message_content, 
-                   scheduled_time, metadata
-            FROM ai_messages_queue
-            WHERE user_id = ? 
-              AND sent = 0
-              AND scheduled_time <= ?
-            ORDER BY priority ASC, scheduled_time ASC
-        """, (user_id, now))
-        
-        messages = []
-        for row in c.fetchall():
-            messages.append({
-                "id": row[0],
-                "message_type": row[1],
-                "priority": row[2],
-                "content": row[3],
-                "scheduled_time": row[4],
-                "metadata": json.loads(row[5]) if row[5] else {}
-            })
-        
-        return messages
+        return list(self.iter_pending_messages(user_id))
     
     def mark_message_sent(self, message_id: int) -> bool:
         """メッセージを送信済みにマーク"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            UPDATE ai_messages_queue
-            SET sent = 1, sent_at = ?
-            WHERE id = ?
-        """, (datetime.now().isoformat(), message_id))
+        with self._write_transaction() as conn:
+            c = conn.execute(_SQL_MARK_SENT, (datetime.now().isoformat(), message_id))
         
-        self.conn.commit()
         return c.rowcount > 0
     
+    def mark_messages_sent(self, message_ids: List[int]) -> int:
+        """複数のメッセージを1回のトランザクションで送信済みにマーク"""
+        if not message_ids:
+            return 0
+        
+        sent_at = datetime.now().isoformat()
+        
+        with self._write_transaction() as conn:
+            c = conn.executemany(
+                _SQL_MARK_SENT, [(sent_at, message_id) for message_id in message_ids]
+            )
+        
+        return c.rowcount
+    
     def mark_message_acknowledged(self, message_id: int) -> bool:
         """ユーザーが確認したことをマーク"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            UPDATE ai_messages_queue
-            SET acknowledged = 1, acknowledged_at = ?
-            WHERE id = ?
-        """, (datetime.now().isoformat(), message_id))
+        with self._write_transaction() as conn:
+            c = conn.execute(_SQL_MARK_ACK, (datetime.now().isoformat(), message_id))
         
-        self.conn.commit()
         return c.rowcount > 0
     
     # ==================== 定期的なチェック ====================
@@ -607,65 +1029,64 @@ class ConversationInitiator:
         - 目標チェックイン
         """
         
-        now = datetime.now()
-        patterns = self.get_user_patterns(user_id)
-        
-        # 朝のチェックインをキュー
-        morning_time = patterns.get('typical_morning_time', '08:00')
-        morning_dt = datetime.combine(now.date(), datetime.strptime(morning_time, "%H:%M").time())
-        
-        # 今日の朝のメッセージがまだキューにない場合
-        c = self.conn.cursor()
-        c.execute("""
-            SELECT id FROM ai_messages_queue
-            WHERE user_id = ? 
-              AND message_type = 'morning_checkin'
-              AND DATE(scheduled_time) = DATE(?)
-        """, (user_id, now.isoformat()))
-        
-        if not c.fetchone():
-            morning_msg = self.generate_morning_checkin(user_id)
-            self.queue_message(
-                user_id=user_id,
-                message_type=morning_msg['type'],
-                priority=morning_msg['priority'],
-                content=morning_msg['content'],
-                scheduled_time=morning_dt.isoformat()
-            )
-        
-        # 夜の振り返りをキュー
-        evening_time = patterns.get('typical_evening_time', '20:00')
-        evening_dt = datetime.combine(now.date(), datetime.strptime(evening_time, "%H:%M").time())
-        
-        c.execute("""
-            SELECT id FROM ai_messages_queue
-            WHERE user_id = ?
-              AND message_type IN ('evening_reflection', 'evening_simple')
-              AND DATE(scheduled_time) = DATE(?)
-        """, (user_id, now.isoformat()))
-        
-        if not c.fetchone():
-            evening_msg = self.generate_evening_reflection(user_id)
-            self.queue_message(
-                user_id=user_id,
-                message_type=evening_msg['type'],
-                priority=evening_msg['priority'],
-                content=evening_msg['content'],
-                scheduled_time=evening_dt.isoformat()
-            )
-        
-        # 週次振り返り（日曜日の夕方）
-        if now.weekday() == 6:  # 日曜日
-            review_time = datetime.combine(now.date(), time(hour=18, minute=0))
+        # 書き込み接続を占有し、1回のトランザクションにまとめてfsyncを1回にする
+        with self._write_transaction():
+            
+            now = datetime.now()
+            today = now.date()
+            _, parsed = self._load_user_patterns(user_id)
             
+            # 今日の範囲 [day_start, day_end)（ISO文字列は辞書順で比較できる）
+            day_start = today.isoformat() + "T00:00:00"
+            day_end = (today + timedelta(days=1)).isoformat() + "T00:00:00"
+            
+            # 今日すでにキューにある定期メッセージの種類をまとめて取得
+            c = self._write_conn.cursor()
             c.execute("""
-                SELECT id FROM ai_messages_queue
+                SELECT DISTINCT message_type FROM ai_messages_queue
                 WHERE user_id = ?
-                  AND message_type = 'weekly_review'
-                  AND DATE(scheduled_time) = DATE(?)
-            """, (user_id, now.isoformat()))
+                  AND message_type IN ('morning_checkin', 'evening_reflection',
+                                       'evening_simple', 'weekly_review')
+                  AND scheduled_time >= ? AND scheduled_time < ?
+            """, (user_id, day_start, day_end))
+            
+            existing = {row[0] for row in c.fetchall()}
+            
+            # 予定・タスク・目標をまとめて取得（目標は朝のメッセージを作る場合のみ）
+            context = self._fetch_daily_context(
+                user_id, include_goals='morning_checkin' not in existing
+            )
+            
+            # 朝のチェックインをキュー
+            morning_dt = datetime.combine(today, parsed['morning'])
+            
+            # 今日の朝のメッセージがまだキューにない場合
+            if 'morning_checkin' not in existing:
+                morning_msg = self.generate_morning_checkin(user_id, context)
+                self.queue_message(
+                    user_id=user_id,
+                    message_type=morning_msg['type'],
+                    priority=morning_msg['priority'],
+                    content=morning_msg['content'],
+                    scheduled_time=morning_dt.isoformat()
+                )
             
-            if not c.fetchone():
+            # 夜の振り返りをキュー
+            evening_dt = datetime.combine(today, parsed['evening'])
+            
+            if not existing & {'evening_reflection', 'evening_simple'}:
+                evening_msg = self.generate_evening_reflection(user_id, context)
+                self.queue_message(
+                    user_id=user_id,
+                    message_type=evening_msg['type'],
+                    priority=evening_msg['priority'],
+                    content=evening_msg['content'],
+                    scheduled_time=evening_dt.isoformat()
+                )
+            
+            # 週次振り返り（日曜日の夕方）
+            if now.weekday() == 6 and 'weekly_review' not in existing:  # 日曜日
+                review_time = datetime.combine(today, time(hour=18, minute=0))
                 review_msg = self.generate_weekly_review_prompt(user_id)
                 self.queue_message(
                     user_id=user_id,
@@ -674,39 +1095,51 @@ class ConversationInitiator:
                     content=review_msg['content'],
                     scheduled_time=review_time.isoformat()
                 )
-        
-        # タスクリマインダー（期限が近いもの）
-        tasks = self.schedule_mgr.get_pending_tasks(user_id)
-        for task in tasks:
-            if task.get('due_date'):
-                due = datetime.fromisoformat(task['due_date']).date()
-                days_left = (due - now.date()).days
+            
+            # タスクリマインダー（期限が今日または明日のもの）
+            due_tasks = []
+            for task in context["tasks"]:
+                if task.get('due_date'):
+                    due = datetime.fromisoformat(task['due_date']).date()
+                    days_left = (due - today).days
+                    if 0 <= days_left <= 1:
+                        due_tasks.append(task)
+            
+            if due_tasks:
+                # すでにリマインダーがあるタスクを1回のクエリで確認
+                placeholders = ",".join("?" * len(due_tasks))
+                c.execute(f"""
+                    SELECT related_task_id FROM ai_messages_queue
+                    WHERE user_id = ?
+                      AND message_type = 'task_reminder'
+                      AND scheduled_time >= ? AND scheduled_time < ?
+                      AND related_task_id IN ({placeholders})
+                """, (user_id, day_start, day_end, *(t["id"] for t in due_tasks)))
                 
-                # 期限が今日または明日のタスク
-                if 0 <= days_left <= 1:
-                    # すでにリマインダーが送られていないかチェック
-                    c.execute("""
-                        SELECT id FROM ai_messages_queue
-                        WHERE user_id = ?
-                          AND message_type = 'task_reminder'
-                          AND metadata LIKE ?
-                          AND DATE(scheduled_time) = DATE(?)
-                    """, (user_id, f'%"task_id": {task["id"]}%', now.isoformat()))
+                reminded = {row[0] for row in c.fetchall()}
+                
+                # 午前10時にリマインド
+                reminder_time = datetime.combine(today, time(hour=10, minute=0))
+                
+                reminder_iso = reminder_time.isoformat()
+                created_at = datetime.now().isoformat()
+                
+                params = []
+                for task in due_tasks:
+                    if task["id"] in reminded:
+                        continue
                     
-                    if not c.fetchone():
-                        reminder_msg = self.generate_task_reminder(user_id, task)
-                        # 午前10時にリマインド
-                        reminder_time = datetime.combine(now.date(), time(hour=10, minute=0))
-                        
-                        self.queue_message(
-                            user_id=user_id,
-                            message_type=reminder_msg['type'],
-                            priority=reminder_msg['priority'],
-                            content=reminder_msg['content'],
-                            scheduled_time=reminder_time.isoformat(),
-                            metadata=reminder_msg.get('metadata')
-                        )
-
+                    reminder_msg = self.generate_task_reminder(user_id, task)
+                    params.append((
+                        user_id, reminder_msg['type'], reminder_msg['priority'],
+                        reminder_msg['content'], reminder_iso,
+                        _jdumps(reminder_msg['metadata']), created_at,
+                        task["id"], None
+                    ))
+                
+                # 同じINSERTをまとめて実行
+                if params:
+                    self._write_conn.executemany(_SQL_INSERT_MSG, params)
 
 # ==================== 使用例 ====================
 
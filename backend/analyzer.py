@@ -4,15 +4,200 @@ analyzer.py
 """
 
 import ollama
+import asyncio
 import json
 import re
-from typing import Dict, List
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from _ollama_pool import async_client, client
+from request_context import request_now
+
+# orjson があれば使う（C実装でUTF-8を直接出力するため高速）
+try:
+    import orjson
+    
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+    
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+    
+    _loads = json.loads
+
+
+# 簡易トピック抽出のキーワード（結果はこの順序で返す）
+_TOPIC_KEYWORDS = (
+    'Python', 'JavaScript', 'Java', 'C++', 'Go', 'Rust',
+    'React', 'Vue', 'Angular', 'Next.js',
+    'AI', '機械学習', 'ディープラーニング', 'ChatGPT',
+    'Web開発', 'アプリ開発', 'ゲーム開発',
+    'データベース', 'SQL', 'NoSQL',
+    'Docker', 'Kubernetes', 'AWS', 'Azure',
+    'アルゴリズム', 'データ構造',
+    'プログラミング', '開発', 'エンジニアリング'
+)
+
+_TOPIC_KEYWORDS_LOWER = frozenset(kw.lower() for kw in _TOPIC_KEYWORDS)
+
+# 小文字化したキーワードの選択肢（長い順）を先読みで全位置に当てる
+_TOPIC_PATTERN = re.compile(
+    "(?=(" + "|".join(
+        re.escape(kw) for kw in sorted(_TOPIC_KEYWORDS_LOWER, key=len, reverse=True)
+    ) + "))"
+)
+
+# 同じ位置で長いキーワードに隠れる接頭辞キーワード（例: javascript → java）
+_TOPIC_PREFIXES = {
+    kw: tuple(other for other in _TOPIC_KEYWORDS_LOWER if other != kw and kw.startswith(other))
+    for kw in _TOPIC_KEYWORDS_LOWER
+}
+
+
+# ==================== プロンプトテンプレート ====================
+# 固定部分はモジュール読み込み時に一度だけ用意し、呼び出しごとには差し込みのみ行う
+
+_ANALYZE_PROMPT = """以下の会話を分析してください。
+
+ユーザー: {user_message}
+AI: {ai_response}
+
+以下のJSON形式で返してください（JSONのみ、他の文字は含めない）:
+{{
+  "topics": ["トピック1", "トピック2"],
+  "emotion": "happy/curious/neutral/frustrated",
+  "intent": "question/chat/request/feedback",
+  "key_info": "ユーザーについて学習した重要な情報（1文で）"
+}}
+"""
+
+_EMOTION_PROMPT = """以下のユーザーメッセージと会話履歴から、ユーザーの感情と心理状態を分析してください。
+
+現在のメッセージ: {user_message}
+
+最近の会話履歴:
+{history}
+
+以下のJSON形式で返してください:
+{{
+  "primary_emotion": "happy/sad/anxious/excited/tired/frustrated/curious/neutral",
+  "emotion_intensity": 1-10,
+  "underlying_needs": ["承認", "サポート", "情報", "共感"],
+  "preferred_response_style": "励まし/具体的アドバイス/共感/簡潔な回答",
+  "energy_level": "high/medium/low",
+  "conversation_goal": "雑談/問題解決/学習/愚痴"
+}}
+"""
+
+
+class _JsonObjectScanner:
+    """
+    LLM応答から最初のJSONオブジェクト部分を切り出す
+    
+    括弧の深さを数えながら1回だけ走査する（文字列リテラル内の括弧とエスケープは無視）。
+    ストリーミング応答にも使えるよう、走査位置と状態を保持して追記分だけを調べる
+    """
+    
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    def feed(self, text: str) -> Optional[str]:
+        """テキストを追加し、オブジェクトが閉じたらその文字列を返す"""
+        self._buf += text
+        s = self._buf
+        
+        i = self._pos
+        if self._start < 0:
+            i = s.find("{", i)
+            if i < 0:
+                self._pos = len(s)
+                return None
+            self._start = i
+        
+        depth = self._depth
+        in_string = self._in_string
+        escaped = self._escaped
+        for i in range(i, len(s)):
+            ch = s[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    self._pos = i + 1
+                    self._depth = 0
+                    return s[self._start:i + 1]
+        
+        self._pos = len(s)
+        self._depth = depth
+        self._in_string = in_string
+        self._escaped = escaped
+        return None
+
+
+def _extract_json_object(s: str) -> Optional[str]:
+    """LLM応答から最初のJSONオブジェクト部分を切り出す"""
+    return _JsonObjectScanner().feed(s)
+
+
+def _chat_json_object_sync(client: "ollama.Client", **chat_kwargs) -> Optional[str]:
+    """_chat_json_object の同期版"""
+    scanner = _JsonObjectScanner()
+    stream = client.chat(stream=True, **chat_kwargs)
+    try:
+        for chunk in stream:
+            json_str = scanner.feed(chunk['message']['content'])
+            if json_str:
+                return json_str
+    finally:
+        stream.close()
+    return None
+
+
+async def _chat_json_object(client: "ollama.AsyncClient", **chat_kwargs) -> Optional[str]:
+    """
+    ストリーミングで ollama.chat を呼び、JSONオブジェクトが閉じた時点で打ち切る
+    
+    後続の説明文などを生成させずに済むよう、ストリームを閉じてOllama側の生成を止める
+    """
+    scanner = _JsonObjectScanner()
+    stream = await client.chat(stream=True, **chat_kwargs)
+    try:
+        async for chunk in stream:
+            json_str = scanner.feed(chunk['message']['content'])
+            if json_str:
+                return json_str
+    finally:
+        await stream.aclose()
+    return None
+
 
 class ConversationAnalyzer:
     """会話分析クラス"""
     
-    def __init__(self, model: str = "gemma3:4b"):
+    def __init__(self, model: str = "gemma3:4b", max_concurrency: int = 8):
         self.model = model
+        # 非同期クライアントを共有し、同時リクエストはOllama側でまとめて処理させる
+        # （並列数はサーバーの OLLAMA_NUM_PARALLEL に合わせる）
+        self._client = async_client
+        self._semaphore = asyncio.Semaphore(max_concurrency)
     
     def analyze_conversation(
         self, 
@@ -31,34 +216,50 @@ class ConversationAnalyzer:
             }
         """
         
-        prompt = f"""以下の会話を分析してください。
-
-ユーザー: {user_message}
-AI: {ai_response}
-
-以下のJSON形式で返してください（JSONのみ、他の文字は含めない）:
-{{
-  "topics": ["トピック1", "トピック2"],
-  "emotion": "happy/curious/neutral/frustrated",
-  "intent": "question/chat/request/feedback",
-  "key_info": "ユーザーについて学習した重要な情報（1文で）"
-}}
-"""
+        prompt = _ANALYZE_PROMPT.format(
+            user_message=user_message, ai_response=ai_response
+        )
         
         try:
-            response = ollama.chat(
+            json_str = _chat_json_object_sync(
+                client,
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 options={"temperature": 0.3}
             )
             
-            content = response['message']['content']
-            
+            if json_str:
+                return _loads(json_str)
+            else:
+                return self._get_default_analysis()
+                
+        except Exception as e:
+            print(f"⚠️ 分析エラー: {e}")
+            return self._get_default_analysis()
+    
+    async def aanalyze_conversation(
+        self, 
+        user_message: str, 
+        ai_response: str
+    ) -> Dict:
+        """analyze_conversation の非同期版（他のLLM呼び出しと並行できる）"""
+        
+        prompt = _ANALYZE_PROMPT.format(
+            user_message=user_message, ai_response=ai_response
+        )
+        
+        try:
             # JSONを抽出（```json ... ``` で囲まれている場合に対応）
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                result = json.loads(json_str)
+            async with self._semaphore:
+                json_str = await _chat_json_object(
+                    self._client,
+                    model=self.model,
+                    messages=[{"role": "user", "content": prompt}],
+                    options={"temperature": 0.3}
+                )
+            
+            if json_str:
+                result = _loads(json_str)
                 return result
             else:
                 return self._get_default_analysis()
@@ -67,6 +268,23 @@ AI: {ai_response}
             print(f"⚠️ 分析エラー: {e}")
             return self._get_default_analysis()
     
+    async def analyze_conversations(
+        self,
+        pairs: List[Tuple[str, str]]
+    ) -> List[Dict]:
+        """
+        複数の会話をまとめて分析（一括取り込み・再分析用）
+        
+        Args:
+            pairs: [(ユーザーメッセージ, AI応答), ...]
+        
+        Returns:
+            pairs と同じ順序の分析結果リスト
+        """
+        return await asyncio.gather(
+            *(self.aanalyze_conversation(u, a) for u, a in pairs)
+        )
+    
     def _get_default_analysis(self) -> Dict:
         """デフォルト分析結果"""
         return {
@@ -78,32 +296,139 @@ AI: {ai_response}
     
     def extract_topics_simple(self, text: str) -> List[str]:
         """簡易的なトピック抽出（キーワードマッチング）"""
-        keywords = [
-            'Python', 'JavaScript', 'Java', 'C++', 'Go', 'Rust',
-            'React', 'Vue', 'Angular', 'Next.js',
-            'AI', '機械学習', 'ディープラーニング', 'ChatGPT',
-            'Web開発', 'アプリ開発', 'ゲーム開発',
-            'データベース', 'SQL', 'NoSQL',
-            'Docker', 'Kubernetes', 'AWS', 'Azure',
-            'アルゴリズム', 'データ構造',
-            'プログラミング', '開発', 'エンジニアリング'
-        ]
-        
-        found_topics = []
         text_lower = text.lower()
         
-        for keyword in keywords:
-            if keyword.lower() in text_lower or keyword in text:
-                found_topics.append(keyword)
+        # 1回の走査で各位置から始まる最長キーワードを拾い、その接頭辞キーワードも補う
+        found = set()
+        for m in _TOPIC_PATTERN.finditer(text_lower):
+            kw = m.group(1)
+            found.add(kw)
+            found.update(_TOPIC_PREFIXES[kw])
+        
+        if not found:
+            return []
+        
+        found_topics = [kw for kw in _TOPIC_KEYWORDS if kw.lower() in found]
         
         return found_topics[:5]  # 最大5個まで
 
 
+# ProfileManager はリクエストごとに作られるため、DB単位の状態はモジュールで持つ
+# スキーマ確認済みのDB（プロセス内で1回だけ確認する）
+_initialized_dbs: set = set()
+_init_lock = threading.Lock()
+
+# (DBのキー, user_id) -> (プロファイルのバージョン, 生成済みシステムプロンプト)
+_prompt_cache: Dict[tuple, Tuple[tuple, str]] = {}
+
+
+def _db_key(conn: sqlite3.Connection):
+    """DBの識別子（ファイルのパス、ファイルのないDBは接続ごと）"""
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main" and path:
+            return path
+    return id(conn)
+
+
 class ProfileManager:
     """ユーザープロファイル管理"""
     
+    # 保持する記憶の最大件数
+    MAX_MEMORIES = 10
+    
     def __init__(self, db_connection):
         self.conn = db_connection
+        self._db_key = None
+        if self.conn is not None:
+            self._db_key = _db_key(self.conn)
+            with _init_lock:
+                if self._db_key not in _initialized_dbs:
+                    self._init_tables()
+                    _initialized_dbs.add(self._db_key)
+    
+    def _init_tables(self):
+        """
+        テーブル初期化
+        
+        毎ターン更新される項目（会話数・トピック数・記憶）は正規化テーブルで持ち、
+        user_profiles.profile_data にはそれ以外の項目（preferences など）を残す
+        """
+        c = self.conn.cursor()
+        
+        c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'profile_scalar'"
+        )
+        needs_backfill = c.fetchone() is None
+        
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS profile_scalar (
+                user_id TEXT PRIMARY KEY,
+                total_conversations INTEGER NOT NULL DEFAULT 0,
+                tone TEXT NOT NULL DEFAULT 'friendly',
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        
+        # 既存DBのマイグレーション（version 列がなければ追加）
+        columns = {row[1] for row in c.execute("PRAGMA table_info(profile_scalar)")}
+        if "version" not in columns:
+            c.execute(
+                "ALTER TABLE profile_scalar ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+            )
+        
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS profile_topic_counts (
+                user_id TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, topic)
+            )
+        """)
+        
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS profile_memories (
+                user_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                memory TEXT NOT NULL,
+                PRIMARY KEY (user_id, seq),
+                UNIQUE (user_id, memory)
+            )
+        """)
+        
+        # 興味（上位トピック）の取得用
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_profile_topic_rank
+            ON profile_topic_counts(user_id, count DESC)
+        """)
+        
+        # 既存のJSONプロファイルから移行（初回のみ）
+        if needs_backfill:
+            try:
+                c.execute("""
+                    INSERT OR IGNORE INTO profile_scalar
+                        (user_id, total_conversations, tone, updated_at)
+                    SELECT user_id,
+                           COALESCE(json_extract(profile_data, '$.total_conversations'), 0),
+                           COALESCE(json_extract(profile_data, '$.tone'), 'friendly'),
+                           updated_at
+                    FROM user_profiles
+                """)
+                c.execute("""
+                    INSERT OR IGNORE INTO profile_topic_counts (user_id, topic, count)
+                    SELECT p.user_id, j.key, j.value
+                    FROM user_profiles p, json_each(p.profile_data, '$.topic_counts') j
+                """)
+                c.execute("""
+                    INSERT OR IGNORE INTO profile_memories (user_id, seq, memory)
+                    SELECT p.user_id, j.key, j.value
+                    FROM user_profiles p, json_each(p.profile_data, '$.memories') j
+                """)
+            except sqlite3.OperationalError as e:
+                # user_profiles 未作成、またはJSON1拡張なし
+                print(f"⚠️ プロファイル移行スキップ: {e}")
+        
+        self.conn.commit()
     
     def get_profile(self, user_id: str) -> Dict:
         """プロファイル取得"""
@@ -115,9 +440,35 @@ class ProfileManager:
         row = c.fetchone()
         
         if row:
-            return json.loads(row[0])
+            profile = _loads(row[0])
         else:
-            return self._create_default_profile()
+            profile = self._create_default_profile()
+        
+        c.execute(
+            "SELECT total_conversations, tone FROM profile_scalar WHERE user_id = ?",
+            (user_id,)
+        )
+        scalar = c.fetchone()
+        if scalar:
+            profile["total_conversations"], profile["tone"] = scalar
+        
+        # 同数の場合は先に出てきたトピックを優先（rowid順）
+        c.execute("""
+            SELECT topic, count FROM profile_topic_counts
+            WHERE user_id = ?
+            ORDER BY count DESC, rowid
+        """, (user_id,))
+        topic_counts = dict(c.fetchall())
+        profile["topic_counts"] = topic_counts
+        profile["interests"] = list(topic_counts)[:3]
+        
+        c.execute(
+            "SELECT memory FROM profile_memories WHERE user_id = ? ORDER BY seq",
+            (user_id,)
+        )
+        profile["memories"] = [r[0] for r in c.fetchall()]
+        
+        return profile
     
     def _create_default_profile(self) -> Dict:
         """デフォルトプロファイル"""
@@ -130,100 +481,116 @@ class ProfileManager:
             "total_conversations": 0
         }
     
-    def update_profile(self, user_id: str, analysis: Dict):
+    def update_profile(self, user_id: str, analysis: Dict, conversations: int = 1):
         """
         分析結果に基づいてプロファイルを更新
         
+        プロファイル全体を読み書きせず、変化した行だけを更新する
+        
         Args:
             user_id: ユーザーID
             analysis: 会話分析結果
+            conversations: analysis が何件分の会話をまとめて分析したものか
         """
-        profile = self.get_profile(user_id)
+        c = self.conn.cursor()
+        now = request_now().isoformat()
         
         # トピックカウントを更新
-        for topic in analysis.get("topics", []):
-            if topic:
-                profile["topic_counts"][topic] = profile["topic_counts"].get(topic, 0) + 1
-        
-        # 上位3つを interests に設定
-        if profile["topic_counts"]:
-            sorted_topics = sorted(
-                profile["topic_counts"].items(),
-                key=lambda x: x[1],
-                reverse=True
-            )
-            profile["interests"] = [t[0] for t in sorted_topics[:3]]
+        topics = [(user_id, topic) for topic in analysis.get("topics", []) if topic]
+        if topics:
+            c.executemany("""
+                INSERT INTO profile_topic_counts (user_id, topic, count)
+                VALUES (?, ?, 1)
+                ON CONFLICT(user_id, topic) DO UPDATE SET count = count + 1
+            """, topics)
         
-        # 重要な情報を memories に追加
+        # 重要な情報を memories に追加（重複はUNIQUE制約で無視）
         key_info = analysis.get("key_info", "").strip()
         if key_info and len(key_info) > 10:
-            # 重複チェック
-            if key_info not in profile["memories"]:
-                profile["memories"].append(key_info)
+            c.execute("""
+                INSERT OR IGNORE INTO profile_memories (user_id, seq, memory)
+                SELECT ?, COALESCE(MAX(seq), -1) + 1, ?
+                FROM profile_memories WHERE user_id = ?
+            """, (user_id, key_info, user_id))
+            
+            if c.rowcount > 0:
                 # 最新10件まで保持
-                profile["memories"] = profile["memories"][-10:]
+                c.execute("""
+                    DELETE FROM profile_memories
+                    WHERE user_id = ? AND seq <= (
+                        SELECT MAX(seq) FROM profile_memories WHERE user_id = ?
+                    ) - ?
+                """, (user_id, user_id, self.MAX_MEMORIES))
         
         # 会話数をインクリメント
-        profile["total_conversations"] = profile.get("total_conversations", 0) + 1
+        c.execute("""
+            INSERT INTO profile_scalar (user_id, total_conversations, updated_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                total_conversations = total_conversations + excluded.total_conversations,
+                version = version + 1,
+                updated_at = excluded.updated_at
+        """, (user_id, conversations, now))
         
-        # DBに保存
-        self._save_profile(user_id, profile)
+        self.conn.commit()
         
-        return profile
+        return self.get_profile(user_id)
     
     def _save_profile(self, user_id: str, profile: Dict):
-        """プロファイルをDBに保存"""
-        from datetime import datetime
-        
-        c = self.conn.cursor()
-        
-        # 既存チェック
-        c.execute(
-            "SELECT user_id FROM user_profiles WHERE user_id = ?",
-            (user_id,)
-        )
-        exists = c.fetchone()
+        """
+        プロファイルをDBに保存
         
-        profile_json = json.dumps(profile, ensure_ascii=False)
-        now = datetime.now().isoformat()
+        正規化テーブルで管理していない項目（preferences など）の保存用
+        """
+        profile_json = _dumps(profile)
+        now = request_now().isoformat()
         
-        if exists:
-            c.execute("""
-                UPDATE user_profiles
-                SET profile_data = ?, updated_at = ?
-                WHERE user_id = ?
-            """, (profile_json, now, user_id))
-        else:
-            c.execute("""
-                INSERT INTO user_profiles (user_id, profile_data, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, profile_json, now, now))
+        self.conn.execute("""
+            INSERT INTO user_profiles (user_id, profile_data, created_at, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                profile_data = excluded.profile_data,
+                updated_at = excluded.updated_at
+        """, (user_id, profile_json, now, now))
         
         self.conn.commit()
     
     def get_personalized_system_prompt(self, user_id: str) -> str:
         """パーソナライズされたシステムプロンプトを生成"""
+        c = self.conn.cursor()
+        
+        # プロファイルが更新されていなければ前回のプロンプトを返す
+        c.execute("""
+            SELECT
+                (SELECT version FROM profile_scalar WHERE user_id = ?),
+                (SELECT updated_at FROM user_profiles WHERE user_id = ?)
+        """, (user_id, user_id))
+        version = c.fetchone()
+        cached = _prompt_cache.get((self._db_key, user_id))
+        if cached and cached[0] == version:
+            return cached[1]
+        
         profile = self.get_profile(user_id)
         
-        prompt = "あなたは親しみやすく、有能なAIアシスタントです。\n"
+        parts = ["あなたは親しみやすく、有能なAIアシスタントです。\n"]
         
         # 興味・関心を追加
         if profile.get("interests"):
-            interests = ", ".join(profile["interests"])
-            prompt += f"\nユーザーは以下のトピックに興味があります: {interests}\n"
+            interests = ", ".join(sorted(profile["interests"]))  # 順位の入れ替わりで変えない
+            parts.append(f"\nユーザーは以下のトピックに興味があります: {interests}\n")
         
         # 学習した記憶を追加
         if profile.get("memories"):
-            prompt += "\nユーザーについて学習した情報:\n"
-            for mem in profile["memories"][-3:]:  # 最新3件
-                prompt += f"- {mem}\n"
+            parts.append("\nユーザーについて学習した情報:\n")
+            parts.extend(f"- {mem}\n" for mem in profile["memories"][-3:])  # 最新3件
         
         # 好みを追加
         if profile.get("preferences"):
-            prompt += "\nユーザーの好み:\n"
-            for pref in profile["preferences"]:
-                prompt += f"- {pref}\n"
+            parts.append("\nユーザーの好み:\n")
+            parts.extend(f"- {pref}\n" for pref in profile["preferences"])
         
+        prompt = "".join(parts)
+        _prompt_cache[(self._db_key, user_id)] = (version, prompt)
         return prompt
     
 class EmotionDetector:
@@ -237,20 +604,7 @@ class EmotionDetector:
         - 会話の文脈から推測される心理状態
         """
         
-        prompt = f"""以下のユーザーメッセージと会話履歴から、ユーザーの感情と心理状態を分析してください。
-
-現在のメッセージ: {user_message}
-
-最近の会話履歴:
-{self._format_history(conversation_history)}
-
-以下のJSON形式で返してください:
-{{
-  "primary_emotion": "happy/sad/anxious/excited/tired/frustrated/curious/neutral",
-  "emotion_intensity": 1-10,
-  "underlying_needs": ["承認", "サポート", "情報", "共感"],
-  "preferred_response_style": "励まし/具体的アドバイス/共感/簡潔な回答",
-  "energy_level": "high/medium/low",
-  "conversation_goal": "雑談/問題解決/学習/愚痴"
-}}
-"""
\ No newline at end of file
+        prompt = _EMOTION_PROMPT.format(
+            user_message=user_message,
+            history=self._format_history(conversation_history)
+        )
\ No newline at end of file
@@ -3,10 +3,49 @@ assistant_brain.py
 AIアシスタントの「脳」- 判断・提案・サポート
 """
 
-import ollama
+import re
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
-import json
+
+from _ollama_pool import async_client, client
+from request_context import request_now
+from analyzer import _chat_json_object, _chat_json_object_sync, _loads
+
+
+# ストレス検出用キーワード（0: ストレス, 1: ポジティブ）
+_STRESS_KEYWORDS = {
+    "疲れた": 0, "無理": 0, "間に合わない": 0, "やばい": 0, "焦る": 0,
+    "できた": 1, "うまくいった": 1, "楽しい": 1, "良かった": 1,
+}
+
+# 先読みで全位置を1回だけ走査し、両カテゴリのキーワードをまとめて拾う
+_STRESS_PATTERN = re.compile(
+    "(?=(" + "|".join(
+        re.escape(kw) for kw in sorted(_STRESS_KEYWORDS, key=len, reverse=True)
+    ) + "))"
+)
+
+
+# 意図理解プロンプト（固定部分はモジュール読み込み時に一度だけ用意）
+_INTENT_PROMPT = """以下のユーザーメッセージの意図を分析してください。
+
+メッセージ: {user_message}
+
+コンテキスト:
+- 現在時刻: {now}
+- 未完了タスク数: {pending_tasks}
+- 今日の予定数: {today_schedules}
+
+以下のJSON形式で返してください（JSONのみ）:
+{{
+  "intent": "question/request/chat/task_check/schedule_inquiry",
+  "requires_action": true/false,
+  "action_type": "create_task/create_schedule/start_work_session/provide_info/none",
+  "urgency": "high/medium/low",
+  "emotional_tone": "stressed/excited/neutral/confused",
+  "keywords": ["キーワード1", "キーワード2"]
+}}
+"""
 
 
 class AssistantBrain:
@@ -15,6 +54,20 @@ class AssistantBrain:
     def __init__(self, schedule_manager, model: str = "qwen2.5:7b"):
         self.schedule_mgr = schedule_manager
         self.model = model
+        self._client = async_client
+        # user_id -> ((日付, スケジュールのデータバージョン), 今日の計画)
+        self._plan_cache: Dict[str, tuple] = {}
+    
+    def _get_daily_plan(self, user_id: str) -> Dict:
+        """今日の計画を取得（同じ日で予定・タスクに変更がなければ前回の結果を使う）"""
+        key = (request_now().date(), self.schedule_mgr.data_version)
+        cached = self._plan_cache.get(user_id)
+        if cached and cached[0] == key:
+            return cached[1]
+        
+        daily_plan = self.schedule_mgr.suggest_daily_plan(user_id)
+        self._plan_cache[user_id] = (key, daily_plan)
+        return daily_plan
     
     # ==================== 会話理解 ====================
     
@@ -25,57 +78,63 @@ class AssistantBrain:
         - 何をサポートすべきか
         """
         
-        prompt = f"""以下のユーザーメッセージの意図を分析してください。
-
-メッセージ: {user_message}
-
-コンテキスト:
-- 現在時刻: {datetime.now().strftime('%Y-%m-%d %H:%M')}
-- 未完了タスク数: {context.get('pending_tasks_count', 0)}
-- 今日の予定数: {context.get('today_schedules_count', 0)}
-
-以下のJSON形式で返してください（JSONのみ）:
-{{
-  "intent": "question/request/chat/task_check/schedule_inquiry",
-  "requires_action": true/false,
-  "action_type": "create_task/create_schedule/start_work_session/provide_info/none",
-  "urgency": "high/medium/low",
-  "emotional_tone": "stressed/excited/neutral/confused",
-  "keywords": ["キーワード1", "キーワード2"]
-}}
-"""
+        prompt = self._intent_prompt(user_message, context)
         
         try:
-            response = ollama.chat(
+            json_str = _chat_json_object_sync(
+                client,
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 options={"temperature": 0.3}
             )
+            if json_str:
+                return _loads(json_str)
             
-            content = response['message']['content']
-            
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
+        except Exception as e:
+            print(f"⚠️ 意図理解エラー: {e}")
+        
+        return {"intent": "chat", "requires_action": False}
+    
+    async def aunderstand_intent(self, user_message: str, context: Dict) -> Dict:
+        """understand_intent の非同期版（他のLLM呼び出しと並行できる）"""
+        
+        prompt = self._intent_prompt(user_message, context)
+        
+        try:
+            json_str = await _chat_json_object(
+                self._client,
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                options={"temperature": 0.3}
+            )
+            if json_str:
+                return _loads(json_str)
             
         except Exception as e:
             print(f"⚠️ 意図理解エラー: {e}")
         
         return {"intent": "chat", "requires_action": False}
     
+    def _intent_prompt(self, user_message: str, context: Dict) -> str:
+        """意図理解プロンプト"""
+        return _INTENT_PROMPT.format(
+            user_message=user_message,
+            now=request_now().strftime('%Y-%m-%d %H:%M'),
+            pending_tasks=context.get('pending_tasks_count', 0),
+            today_schedules=context.get('today_schedules_count', 0)
+        )
+    
     def detect_stress_level(self, user_message: str, recent_history: List[Dict]) -> Dict:
         """
         ストレスレベルを検出
         - 焦り、疲労、不安などのシグナル
         """
         
-        # メッセージから感情シグナル検出
-        stress_keywords = ["疲れた", "無理", "間に合わない", "やばい", "焦る"]
-        positive_keywords = ["できた", "うまくいった", "楽しい", "良かった"]
-        
-        stress_score = sum(1 for kw in stress_keywords if kw in user_message)
-        positive_score = sum(1 for kw in positive_keywords if kw in user_message)
+        # メッセージから感情シグナル検出（各キーワードは出現有無で1点）
+        scores = [0, 0]
+        for kw in set(_STRESS_PATTERN.findall(user_message)):
+            scores[_STRESS_KEYWORDS[kw]] += 1
+        stress_score, positive_score = scores
         
         # 最近の会話パターン
         recent_short_messages = sum(
@@ -144,15 +203,13 @@ class AssistantBrain:
         - 優先順位
         """
         
-        # 今日の計画取得
-        daily_plan = self.schedule_mgr.suggest_daily_plan(user_id)
-        
-        now = datetime.now()
+        now = request_now()
         hour = now.hour
         
-        # 時間帯による提案
+        # 時間帯による提案（計画が必要な時間帯だけ取得する）
         if hour < 10:
             # 午前: 難しいタスクを提案
+            daily_plan = self._get_daily_plan(user_id)
             if daily_plan["urgent_tasks"]:
                 task = daily_plan["urgent_tasks"][0]
                 return f"""おはようございます！今日は頭が冴えている時間ですね。
@@ -162,6 +219,7 @@ class AssistantBrain:
             
         elif hour < 15:
             # 昼: 適度なタスク
+            daily_plan = self._get_daily_plan(user_id)
             if daily_plan["schedules"]:
                 next_schedule = daily_plan["schedules"][0]
                 return f"""次の予定「{next_schedule['title']}」まで時間があります。
@@ -207,10 +265,11 @@ class AssistantBrain:
         warnings = []
         suggestions = []
         
+        new_time = datetime.fromisoformat(start_time)
+        
         for schedule in nearby_schedules:
             # 時間の近さをチェック
             schedule_time = datetime.fromisoformat(schedule["start_time"])
-            new_time = datetime.fromisoformat(start_time)
             
             time_diff = abs((schedule_time - new_time).total_seconds() / 60)
             
@@ -243,24 +302,27 @@ class AssistantBrain:
         # 簡易実装: 空き時間を検出
         suggestions = []
         
+        # 予定のある日付を一度だけ求める
+        busy_dates = {
+            datetime.fromisoformat(s["start_time"]).date() for s in schedules
+        }
+        today = request_now().date()
+        
         for day_offset in range(days_ahead):
-            target_date = datetime.now().date() + timedelta(days=day_offset)
+            target_date = today + timedelta(days=day_offset)
             
             # その日の予定を確認
-            day_schedules = [
-                s for s in schedules
-                if datetime.fromisoformat(s["start_time"]).date() == target_date
-            ]
-            
-            if not day_schedules:
+            if target_date not in busy_dates:
                 # 予定がない日 - 午前を提案
                 suggestions.append({
                     "date": target_date.isoformat(),
                     "time": "10:00",
                     "reason": "予定のない日です。午前中の集中時間がおすすめ"
                 })
+                if len(suggestions) == 3:
+                    break
         
-        return suggestions[:3]
+        return suggestions
     
     # ==================== モチベーション管理 ====================
     
@@ -321,13 +383,12 @@ class AssistantBrain:
         リマインダーを送るべきか判断
         """
         
-        # 今後1時間以内の予定
-        schedules = self.schedule_mgr.get_upcoming_schedules(user_id, days=1)
-        now = datetime.now()
+        # 15分以内に始まる予定
+        schedule = self.schedule_mgr.get_next_schedule_within(user_id, minutes=15)
         
-        for schedule in schedules:
+        if schedule:
             start_time = datetime.fromisoformat(schedule["start_time"])
-            time_until = (start_time - now).total_seconds() / 60
+            time_until = (start_time - request_now()).total_seconds() / 60
             
             if 0 < time_until <= 15:
                 return {
@@ -338,19 +399,14 @@ class AssistantBrain:
                 }
         
         # 期限が迫っているタスク
-        tasks = self.schedule_mgr.get_pending_tasks(user_id)
-        
-        for task in tasks:
-            if task.get("due_date"):
-                due = datetime.fromisoformat(task["due_date"])
-                days_until = (due.date() - now.date()).days
-                
-                if days_until == 0 and task["status"] == "pending":
-                    return {
-                        "type": "task_deadline",
-                        "task": task,
-                        "message": f"「{task['title']}」の期限は今日です。取り組みましょうか？"
-                    }
+        task = self.schedule_mgr.get_task_due_today(user_id)
+        
+        if task:
+            return {
+                "type": "task_deadline",
+                "task": task,
+                "message": f"「{task['title']}」の期限は今日です。取り組みましょうか？"
+            }
         
         return None
     
@@ -359,30 +415,29 @@ class AssistantBrain:
         朝の定例ブリーフィング
         """
         
-        daily_plan = self.schedule_mgr.suggest_daily_plan(user_id)
+        daily_plan = self._get_daily_plan(user_id)
         stats = self.schedule_mgr.get_work_statistics(user_id, days=7)
         
-        briefing = f"""おはようございます！今日のブリーフィングです。
+        parts = [f"""おはようございます！今日のブリーフィングです。
 
 📅 今日の予定: {len(daily_plan['schedules'])}件
-"""
+"""]
         
         if daily_plan['schedules']:
             for i, s in enumerate(daily_plan['schedules'][:3], 1):
                 start = datetime.fromisoformat(s['start_time']).strftime('%H:%M')
-                briefing += f"{i}. {start} - {s['title']}\n"
+                parts.append(f"{i}. {start} - {s['title']}\n")
         
-        briefing += f"\n✅ 優先タスク: {len(daily_plan['urgent_tasks'])}件\n"
+        parts.append(f"\n✅ 優先タスク: {len(daily_plan['urgent_tasks'])}件\n")
         
         if daily_plan['urgent_tasks']:
-            for task in daily_plan['urgent_tasks'][:2]:
-                briefing += f"・{task['title']}\n"
+            parts.extend(f"・{task['title']}\n" for task in daily_plan['urgent_tasks'][:2])
         
-        briefing += f"\n📊 今週の作業時間: {stats['total_work_hours']}時間\n"
+        parts.append(f"\n📊 今週の作業時間: {stats['total_work_hours']}時間\n")
         
-        briefing += f"\n{daily_plan['recommendation']}"
+        parts.append(f"\n{daily_plan['recommendation']}")
         
-        return briefing
+        return "".join(parts)
 
 
 # ==================== 使用例 ====================
@@ -5,11 +5,253 @@ OllamaのModelfileを使ったパーソナライズモデル作成
 """
 
 import os
-import json
+import re
+import atexit
+import heapq
 import sqlite3
-from typing import List, Dict, Optional
+import subprocess
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import ollama
+from pathlib import Path
+from time import monotonic
+from typing import List, Dict, Optional, Tuple
+
+from _ollama_pool import client
+from request_context import request_now
+from analyzer import ProfileManager, _loads
+
+
+# ==================== SQL ====================
+# 同一の文字列を使い回し、sqlite3 の文キャッシュに乗せる
+
+_SQL_CREATE_CUSTOM_MODELS = """
+    CREATE TABLE IF NOT EXISTS custom_models (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        model_name TEXT NOT NULL,
+        base_model TEXT NOT NULL,
+        training_size INTEGER,
+        created_at TEXT NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        UNIQUE(user_id, model_name)
+    )
+"""
+
+# メタデータ全体ではなく tags 配列だけを取り出す（空・不正なJSONはNULL）
+_SQL_TRAINING_DATA = """
+    SELECT user_message, ai_response, rating,
+           CASE WHEN json_valid(metadata) AND json_type(metadata, '$.tags') = 'array'
+                THEN json_extract(metadata, '$.tags') END,
+           length(ai_response)
+    FROM conversations
+    WHERE user_id = ? AND (rating >= 3 OR rating IS NULL)
+    ORDER BY timestamp DESC
+    LIMIT 100
+"""
+
+# 代表例の選択をSQL側で採点する（collect_training_data と同じ直近100件が対象。
+# 同点は新しい順で、Python版の安定な上位n件と同じ並びになる）
+_SQL_REPRESENTATIVE_EXAMPLES = """
+    WITH recent AS (
+        SELECT user_message, ai_response, rating, timestamp,
+               CASE WHEN json_valid(metadata) AND json_type(metadata, '$.tags') = 'array'
+                    THEN json_extract(metadata, '$.tags') END AS tags
+        FROM conversations
+        WHERE user_id = ? AND (rating >= 3 OR rating IS NULL)
+        ORDER BY timestamp DESC
+        LIMIT 100
+    )
+    SELECT user_message, ai_response, rating, tags, length(ai_response)
+    FROM recent
+    ORDER BY
+        CASE rating WHEN 5 THEN 3 WHEN 4 THEN 2 WHEN 3 THEN 1 ELSE 0 END
+        + CASE
+            WHEN length(ai_response) BETWEEN 101 AND 499 THEN 2
+            WHEN length(ai_response) BETWEEN 51 AND 100
+              OR length(ai_response) BETWEEN 500 AND 799 THEN 1
+            ELSE 0
+          END
+        + CASE WHEN json_array_length(tags) > 0 THEN 1 ELSE 0 END
+        + CASE WHEN instr(user_message, '?') OR instr(user_message, '？') THEN 1 ELSE 0 END
+        DESC,
+        timestamp DESC
+    LIMIT ?
+"""
+
+# 学習対象（collect_training_data と同じ直近100件）の件数と応答の平均文字数
+_SQL_TRAINING_STATS = """
+    SELECT COUNT(*), AVG(length(ai_response))
+    FROM (
+        SELECT ai_response
+        FROM conversations
+        WHERE user_id = ? AND (rating >= 3 OR rating IS NULL)
+        ORDER BY timestamp DESC
+        LIMIT 100
+    )
+"""
+
+# よく話すトピック（タグ）の集計（collect_training_data と同じ直近100件が対象。
+# 同数のタグは最初に出現した順に並べ、Python側での出現順集計と同じ結果にする）
+_SQL_TOP_TAGS = """
+    WITH recent AS (
+        SELECT metadata, ROW_NUMBER() OVER (ORDER BY timestamp DESC) AS rn
+        FROM conversations
+        WHERE user_id = ? AND (rating >= 3 OR rating IS NULL)
+        ORDER BY timestamp DESC
+        LIMIT 100
+    )
+    SELECT je.value, COUNT(*) AS cnt
+    FROM recent,
+         json_each(
+             CASE WHEN json_valid(recent.metadata)
+                       AND json_type(recent.metadata, '$.tags') = 'array'
+                  THEN json_extract(recent.metadata, '$.tags')
+                  ELSE '[]' END
+         ) AS je
+    GROUP BY je.value
+    ORDER BY cnt DESC, MIN(recent.rn * 1000000 + je.key)
+    LIMIT ?
+"""
+
+# conversations の索引
+# - 新しい順の取得用（ConversationInitiator と同じ定義。DESC も逆順走査で賄える）
+# - 評価による件数集計用
+_SQL_CREATE_CONVERSATIONS_INDEXES = (
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_user_ts
+    ON conversations(user_id, timestamp)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_user_rating
+    ON conversations(user_id, rating)
+    """,
+)
+
+# アクティブモデル取得・モデル一覧用
+_SQL_CREATE_CUSTOM_MODELS_INDEX = """
+    CREATE INDEX IF NOT EXISTS idx_custom_models_user_active
+    ON custom_models(user_id, is_active, created_at DESC)
+"""
+
+_SQL_DEACTIVATE_MODELS = """
+    UPDATE custom_models
+    SET is_active = 0
+    WHERE user_id = ? AND is_active = 1
+"""
+
+_SQL_INSERT_MODEL = """
+    INSERT INTO custom_models
+    (user_id, model_name, base_model, training_size, created_at, is_active)
+    VALUES (?, ?, ?, ?, ?, 1)
+    ON CONFLICT(user_id, model_name) DO UPDATE SET
+        base_model = excluded.base_model,
+        training_size = excluded.training_size,
+        created_at = excluded.created_at,
+        is_active = 1
+"""
+
+_SQL_ACTIVE_MODEL = """
+    SELECT model_name
+    FROM custom_models
+    WHERE user_id = ? AND is_active = 1
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+_SQL_LIST_MODELS = """
+    SELECT model_name, base_model, training_size, created_at, is_active
+    FROM custom_models
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+"""
+
+_SQL_DELETE_MODEL = """
+    DELETE FROM custom_models
+    WHERE user_id = ? AND model_name = ?
+"""
+
+# 準備状況の件数を1回の走査で集計（使用可能数は学習データ取得の上限100件に揃える）
+_SQL_READINESS_COUNTS = """
+    SELECT COUNT(*),
+           COUNT(CASE WHEN rating >= 3 THEN 1 END),
+           MIN(100, COUNT(CASE WHEN rating >= 3 OR rating IS NULL THEN 1 END))
+    FROM conversations
+    WHERE user_id = ?
+"""
+
+
+# インストール済みモデル一覧のキャッシュ有効期間（秒）
+_MODELS_CACHE_TTL = 30
+
+# ユーザー単位（プロファイル概要・アクティブモデル）のキャッシュ有効期間（秒）
+_USER_CACHE_TTL = 30
+
+# ollama create のタイムアウト（秒）とエラー時に残す出力の行数
+_OLLAMA_CREATE_TIMEOUT = 300
+_OLLAMA_CREATE_TAIL_LINES = 20
+
+# システムプロンプト末尾の応答の指針
+_RESPONSE_GUIDELINES = """
+【応答の指針】
+- 上記の会話例のトーンとスタイルを参考にする
+- ユーザーの興味や好みを常に考慮する
+- 学習した情報を自然に活用する
+- 簡潔さと詳しさのバランスを保つ
+- 必要に応じて具体例や説明を追加する
+"""
+
+# 評価ごとの代表例スコア
+_RATING_SCORES = {5: 3, 4: 2, 3: 1}
+
+# 代表例の応答の長さ（文字数）の区分（_SQL_REPRESENTATIVE_EXAMPLES と同じ境界）
+# 最適: 100 < 長さ < 500（+2）、許容: 50 < 長さ <= 100 または 500 <= 長さ < 800（+1）
+_LEN_SWEET_LO, _LEN_SWEET_HI = 100, 500
+_LEN_OK_LO_1, _LEN_OK_HI_1 = 50, 100
+_LEN_OK_LO_2, _LEN_OK_HI_2 = 500, 800
+
+# 平均応答長による好みの応答スタイルの境界
+_AVG_LEN_DETAILED = 300
+_AVG_LEN_CONCISE = 150
+
+
+# MESSAGE 用のエスケープ（三重引用符 → エスケープ、改行 → 空白）を1回の走査で行う
+_MODELFILE_ESCAPE = re.compile(r'"""|\n')
+_MODELFILE_ESCAPE_MAP = {'"""': r'\"\"\"', '\n': ' '}
+
+
+def _escape_message(text: str) -> str:
+    """Modelfile の MESSAGE 用に三重引用符をエスケープし、改行を空白にする"""
+    return _MODELFILE_ESCAPE.sub(lambda m: _MODELFILE_ESCAPE_MAP[m.group()], text)
+
+
+# 学習データ1件（length は応答の文字数。SQL側で計算済み）
+TrainingExample = namedtuple(
+    "TrainingExample", "user assistant rating tags length"
+)
+
+
+def _truncate(text: str, limit: int) -> str:
+    """limit 文字を超える場合だけ切り詰めて "..." を付ける"""
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+def _rows_to_training_data(rows, load_metadata: bool = True) -> List[TrainingExample]:
+    """(user_message, ai_response, rating, tags_json, length) の行を学習データに変換"""
+    training_data = []
+    for user_msg, ai_msg, rating, tags_json, length in rows:
+        # タグが必要で、かつタグがある行だけJSONを解析
+        if load_metadata and tags_json and tags_json != "[]":
+            tags = _loads(tags_json)
+        else:
+            tags = []
+
+        training_data.append(
+            TrainingExample(user_msg, ai_msg, rating, tags, length)
+        )
+
+    return training_data
 
 
 class FineTuningSystem:
@@ -20,233 +262,285 @@ class FineTuningSystem:
         self.min_conversations = min_conversations
         self.modelfiles_dir = "./modelfiles"
         os.makedirs(self.modelfiles_dir, exist_ok=True)
+        
+        # 長期間保持する単一接続（自動コミット。複数文の書き込みはロック内で明示的にトランザクション化）
+        self.conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._lock = threading.RLock()
+        # (取得時刻, モデル一覧)
+        self._models_cache = None
+        # user_id -> (取得時刻, 値)
+        self._profile_cache = {}
+        self._active_model_cache = {}
         self._init_db()
+        self.profile_manager = ProfileManager(self.conn)
+        # プロセス終了時にWALをチェックポイントして閉じる
+        atexit.register(self.close)
     
     def _init_db(self):
         """データベース初期化"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        c = self.conn.cursor()
+        
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("PRAGMA mmap_size=268435456")
+        c.execute("PRAGMA cache_size=-65536")
+        c.execute("PRAGMA busy_timeout=5000")
         
         # カスタムモデルテーブル
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS custom_models (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                model_name TEXT NOT NULL,
-                base_model TEXT NOT NULL,
-                training_size INTEGER,
-                created_at TEXT NOT NULL,
-                is_active INTEGER DEFAULT 1,
-                UNIQUE(user_id, model_name)
-            )
-        """)
+        c.execute(_SQL_CREATE_CUSTOM_MODELS)
+        c.execute(_SQL_CREATE_CUSTOM_MODELS_INDEX)
         
-        conn.commit()
-        conn.close()
+        try:
+            for sql in _SQL_CREATE_CONVERSATIONS_INDEXES:
+                c.execute(sql)
+        except sqlite3.OperationalError:
+            pass  # conversations テーブル未作成
     
-    def collect_training_data(self, user_id: str) -> List[Dict[str, str]]:
+    def close(self):
+        """接続を閉じる"""
+        self.conn.close()
+    
+    def list_available_models(self) -> List[Dict]:
+        """
+        Ollamaにインストール済みのモデル一覧
+        
+        画面更新のたびにデーモンへ問い合わせないよう、短時間キャッシュする
+        """
+        cached = self._models_cache
+        if cached is not None and monotonic() - cached[0] < _MODELS_CACHE_TTL:
+            return cached[1]
+        
+        result = client.list()
+        
+        models = []
+        for m in getattr(result, 'models', None) or []:
+            size = getattr(m, 'size', 0) or 0
+            details = getattr(m, 'details', None)
+            models.append({
+                "name": getattr(m, 'model', None) or str(m),
+                "size": size,
+                "size_gb": round(size / (1024**3), 1),
+                "parameter_size": getattr(details, 'parameter_size', '') if details else '',
+                "quantization": getattr(details, 'quantization_level', '') if details else ''
+            })
+        
+        self._models_cache = (monotonic(), models)
+        return models
+    
+    def invalidate_models_cache(self):
+        """モデル一覧のキャッシュを破棄（作成・削除後に呼ぶ）"""
+        self._models_cache = None
+    
+    def collect_training_data(
+        self,
+        user_id: str,
+        load_metadata: bool = True
+    ) -> List[TrainingExample]:
         """
         ユーザーの会話履歴を収集
         
         評価が高い（3以上）または未評価の会話を使用
         
+        Args:
+            user_id: ユーザーID
+            load_metadata: Falseの場合はタグのJSONを解析しない（tagsは空リスト）
+        
         Returns:
-            [{"user": "...", "assistant": "...", "rating": ..., "tags": [...]}, ...]
+            [TrainingExample(user, assistant, rating, tags, length), ...]
         """
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        c = self.conn.cursor()
         
         # 高評価または未評価の会話を取得
-        c.execute("""
-            SELECT user_message, ai_response, rating, metadata
-            FROM conversations
-            WHERE user_id = ? AND (rating >= 3 OR rating IS NULL)
-            ORDER BY timestamp DESC
-            LIMIT 100
-        """, (user_id,))
-        
-        rows = c.fetchall()
-        conn.close()
-        
-        training_data = []
-        for row in rows:
-            user_msg, ai_msg, rating, metadata_json = row
-            
-            # メタデータから追加情報を取得
-            metadata = json.loads(metadata_json) if metadata_json else {}
-            
-            training_data.append({
-                "user": user_msg,
-                "assistant": ai_msg,
-                "rating": rating,
-                "tags": metadata.get("tags", [])
-            })
+        c.execute(_SQL_TRAINING_DATA, (user_id,))
         
-        return training_data
+        return _rows_to_training_data(c.fetchall(), load_metadata)
+    
+    def _training_stats(self, user_id: str) -> Tuple[int, Optional[float]]:
+        """学習対象の会話の (件数, 応答の平均文字数) をSQLで集計（会話がなければ平均はNone）"""
+        c = self.conn.cursor()
+        c.execute(_SQL_TRAINING_STATS, (user_id,))
+        return c.fetchone()
+    
+    def _top_tags(self, user_id: str, n: int = 5) -> List[Tuple[str, int]]:
+        """学習対象の会話で多いタグ上位n件を [(タグ, 件数), ...] で返す"""
+        c = self.conn.cursor()
+        c.execute(_SQL_TOP_TAGS, (user_id, n))
+        return c.fetchall()
     
     def get_user_profile_summary(self, user_id: str) -> Dict:
-        """ユーザープロファイルを取得"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute("""
-            SELECT profile_data
-            FROM user_profiles
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        row = c.fetchone()
-        conn.close()
+        """
+        ユーザープロファイルを取得
         
-        if not row:
-            return {}
+        プロファイルは会話処理側で更新されるため、短時間だけキャッシュする
+        """
+        cached = self._profile_cache.get(user_id)
+        if cached is not None and monotonic() - cached[0] < _USER_CACHE_TTL:
+            return cached[1]
         
-        return json.loads(row[0])
+        profile = self.profile_manager.get_profile(user_id)
+        self._profile_cache[user_id] = (monotonic(), profile)
+        return profile
     
     def _build_personalized_system_prompt(
         self,
         user_id: str,
         profile: Dict,
-        training_data: List[Dict]
+        training_data: Optional[List[TrainingExample]],
+        examples: Optional[List[TrainingExample]] = None,
+        avg_length: Optional[float] = None
     ) -> str:
-        """パーソナライズされたシステムプロンプトを構築"""
+        """
+        パーソナライズされたシステムプロンプトを構築
+        
+        examples に選択済みの代表例（上位5件）を渡すと、再選択しない。
+        avg_length に集計済みの応答の平均文字数を渡すと、training_data から求めない
+        （training_data を読み込まない場合は examples と avg_length を渡す）
+        """
         
-        prompt = f"あなたは{user_id}さん専用にカスタマイズされたAIアシスタントです。\n\n"
+        parts = [f"あなたは{user_id}さん専用にカスタマイズされたAIアシスタントです。\n\n"]
         
         # ユーザープロファイル情報
-        prompt += "【ユーザープロファイル】\n"
+        parts.append("【ユーザープロファイル】\n")
         
         # 興味・関心
         if profile.get("interests"):
             interests = ", ".join(profile["interests"][:5])
-            prompt += f"主な興味: {interests}\n"
+            parts.append(f"主な興味: {interests}\n")
         
         # 好みのトーン
         if profile.get("preferred_tone"):
-            prompt += f"好みのトーン: {profile['preferred_tone']}\n"
+            parts.append(f"好みのトーン: {profile['preferred_tone']}\n")
         
-        # よく話すトピック（タグから分析）
-        tag_counts = {}
-        for data in training_data:
-            for tag in data.get("tags", []):
-                tag_counts[tag] = tag_counts.get(tag, 0) + 1
+        # よく話すトピック（タグから分析。集計はSQLiteの json_each で行う）
+        top_tags = self._top_tags(user_id, n=5)
         
-        if tag_counts:
-            top_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)[:5]
+        if top_tags:
             tags_str = ", ".join([tag for tag, _ in top_tags])
-            prompt += f"よく話すトピック: {tags_str}\n"
+            parts.append(f"よく話すトピック: {tags_str}\n")
         
         # 応答スタイルの分析
-        if training_data:
-            avg_length = sum(len(d["assistant"]) for d in training_data) / len(training_data)
-            
-            if avg_length > 300:
-                prompt += "好みの応答スタイル: 詳細で丁寧な説明\n"
-            elif avg_length < 150:
-                prompt += "好みの応答スタイル: 簡潔で要点を押さえた説明\n"
+        if avg_length is None and training_data:
+            avg_length = sum(d.length for d in training_data) / len(training_data)
+        
+        if avg_length is not None:
+            if avg_length > _AVG_LEN_DETAILED:
+                parts.append("好みの応答スタイル: 詳細で丁寧な説明\n")
+            elif avg_length < _AVG_LEN_CONCISE:
+                parts.append("好みの応答スタイル: 簡潔で要点を押さえた説明\n")
             else:
-                prompt += "好みの応答スタイル: バランスの取れた適度な長さ\n"
+                parts.append("好みの応答スタイル: バランスの取れた適度な長さ\n")
         
         # 学習した記憶
         if profile.get("memories"):
-            prompt += "\n学習した重要な情報:\n"
-            for mem in profile["memories"][-5:]:
-                prompt += f"- {mem}\n"
+            parts.append("\n学習した重要な情報:\n")
+            parts.extend(f"- {mem}\n" for mem in profile["memories"][-5:])
         
         # 会話例の追加
-        prompt += "\n\n【高評価だった会話例】\n"
-        prompt += "以下のような会話スタイルを参考にしてください:\n\n"
+        parts.append("\n\n【高評価だった会話例】\n")
+        parts.append("以下のような会話スタイルを参考にしてください:\n\n")
         
         # 代表的な会話例を選択
-        examples = self._select_representative_examples(training_data, n=5)
-        for i, ex in enumerate(examples, 1):
-            prompt += f"例{i}:\n"
-            prompt += f"ユーザー: {ex['user'][:100]}{'...' if len(ex['user']) > 100 else ''}\n"
-            prompt += f"あなた: {ex['assistant'][:150]}{'...' if len(ex['assistant']) > 150 else ''}\n\n"
+        if examples is None:
+            examples = self._select_representative_examples(training_data, n=5)
+        for i, ex in enumerate(examples[:5], 1):
+            parts.append(f"例{i}:\n")
+            parts.append(f"ユーザー: {_truncate(ex.user, 100)}\n")
+            parts.append(f"あなた: {_truncate(ex.assistant, 150)}\n\n")
         
         # 応答の指針
-        prompt += """
-【応答の指針】
-- 上記の会話例のトーンとスタイルを参考にする
-- ユーザーの興味や好みを常に考慮する
-- 学習した情報を自然に活用する
-- 簡潔さと詳しさのバランスを保つ
-- 必要に応じて具体例や説明を追加する
-"""
+        parts.append(_RESPONSE_GUIDELINES)
         
-        return prompt
+        return "".join(parts)
     
     def _select_representative_examples(
         self,
-        training_data: List[Dict],
-        n: int = 5
-    ) -> List[Dict]:
-        """代表的な会話例を選択（Few-shot learning用）"""
+        training_data: Optional[List[TrainingExample]],
+        n: int = 5,
+        user_id: Optional[str] = None
+    ) -> List[TrainingExample]:
+        """
+        代表的な会話例を選択（Few-shot learning用）
+        
+        training_data が未取得（None）で user_id がある場合は、
+        採点と上位n件の抽出をSQLで行い、全件を読み込まない
+        """
+        
+        if training_data is None:
+            c = self.conn.cursor()
+            c.execute(_SQL_REPRESENTATIVE_EXAMPLES, (user_id, n))
+            return _rows_to_training_data(c.fetchall())
         
         # 評価が高く、長さが適度な会話を選択
-        scored = []
-        for data in training_data:
-            score = 0
-            
+        def score(data: TrainingExample) -> int:
             # 評価が高い
-            rating = data.get("rating")
-            if rating == 5:
-                score += 3
-            elif rating == 4:
-                score += 2
-            elif rating == 3:
-                score += 1
+            value = _RATING_SCORES.get(data.rating, 0)
             
             # 適度な長さ（100〜500文字）
-            length = len(data["assistant"])
-            if 100 < length < 500:
-                score += 2
-            elif 50 < length <= 100 or 500 <= length < 800:
-                score += 1
+            length = data.length
+            if _LEN_SWEET_LO < length < _LEN_SWEET_HI:
+                value += 2
+            elif (_LEN_OK_LO_1 < length <= _LEN_OK_HI_1
+                  or _LEN_OK_LO_2 <= length < _LEN_OK_HI_2):
+                value += 1
             
             # タグが付いている
-            if data.get("tags"):
-                score += 1
+            if data.tags:
+                value += 1
             
             # 質問形式の会話を優先
-            if "?" in data["user"] or "？" in data["user"]:
-                score += 1
+            user_text = data.user
+            if "?" in user_text or "？" in user_text:
+                value += 1
             
-            scored.append((score, data))
-        
-        # スコアの高い順にソート
-        scored.sort(key=lambda x: x[0], reverse=True)
+            return value
         
-        return [data for _, data in scored[:n]]
+        # 上位n件だけを取り出す（同点は元の順序を維持。全件ソートは不要）
+        return heapq.nlargest(n, training_data, key=score)
     
     def create_modelfile(
         self,
         user_id: str,
         base_model: str = "qwen2.5:32b",
-        training_data: Optional[List[Dict]] = None
-    ) -> str:
+        training_data: Optional[List[TrainingExample]] = None,
+        now: Optional[datetime] = None
+    ) -> Tuple[str, str]:
         """
-        Modelfileを生成
+        Modelfileを生成して保存
         
         Args:
             user_id: ユーザーID
             base_model: ベースモデル
-            training_data: トレーニングデータ（Noneの場合は自動取得）
+            training_data: トレーニングデータ（Noneの場合は会話本文を全件読み込まず、
+                件数・平均文字数の集計と代表例の選択をSQLで行う）
+            now: 作成日時（ヘッダーとファイル名に使用。Noneの場合は現在時刻）
         
         Returns:
-            Modelfileの内容（文字列）
+            (Modelfileのパス, Modelfileの内容)
         """
         
-        # トレーニングデータ取得
-        if training_data is None:
-            training_data = self.collect_training_data(user_id)
+        if now is None:
+            now = request_now()
         
         # プロファイル取得
         profile = self.get_user_profile_summary(user_id)
         
+        # 代表例は一度だけ選び、プロンプト用（上位5件）とFew-shot用（上位3件）で共有
+        # （上位n件の選択は安定なので、上位5件の先頭3件は上位3件と一致する）
+        if training_data is None:
+            sample_count, avg_length = self._training_stats(user_id)
+            ranked_examples = self._select_representative_examples(
+                None, n=5, user_id=user_id
+            )
+        else:
+            sample_count, avg_length = len(training_data), None
+            ranked_examples = self._select_representative_examples(training_data, n=5)
+        
         # システムプロンプト構築
         system_prompt = self._build_personalized_system_prompt(
-            user_id, profile, training_data
+            user_id, profile, training_data, ranked_examples, avg_length
         )
         
         # システムプロンプトのエスケープ処理
@@ -257,8 +551,8 @@ class FineTuningSystem:
 
 # ユーザー専用カスタムモデル
 # User: {user_id}
-# Created: {datetime.now().isoformat()}
-# Training samples: {len(training_data)}
+# Created: {now.isoformat()}
+# Training samples: {sample_count}
 # Base model: {base_model}
 
 SYSTEM \"\"\"{system_prompt_escaped}\"\"\"
@@ -274,27 +568,34 @@ PARAMETER stop "</s>"
 """
         
         # Few-shot examplesを追加
-        examples = self._select_representative_examples(training_data, n=3)
+        examples = ranked_examples[:3]
         if examples:
-            modelfile_content += "\n# Few-shot examples\n"
-            for example in examples:
-                # エスケープ処理
-                user_text = example['user'].replace('"""', r'\"\"\"').replace('\n', ' ')
-                assistant_text = example['assistant'].replace('"""', r'\"\"\"').replace('\n', ' ')
-                
-                # 長さ制限
-                user_text = user_text[:200]
-                assistant_text = assistant_text[:300]
-                
-                modelfile_content += f'MESSAGE user \"\"\"{user_text}\"\"\"\n'
-                modelfile_content += f'MESSAGE assistant \"\"\"{assistant_text}\"\"\"\n'
+            modelfile_content = "".join((
+                modelfile_content,
+                "\n# Few-shot examples\n",
+                *(
+                    # エスケープ処理（改行は空白に）と長さ制限
+                    f'MESSAGE user \"\"\"{_escape_message(example.user)[:200]}\"\"\"\n'
+                    f'MESSAGE assistant \"\"\"{_escape_message(example.assistant)[:300]}\"\"\"\n'
+                    for example in examples
+                )
+            ))
+        
+        # Modelfileを保存（デバッグ用 + コマンド実行用）
+        modelfile_path = os.path.join(
+            self.modelfiles_dir,
+            f"{user_id}_{now.strftime('%Y%m%d_%H%M%S')}.Modelfile"
+        )
+        # 改行変換なしでUTF-8のバイト列をそのまま書き出す
+        Path(modelfile_path).write_bytes(modelfile_content.encode('utf-8'))
         
-        return modelfile_content
+        return modelfile_path, modelfile_content
     
     def fine_tune(
         self,
         user_id: str,
-        base_model: str = "qwen2.5:32b"
+        base_model: str = "qwen2.5:32b",
+        readiness: Optional[Dict] = None
     ) -> str:
         """
         ファインチューニングを実行
@@ -302,6 +603,8 @@ PARAMETER stop "</s>"
         Args:
             user_id: ユーザーID
             base_model: ベースモデル
+            readiness: 呼び出し側で取得済みの get_tuning_readiness の結果
+                （Noneの場合はここで取得する）
         
         Returns:
             作成されたモデル名
@@ -309,31 +612,32 @@ PARAMETER stop "</s>"
         
         print(f"🔧 ファインチューニング開始: {user_id}")
         
-        # 1. トレーニングデータ収集
-        training_data = self.collect_training_data(user_id)
-        
-        if len(training_data) < self.min_conversations:
+        # 1. 件数だけを集計して事前チェック（不足時は会話本文を読み込まない）
+        if readiness is None:
+            readiness = self.get_tuning_readiness(user_id)
+        if not readiness["ready"]:
             raise ValueError(
                 f"会話データが不足しています。"
-                f"最低{self.min_conversations}件必要ですが、{len(training_data)}件しかありません。"
+                f"最低{self.min_conversations}件必要ですが、{readiness['usable_for_training']}件しかありません。"
             )
         
-        print(f"✅ トレーニングデータ: {len(training_data)}件")
+        # 学習対象の件数（準備状況と同じく直近100件まで）
+        training_size = readiness["usable_for_training"]
         
-        # 2. Modelfile作成
-        modelfile_content = self.create_modelfile(user_id, base_model, training_data)
+        print(f"✅ トレーニングデータ: {training_size}件")
         
-        # Modelfileを保存（デバッグ用 + コマンド実行用）
-        modelfile_path = os.path.join(
-            self.modelfiles_dir,
-            f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.Modelfile"
+        # 作成日時は1回だけ取得し、Modelfile・モデル名・メタデータで揃える
+        now = request_now()
+        
+        # 2. Modelfile作成
+        # （会話本文は読み込まずSQLで代表例を選ぶ。保存済みのパスと内容を受け取り、読み直しはしない）
+        modelfile_path, modelfile_content = self.create_modelfile(
+            user_id, base_model, None, now
         )
-        with open(modelfile_path, 'w', encoding='utf-8') as f:
-            f.write(modelfile_content)
         print(f"✅ Modelfile保存: {modelfile_path}")
         
         # 3. カスタムモデル名
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
         model_name = f"{user_id}_custom_{timestamp}"
         
         try:
@@ -344,27 +648,16 @@ PARAMETER stop "</s>"
             # デバッグ: Modelfileの内容を確認
             print(f"   Modelfile先頭200文字: {modelfile_content[:200]}")
             
-            # ollama.create()を使用（path指定で読み込み）
-            # 一時ファイルから読み込ませる方法に変更
-            import subprocess
-            
-            result = subprocess.run(
-                ["ollama", "create", model_name, "-f", modelfile_path],
-                capture_output=True,
-                text=True,
-                timeout=300
-            )
-            
-            if result.returncode != 0:
-                raise RuntimeError(f"モデル作成失敗: {result.stderr}")
+            # ollama create を実行（保存済みのModelfileを指定）
+            self._run_ollama_create(model_name, modelfile_path)
             
-            # 結果を確認
-            print(f"   作成結果: {result.stdout}")
             print(f"✅ モデル作成完了: {model_name}")
+            self.invalidate_models_cache()
             
             # 5. メタデータを保存
             self._save_model_metadata(
-                user_id, model_name, base_model, len(training_data)
+                user_id, model_name, base_model, training_size,
+                now.isoformat()
             )
             
             return model_name
@@ -377,84 +670,103 @@ PARAMETER stop "</s>"
             print(modelfile_content[:200])
             raise RuntimeError(f"モデル作成エラー: {str(e)}")
     
+    def _run_ollama_create(self, model_name: str, modelfile_path: str):
+        """
+        ollama create を実行し、進捗を1行ずつそのまま表示する
+        
+        出力全体はメモリに溜めず、失敗時のメッセージ用に末尾数行だけ保持する
+        """
+        cmd = ["ollama", "create", model_name, "-f", modelfile_path]
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        )
+        timed_out = threading.Event()
+        
+        def kill():
+            timed_out.set()
+            proc.kill()
+        
+        timer = threading.Timer(_OLLAMA_CREATE_TIMEOUT, kill)
+        timer.start()
+        tail = deque(maxlen=_OLLAMA_CREATE_TAIL_LINES)
+        try:
+            for line in proc.stdout:
+                print(f"   {line}", end="")
+                tail.append(line)
+            proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+        
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, _OLLAMA_CREATE_TIMEOUT)
+        if proc.returncode != 0:
+            raise RuntimeError(f"モデル作成失敗: {''.join(tail)}")
+    
     def _save_model_metadata(
         self,
         user_id: str,
         model_name: str,
         base_model: str,
-        training_size: int
+        training_size: int,
+        created_at: Optional[str] = None
     ):
-        """カスタムモデルのメタデータを保存"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # 既存のモデルを非アクティブに
-        c.execute("""
-            UPDATE custom_models
-            SET is_active = 0
-            WHERE user_id = ? AND is_active = 1
-        """, (user_id,))
-        
-        # 新しいモデルを保存
-        c.execute("""
-            INSERT OR REPLACE INTO custom_models
-            (user_id, model_name, base_model, training_size, created_at, is_active)
-            VALUES (?, ?, ?, ?, ?, 1)
-        """, (
-            user_id,
-            model_name,
-            base_model,
-            training_size,
-            datetime.now().isoformat()
-        ))
-        
-        conn.commit()
-        conn.close()
+        """カスタムモデルのメタデータを保存（created_at 省略時は現在時刻）"""
+        if created_at is None:
+            created_at = request_now().isoformat()
+        
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                # 既存のモデルを非アクティブに
+                c.execute(_SQL_DEACTIVATE_MODELS, (user_id,))
+                
+                # 新しいモデルを保存
+                c.execute(_SQL_INSERT_MODEL, (
+                    user_id,
+                    model_name,
+                    base_model,
+                    training_size,
+                    created_at
+                ))
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+            finally:
+                self._active_model_cache.pop(user_id, None)
         
         print(f"✅ メタデータ保存完了")
     
     def get_active_model(self, user_id: str) -> Optional[str]:
-        """ユーザーのアクティブなカスタムモデルを取得"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute("""
-            SELECT model_name
-            FROM custom_models
-            WHERE user_id = ? AND is_active = 1
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (user_id,))
+        """ユーザーのアクティブなカスタムモデルを取得（短時間キャッシュ）"""
+        cached = self._active_model_cache.get(user_id)
+        if cached is not None and monotonic() - cached[0] < _USER_CACHE_TTL:
+            return cached[1]
         
+        c = self.conn.cursor()
+        c.execute(_SQL_ACTIVE_MODEL, (user_id,))
         row = c.fetchone()
-        conn.close()
         
-        return row[0] if row else None
+        model_name = row[0] if row else None
+        self._active_model_cache[user_id] = (monotonic(), model_name)
+        return model_name
     
     def list_user_models(self, user_id: str) -> List[Dict]:
         """ユーザーが作成したモデル一覧"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute("""
-            SELECT model_name, base_model, training_size, created_at, is_active
-            FROM custom_models
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-        """, (user_id,))
-        
-        rows = c.fetchall()
-        conn.close()
+        # 列名つきの行で受け取り、そのまま辞書化する（共有接続の設定は変えない）
+        c = self.conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute(_SQL_LIST_MODELS, (user_id,))
         
-        models = []
-        for row in rows:
-            models.append({
-                "model_name": row[0],
-                "base_model": row[1],
-                "training_size": row[2],
-                "created_at": row[3],
-                "is_active": bool(row[4])
-            })
+        models = [dict(row) for row in c]
+        for model in models:
+            model["is_active"] = bool(model["is_active"])
         
         return models
     
@@ -463,19 +775,13 @@ PARAMETER stop "</s>"
         try:
             # Ollamaからモデル削除
             print(f"🗑️ Ollamaからモデル削除中: {model_name}")
-            ollama.delete(model_name)
+            client.delete(model_name)
+            self.invalidate_models_cache()
             
             # データベースから削除
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            
-            c.execute("""
-                DELETE FROM custom_models
-                WHERE user_id = ? AND model_name = ?
-            """, (user_id, model_name))
-            
-            conn.commit()
-            conn.close()
+            with self._lock:
+                self.conn.execute(_SQL_DELETE_MODEL, (user_id, model_name))
+                self._active_model_cache.pop(user_id, None)
             
             print(f"✅ モデル削除完了: {model_name}")
             
@@ -507,27 +813,14 @@ PARAMETER stop "</s>"
                 "おすすめの本を教えて"
             ]
         
+        # 各プロンプトは独立しているので並行して問い合わせる（結果は入力順）
         results = []
-        
-        for prompt in test_prompts:
-            try:
-                response = ollama.chat(
-                    model=model_name,
-                    messages=[{"role": "user", "content": prompt}]
-                )
-                
-                results.append({
-                    "prompt": prompt,
-                    "response": response['message']['content'],
-                    "success": True
-                })
-                
-            except Exception as e:
-                results.append({
-                    "prompt": prompt,
-                    "error": str(e),
-                    "success": False
-                })
+        if test_prompts:
+            with ThreadPoolExecutor(max_workers=min(8, len(test_prompts))) as pool:
+                results = list(pool.map(
+                    lambda prompt: self._evaluate_prompt(model_name, prompt),
+                    test_prompts
+                ))
         
         success_count = sum(1 for r in results if r["success"])
         success_rate = success_count / len(results) if results else 0
@@ -540,6 +833,27 @@ PARAMETER stop "</s>"
             "results": results
         }
     
+    def _evaluate_prompt(self, model_name: str, prompt: str) -> Dict:
+        """評価用プロンプトを1件実行"""
+        try:
+            response = client.chat(
+                model=model_name,
+                messages=[{"role": "user", "content": prompt}]
+            )
+            
+            return {
+                "prompt": prompt,
+                "response": response['message']['content'],
+                "success": True
+            }
+            
+        except Exception as e:
+            return {
+                "prompt": prompt,
+                "error": str(e),
+                "success": False
+            }
+    
     def get_tuning_readiness(self, user_id: str) -> Dict:
         """
         ファインチューニングの準備状況をチェック
@@ -547,27 +861,11 @@ PARAMETER stop "</s>"
         Returns:
             準備状況の詳細情報
         """
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # 総会話数
-        c.execute("""
-            SELECT COUNT(*) FROM conversations WHERE user_id = ?
-        """, (user_id,))
-        total_count = c.fetchone()[0]
-        
-        # 高評価数
-        c.execute("""
-            SELECT COUNT(*) FROM conversations
-            WHERE user_id = ? AND rating >= 3
-        """, (user_id,))
-        high_rated_count = c.fetchone()[0]
-        
-        conn.close()
-        
-        # 使用可能なデータ数
-        training_data = self.collect_training_data(user_id)
-        usable_count = len(training_data)
+        c = self.conn.cursor()
+        
+        # 総会話数・高評価数・使用可能なデータ数
+        c.execute(_SQL_READINESS_COUNTS, (user_id,))
+        total_count, high_rated_count, usable_count = c.fetchone()
         
         ready = usable_count >= self.min_conversations
         progress = min(100, (usable_count / self.min_conversations) * 100)
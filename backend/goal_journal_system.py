@@ -6,84 +6,794 @@ AIが人生のパートナーとして目標達成をサポート
 
 import sqlite3
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from itertools import groupby
+from typing import Iterator, List, Dict, Optional
 import json
+import re
+import string
+import hashlib
+import threading
+from collections import OrderedDict
+import asyncio
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Queue
 import ollama
 
+from _ollama_pool import async_client
+from analyzer import _JsonObjectScanner, _extract_json_object
+from request_context import request_now
 
-class GoalManager:
-    """長期目標管理システム"""
-    
-    def __init__(self, db_connection, model: str = "qwen2.5:7b"):
-        self.conn = db_connection
-        self.model = model
-        if self.conn is not None: # ← この行を追加
-            self._init_tables()
+
+# ==================== LLM応答のJSON抽出 ====================
+
+# 括弧が閉じていない応答向けの予備（最初の "{" から最後の "}" まで）
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+
+def _extract_json(text: str) -> Optional[str]:
+    """LLM応答からJSONオブジェクト部分を1回の走査で切り出す（見つからなければNone）"""
+    json_str = _extract_json_object(text)
+    if json_str is None:
+        match = _JSON_RE.search(text)
+        json_str = match.group() if match else None
+    return json_str
+
+
+# ==================== 時刻 ====================
+
+def _now_iso() -> str:
+    """記録用の現在時刻（リクエスト内ではリクエスト開始時刻）"""
+    return request_now().isoformat()
+
+
+# ==================== LLM応答キャッシュ ====================
+
+# プロセス内キャッシュの上限件数
+_LLM_MEMO_SIZE = 512
+# キー（モデル・温度・プロンプトのハッシュ）-> 応答本文
+_llm_memo: "OrderedDict[str, str]" = OrderedDict()
+_llm_memo_lock = threading.Lock()
+
+# llm_cache テーブルの有効期間と上限件数（古い応答は使わず、保存時に削る）
+_LLM_CACHE_TTL = timedelta(days=30)
+_LLM_CACHE_MAX_ROWS = 5000
+# この回数保存するごとに期限切れ・上限超過分を削除する
+_LLM_CACHE_PRUNE_EVERY = 64
+_llm_cache_puts = 0
+
+
+def _llm_cache_key(model: str, prompt: str, options: Dict) -> str:
+    """キャッシュキー（モデル・生成オプション・プロンプトのハッシュ）"""
+    params = f"{options['temperature']}"
+    if "num_predict" in options:
+        params += f"\0{options['num_predict']}"
+    return hashlib.blake2b(
+        f"{model}\0{params}\0{prompt}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def _chat_options(temperature: float, num_predict: Optional[int]) -> Dict:
+    """ollama.chat の options（num_predict は指定時のみ）"""
+    options = {"temperature": temperature}
+    if num_predict is not None:
+        options["num_predict"] = num_predict
+    return options
+
+
+def _llm_cache_get(db, key: str) -> Optional[str]:
+    """プロセス内のLRU → llm_cache テーブルの順に引く"""
+    with _llm_memo_lock:
+        content = _llm_memo.get(key)
+        if content is not None:
+            _llm_memo.move_to_end(key)
+            return content
     
-    def _init_tables(self):
-        """テーブル初期化"""
-        c = self.conn.cursor()
-        
-        # 目標テーブル
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS goals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                category TEXT,
-                target_date TEXT,
-                status TEXT DEFAULT 'active',
-                progress_percentage INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL,
-                completed_at TEXT,
-                metadata TEXT
+    try:
+        with db._connection() as conn:
+            row = conn.execute(
+                _SQL_GET_LLM_CACHE, (key, _llm_cache_cutoff())
+            ).fetchone()
+    except sqlite3.Error:
+        return None  # 接続なし・llm_cache テーブル未作成
+    if row:
+        _llm_memo_put(key, row[0])
+        return row[0]
+    return None
+
+
+def _llm_memo_put(key: str, content: str):
+    """プロセス内のLRUに保存"""
+    with _llm_memo_lock:
+        _llm_memo[key] = content
+        _llm_memo.move_to_end(key)
+        if len(_llm_memo) > _LLM_MEMO_SIZE:
+            _llm_memo.popitem(last=False)
+
+
+def _llm_cache_cutoff() -> str:
+    """これより古い llm_cache の行は使わない"""
+    return (request_now() - _LLM_CACHE_TTL).isoformat()
+
+
+def _llm_cache_put(db, key: str, model: str, content: str):
+    """プロセス内のLRUと llm_cache テーブルの両方に保存（ときどき古い行を削る）"""
+    global _llm_cache_puts
+    _llm_memo_put(key, content)
+    with _llm_memo_lock:
+        _llm_cache_puts += 1
+        prune = _llm_cache_puts % _LLM_CACHE_PRUNE_EVERY == 0
+    try:
+        with db.batch() as conn:
+            conn.execute(
+                _SQL_PUT_LLM_CACHE,
+                (key, model, content, _now_iso())
             )
-        """)
-        
-        # マイルストーン（中間目標）
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS milestones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                goal_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                target_date TEXT,
-                completed INTEGER DEFAULT 0,
-                completed_at TEXT,
-                FOREIGN KEY (goal_id) REFERENCES goals(id)
+            if prune:
+                conn.execute(_SQL_PRUNE_LLM_CACHE_EXPIRED, (_llm_cache_cutoff(),))
+                conn.execute(_SQL_PRUNE_LLM_CACHE_OVERFLOW, (_LLM_CACHE_MAX_ROWS - 1,))
+    except sqlite3.Error:
+        pass  # 接続なし・llm_cache テーブル未作成
+
+
+def _is_cacheable(content: str, json_object: bool) -> bool:
+    """
+    キャッシュしてよい応答か
+    
+    JSONを求めた応答は解析できるオブジェクトのときだけ（途中で切れた応答を
+    保存すると、同じプロンプトで二度と生成し直されない）。文章は空でなければよい
+    """
+    if not content or not content.strip():
+        return False
+    if not json_object:
+        return True
+    json_str = _extract_json(content)
+    if json_str is None:
+        return False
+    try:
+        return isinstance(json.loads(json_str), dict)
+    except ValueError:
+        return False
+
+
+def _stream_json_object(model: str, prompt: str, options: Dict) -> str:
+    """
+    ストリーミングで ollama.chat を呼び、JSONオブジェクトが閉じた時点で打ち切る
+    
+    ストリームを閉じるとOllama側の生成も止まるため、閉じ括弧の後の説明文を
+    生成させずに済む。最後まで閉じなければ応答全体を返す
+    """
+    scanner = _JsonObjectScanner()
+    parts = []
+    stream = ollama.chat(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        options=options,
+        stream=True
+    )
+    try:
+        for chunk in stream:
+            text = chunk['message']['content']
+            parts.append(text)
+            json_str = scanner.feed(text)
+            if json_str:
+                return json_str
+    finally:
+        stream.close()
+    return "".join(parts)
+
+
+async def _astream_json_object(model: str, prompt: str, options: Dict) -> str:
+    """_stream_json_object の非同期版"""
+    scanner = _JsonObjectScanner()
+    parts = []
+    stream = await async_client.chat(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        options=options,
+        stream=True
+    )
+    try:
+        async for chunk in stream:
+            text = chunk['message']['content']
+            parts.append(text)
+            json_str = scanner.feed(text)
+            if json_str:
+                return json_str
+    finally:
+        await stream.aclose()
+    return "".join(parts)
+
+
+def _cached_chat(
+    db,
+    model: str,
+    prompt: str,
+    temperature: float,
+    json_object: bool = False,
+    num_predict: Optional[int] = None
+) -> str:
+    """
+    同一プロンプトへの応答をキャッシュして ollama.chat を呼ぶ
+    
+    プロセス内のLRUを先に引き、なければ llm_cache テーブル（再起動後も有効）を引く。
+    どちらにもなければ生成し、解析できる応答だけを両方に保存する。
+    db（GoalManager / JournalSystem）がDBに接続できない場合はプロセス内のみ。
+    llm_cache の行は _LLM_CACHE_TTL で期限切れになり、_LLM_CACHE_MAX_ROWS 件を超えた分は削る。
+    json_object=True ならJSONオブジェクトが閉じた時点で生成を打ち切り、その部分を返す。
+    num_predict を指定すると生成トークン数の上限にする。
+    """
+    options = _chat_options(temperature, num_predict)
+    key = _llm_cache_key(model, prompt, options)
+    content = _llm_cache_get(db, key)
+    if content is None:
+        if json_object:
+            content = _stream_json_object(model, prompt, options)
+        else:
+            response = ollama.chat(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                options=options
             )
-        """)
-        
-        # 目標進捗ログ
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS goal_progress (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                goal_id INTEGER NOT NULL,
-                timestamp TEXT NOT NULL,
-                progress_percentage INTEGER,
-                notes TEXT,
-                achievements TEXT,
-                challenges TEXT,
-                FOREIGN KEY (goal_id) REFERENCES goals(id)
+            content = response['message']['content']
+        if _is_cacheable(content, json_object):
+            _llm_cache_put(db, key, model, content)
+    return content
+
+
+async def _acached_chat(
+    db,
+    model: str,
+    prompt: str,
+    temperature: float,
+    json_object: bool = False,
+    num_predict: Optional[int] = None
+) -> str:
+    """_cached_chat の非同期版（共有の AsyncClient で生成し、待ち時間を重ねられる）"""
+    options = _chat_options(temperature, num_predict)
+    key = _llm_cache_key(model, prompt, options)
+    content = _llm_cache_get(db, key)
+    if content is None:
+        if json_object:
+            content = await _astream_json_object(model, prompt, options)
+        else:
+            response = await async_client.chat(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                options=options
             )
-        """)
-        
-        # 振り返りメモ
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS reflections (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                goal_id INTEGER,
-                timestamp TEXT NOT NULL,
-                reflection_type TEXT DEFAULT 'weekly',
-                content TEXT NOT NULL,
-                insights TEXT,
-                action_items TEXT,
-                FOREIGN KEY (goal_id) REFERENCES goals(id)
+            content = response['message']['content']
+        if _is_cacheable(content, json_object):
+            _llm_cache_put(db, key, model, content)
+    return content
+
+
+# ==================== プロンプト ====================
+# 固定の指示を先頭に、可変部分を末尾に置く（Ollama側のプレフィックスキャッシュが効く）
+
+# 抽出処理の生成トークン数の上限（JSONを閉じるのに足りる分だけ）
+_GOAL_EXTRACT_NUM_PREDICT = 256
+_JOURNAL_EXTRACT_NUM_PREDICT = 512  # 要約文を含むので多めに取る
+
+# 目標らしい発言の判定（含まなければLLMに渡さない）
+_GOAL_KEYWORDS_RE = re.compile("|".join(map(re.escape, [
+    "なりたい", "達成したい", "目指す", "目標",
+    "できるようになりたい", "マスターしたい"
+])))
+
+# 目標抽出
+_GOAL_EXTRACT_TMPL = string.Template("""以下のメッセージから目標情報を抽出してください。
+
+以下のJSON形式で返してください（JSONのみ）:
+{
+  "has_goal": true/false,
+  "title": "目標のタイトル",
+  "description": "詳細説明",
+  "category": "skill/health/career/finance/hobby/personal",
+  "target_date": "YYYY-MM-DD形式または相対期間",
+  "estimated_months": 3,
+  "key_milestones": ["マイルストーン1", "マイルストーン2"]
+}
+
+現在日付: $today
+メッセージ: $message
+""")
+
+
+# 計画生成
+_GOAL_PLAN_TMPL = string.Template("""末尾の目標を、指定の期間で達成するための計画を立ててください。
+
+以下のJSON形式で返してください（JSONのみ）:
+{
+  "milestones": [
+    {"month": 1, "title": "マイルストーン1", "description": "詳細"},
+    {"month": 2, "title": "マイルストーン2", "description": "詳細"}
+  ],
+  "weekly_actions": [
+    "週次アクション1",
+    "週次アクション2"
+  ],
+  "key_habits": [
+    "習慣1",
+    "習慣2"
+  ],
+  "success_metrics": [
+    "成功指標1",
+    "成功指標2"
+  ],
+  "potential_challenges": [
+    "課題1",
+    "課題2"
+  ]
+}
+
+目標: $title
+詳細: $description
+期間: ${months}ヶ月
+""")
+
+
+# 進捗インサイト
+_INSIGHT_TMPL = string.Template("""末尾の目標の進捗を分析して、アドバイスをください。
+
+以下の形式で簡潔に（3-4文で）回答してください:
+1. 現状の評価
+2. 具体的なアドバイス
+3. 励ましのメッセージ
+
+目標: $title
+現在の進捗: $progress%
+経過日数: ${days}日
+ステータス: $status
+進捗ギャップ: $gap%
+
+最近の進捗:
+$recent
+""")
+
+
+# 日記生成
+_JOURNAL_TMPL = string.Template("""末尾は今日のユーザーとの会話です。この会話から日記エントリを作成してください。
+
+以下のJSON形式で返してください（JSONのみ）:
+{
+  "summary": "今日の出来事の要約（3-4文）",
+  "mood": "happy/productive/tired/stressed/peaceful/excited",
+  "energy_level": 1-10,
+  "highlights": ["ハイライト1", "ハイライト2"],
+  "challenges": ["課題1", "課題2"],
+  "achievements": ["達成したこと1", "達成したこと2"],
+  "gratitude": ["感謝すること1", "感謝すること2"]
+}
+
+$conversations
+""")
+
+
+# 週次振り返り
+_WEEKLY_REVIEW_TMPL = string.Template("""末尾は過去1週間の日記データです。週次振り返りを作成してください。
+
+以下のJSON形式で返してください（JSONのみ）:
+{
+  "overall_mood": "全体的な気分",
+  "highlights": ["今週のハイライト1", "ハイライト2"],
+  "patterns": ["気づいたパターン1", "パターン2"],
+  "improvements": ["改善できること1", "改善できること2"],
+  "next_week_focus": ["来週の焦点1", "焦点2"],
+  "encouragement": "励ましのメッセージ"
+}
+
+$entries
+""")
+
+
+# ==================== スキーマ ====================
+
+# 変更したら上げる（DBの PRAGMA user_version と比べ、古ければ _SCHEMA_SQL を流す）
+_SCHEMA_VERSION = 2
+
+# 目標・日記・LLM応答キャッシュのテーブル・索引・トリガー（すべて冪等）
+_SCHEMA_SQL = """
+    -- 目標テーブル
+    CREATE TABLE IF NOT EXISTS goals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT,
+        category TEXT,
+        target_date TEXT,
+        status TEXT DEFAULT 'active',
+        progress_percentage INTEGER DEFAULT 0,
+        created_at TEXT NOT NULL,
+        completed_at TEXT,
+        metadata TEXT
+    );
+
+    -- マイルストーン（中間目標）
+    CREATE TABLE IF NOT EXISTS milestones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        goal_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT,
+        target_date TEXT,
+        completed INTEGER DEFAULT 0,
+        completed_at TEXT,
+        FOREIGN KEY (goal_id) REFERENCES goals(id)
+    );
+
+    -- 目標進捗ログ
+    CREATE TABLE IF NOT EXISTS goal_progress (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        goal_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        progress_percentage INTEGER,
+        notes TEXT,
+        achievements TEXT,
+        challenges TEXT,
+        FOREIGN KEY (goal_id) REFERENCES goals(id)
+    );
+
+    -- 振り返りメモ
+    CREATE TABLE IF NOT EXISTS reflections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        goal_id INTEGER,
+        timestamp TEXT NOT NULL,
+        reflection_type TEXT DEFAULT 'weekly',
+        content TEXT NOT NULL,
+        insights TEXT,
+        action_items TEXT,
+        FOREIGN KEY (goal_id) REFERENCES goals(id)
+    );
+
+    -- アクティブな目標の一覧（新しい順）
+    CREATE INDEX IF NOT EXISTS idx_goals_user_status
+    ON goals(user_id, status, created_at DESC);
+
+    -- 目標ごとのマイルストーン（期日順）・達成率の集計
+    CREATE INDEX IF NOT EXISTS idx_milestones_goal
+    ON milestones(goal_id, target_date);
+
+    -- 目標ごとの最近の進捗
+    CREATE INDEX IF NOT EXISTS idx_progress_goal_ts
+    ON goal_progress(goal_id, timestamp DESC);
+
+    -- マイルストーンの達成状況が変わったら目標の進捗率をDB側で再計算する
+    -- （全マイルストーン達成でアクティブな目標は完了にする）
+    CREATE TRIGGER IF NOT EXISTS trg_milestone_progress
+    AFTER UPDATE OF completed ON milestones
+    FOR EACH ROW
+    BEGIN
+        UPDATE goals
+        SET progress_percentage = (
+                SELECT CAST(CAST(SUM(completed) AS REAL) / COUNT(*) * 100 AS INTEGER)
+                FROM milestones
+                WHERE goal_id = NEW.goal_id
+            ),
+            status = CASE
+                WHEN status = 'active' AND NOT EXISTS (
+                    SELECT 1 FROM milestones
+                    WHERE goal_id = NEW.goal_id AND completed = 0
+                ) THEN 'completed'
+                ELSE status
+            END,
+            completed_at = CASE
+                WHEN status = 'active' AND NOT EXISTS (
+                    SELECT 1 FROM milestones
+                    WHERE goal_id = NEW.goal_id AND completed = 0
+                ) THEN NEW.completed_at
+                ELSE completed_at
+            END
+        WHERE id = NEW.goal_id;
+    END;
+
+    -- LLM応答キャッシュ（GoalManager / JournalSystem 共用）
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        prompt_hash TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    -- 期限切れ・上限超過分の削除用
+    CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at);
+
+    -- 日記テーブル
+    CREATE TABLE IF NOT EXISTS journal_entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        entry_type TEXT DEFAULT 'daily',
+        content TEXT NOT NULL,
+        mood TEXT,
+        energy_level INTEGER,
+        highlights TEXT,
+        challenges TEXT,
+        gratitude TEXT,
+        tomorrow_plans TEXT,
+        created_at TEXT NOT NULL,
+        metadata TEXT
+    );
+
+    -- アクティビティログ
+    CREATE TABLE IF NOT EXISTS activity_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        activity_type TEXT NOT NULL,
+        description TEXT,
+        duration_minutes INTEGER,
+        related_goal_id INTEGER,
+        notes TEXT
+    );
+
+    -- 週次・月次振り返り
+    CREATE TABLE IF NOT EXISTS periodic_reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        review_type TEXT NOT NULL,
+        period_start TEXT NOT NULL,
+        period_end TEXT NOT NULL,
+        content TEXT NOT NULL,
+        insights TEXT,
+        wins TEXT,
+        learnings TEXT,
+        next_actions TEXT,
+        created_at TEXT NOT NULL
+    );
+
+    -- 日付指定・最近の日記の取得
+    CREATE INDEX IF NOT EXISTS idx_journal_user_date
+    ON journal_entries(user_id, date DESC);
+
+    -- 期間内のアクティビティ集計（種類まで索引で賄う）
+    CREATE INDEX IF NOT EXISTS idx_activity_user_ts
+    ON activity_log(user_id, timestamp, activity_type);
+
+    ANALYZE;
+"""
+
+
+# ==================== SQL ====================
+# 同一の文字列を使い回し、sqlite3 の文キャッシュに乗せる
+
+_SQL_GET_LLM_CACHE = """
+    SELECT response FROM llm_cache WHERE prompt_hash = ? AND created_at >= ?
+"""
+
+_SQL_PUT_LLM_CACHE = """
+    INSERT OR REPLACE INTO llm_cache (prompt_hash, model, response, created_at)
+    VALUES (?, ?, ?, ?)
+"""
+
+_SQL_PRUNE_LLM_CACHE_EXPIRED = """
+    DELETE FROM llm_cache WHERE created_at < ?
+"""
+
+# 新しい順に数えて上限を超えた分を削除（件数が上限以下なら副問い合わせがNULLで何もしない）
+_SQL_PRUNE_LLM_CACHE_OVERFLOW = """
+    DELETE FROM llm_cache WHERE created_at < (
+        SELECT created_at FROM llm_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?
+    )
+"""
+
+_SQL_INSERT_GOAL = """
+    INSERT INTO goals
+    (user_id, title, description, category, target_date, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_MILESTONE = """
+    INSERT INTO milestones
+    (goal_id, title, description, target_date)
+    VALUES (?, ?, ?, ?)
+"""
+
+_SQL_COMPLETE_MILESTONE = """
+    UPDATE milestones
+    SET completed = 1, completed_at = ?
+    WHERE id = ?
+"""
+
+# アクティブな目標とそのマイルストーンを1回で取得（目標ごとに行が連続する）
+_SQL_ACTIVE_GOALS_WITH_MILESTONES = """
+    SELECT g.id, g.title, g.description, g.category, g.target_date,
+           g.progress_percentage, g.created_at,
+           m.id AS milestone_id, m.title AS milestone_title,
+           m.completed AS milestone_completed,
+           m.target_date AS milestone_target_date
+    FROM goals g
+    LEFT JOIN milestones m ON m.goal_id = g.id
+    WHERE g.user_id = ? AND g.status = 'active'
+    ORDER BY g.created_at DESC, g.id, m.target_date ASC, m.id
+"""
+
+_SQL_INSERT_GOAL_PROGRESS = """
+    INSERT INTO goal_progress
+    (goal_id, timestamp, progress_percentage, notes, achievements, challenges)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# 進捗率を更新し、100%以上なら同じ文で完了にする
+# パラメータ: (進捗率, 進捗率, 進捗率, 完了日時, 目標ID)
+_SQL_UPDATE_GOAL_PROGRESS = """
+    UPDATE goals
+    SET progress_percentage = ?,
+        status = CASE WHEN ? >= 100 THEN 'completed' ELSE status END,
+        completed_at = CASE WHEN ? >= 100 THEN ? ELSE completed_at END
+    WHERE id = ?
+"""
+
+_SQL_INSERT_JOURNAL_ENTRY = """
+    INSERT INTO journal_entries
+    (user_id, date, content, mood, energy_level, highlights, 
+     challenges, gratitude, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_ACTIVITY = """
+    INSERT INTO activity_log
+    (user_id, timestamp, activity_type, description, 
+     duration_minutes, related_goal_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# 週次振り返り用の日記の要約（1日1行、新しい順に改行で連結した1つの文字列）
+_SQL_WEEKLY_REVIEW_ENTRIES = """
+    SELECT group_concat(line, char(10))
+    FROM (
+        SELECT date || ': ' || COALESCE(mood, '')
+               || ' (エネルギー: ' || COALESCE(energy_level, '?') || '/10)' AS line
+        FROM journal_entries
+        WHERE user_id = ? AND date >= ?
+        ORDER BY date DESC
+    )
+"""
+
+# アクティビティタイプ別の件数・合計時間（件数の多い順に並べたJSONオブジェクト）
+_SQL_ACTIVITY_SUMMARY = """
+    SELECT json_group_object(
+        activity_type,
+        json_object('count', cnt, 'total_minutes', total_minutes)
+    )
+    FROM (
+        SELECT activity_type, COUNT(*) AS cnt,
+               COALESCE(SUM(duration_minutes), 0) AS total_minutes
+        FROM activity_log
+        WHERE user_id = ? AND timestamp >= ?
+        GROUP BY activity_type
+        ORDER BY cnt DESC
+    )
+"""
+
+
+def _configure_connection(conn):
+    """
+    接続設定（WAL + 書き込み時のfsyncを削減）
+    
+    synchronous=NORMAL では電源断時に直前のコミットが失われうるが、
+    WALによりDBファイルが壊れることはない。日記・目標の記録にはこれで十分とする。
+    journal_mode はDBファイルに保存されるので、WALでない場合だけ切り替える。
+    """
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+
+def _migrate(conn):
+    """
+    スキーマを作成・更新（DBごとに1回だけ）
+    
+    user_version が最新ならSQLを一切解析せずに戻る。
+    executescript は実行前に未コミットのトランザクションをコミットする
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= _SCHEMA_VERSION:
+        return
+    conn.executescript(
+        _SCHEMA_SQL + f"PRAGMA user_version = {_SCHEMA_VERSION};"
+    )
+
+
+class SqlitePool:
+    """
+    SQLite接続プール
+    
+    接続は作成時に1回だけ設定し、acquire() で借りて返す。
+    複数のリクエストから同時に使われても1本の接続を取り合わない
+    """
+    
+    def __init__(self, db_path, size: int = 4):
+        self._pool: Queue = Queue()
+        self._connections: List[sqlite3.Connection] = []
+        for _ in range(max(1, size)):
+            conn = sqlite3.connect(
+                str(db_path), check_same_thread=False, cached_statements=256
             )
-        """)
+            _configure_connection(conn)
+            self._connections.append(conn)
+            self._pool.put(conn)
+    
+    @contextmanager
+    def acquire(self) -> Iterator[sqlite3.Connection]:
+        """接続を借りる（with を抜けるとプールに戻る）"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            # コミットされなかった変更を次の利用者に持ち越さない
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+    
+    def close(self):
+        """すべての接続を閉じる"""
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+
+
+class _SqliteStore:
+    """
+    GoalManager / JournalSystem 共通の接続管理
+    
+    db_connection には SqlitePool、DBファイルのパス、既存の sqlite3.Connection を渡せる。
+    conn に接続が設定されていればそれを使い、なければ操作のたびにプールから借りる
+    """
+    
+    def __init__(self, db_connection):
+        self.pool: Optional[SqlitePool] = None
+        self.conn = None
+        
+        if isinstance(db_connection, (str, Path)):
+            db_connection = SqlitePool(db_connection)
+        if isinstance(db_connection, SqlitePool):
+            self.pool = db_connection
+        else:
+            self.conn = db_connection
         
-        self.conn.commit()
+        if self.conn is not None or self.pool is not None:
+            self._init_tables()
+    
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        """この操作で使う接続"""
+        if self.conn is not None:
+            yield self.conn
+        elif self.pool is not None:
+            with self.pool.acquire() as conn:
+                yield conn
+        else:
+            raise sqlite3.ProgrammingError("データベース接続が設定されていません")
+    
+    @contextmanager
+    def batch(self) -> Iterator[sqlite3.Connection]:
+        """1本の接続・1トランザクションでまとめて書き込む"""
+        with self._connection() as conn:
+            with conn:
+                yield conn
+    
+    def _init_tables(self):
+        """接続設定とテーブル初期化（GoalManager / JournalSystem 共通）"""
+        with self._connection() as conn:
+            _configure_connection(conn)
+            _migrate(conn)
+
+
+class GoalManager(_SqliteStore):
+    """長期目標管理システム"""
+    
+    def __init__(
+        self,
+        db_connection,
+        model: str = "qwen2.5:7b",
+        extract_model: str = "gemma3:4b"
+    ):
+        self.model = model
+        # JSON抽出だけの処理は小さいモデルで十分（文章の質が要る生成は model を使う）
+        self.extract_model = extract_model
+        super().__init__(db_connection)
     
     # ==================== 目標作成・管理 ====================
     
@@ -93,79 +803,114 @@ class GoalManager:
         title: str,
         description: str = "",
         category: str = "personal",
-        target_date: Optional[str] = None
+        target_date: Optional[str] = None,
+        milestones: Optional[List[Dict]] = None
     ) -> int:
-        """目標作成"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            INSERT INTO goals
-            (user_id, title, description, category, target_date, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            user_id, title, description, category, target_date,
-            datetime.now().isoformat()
-        ))
+        """
+        目標作成
         
-        goal_id = c.lastrowid
-        self.conn.commit()
+        milestones があれば同じトランザクションで追加する
+        （形式は add_milestones_bulk と同じ）
+        """
+        with self.batch() as conn:
+            c = conn.execute(_SQL_INSERT_GOAL, (
+                user_id, title, description, category, target_date,
+                _now_iso()
+            ))
+            goal_id = c.lastrowid
+            
+            if milestones:
+                conn.executemany(_SQL_INSERT_MILESTONE, [
+                    (goal_id, m["title"], m.get("description", ""), m.get("target_date"))
+                    for m in milestones
+                ])
         
         return goal_id
     
+    @staticmethod
+    def may_have_goal(user_message: str) -> bool:
+        """目標らしい発言か（False ならLLMに渡さない）"""
+        return _GOAL_KEYWORDS_RE.search(user_message) is not None
+    
     def extract_goal_from_text(self, user_message: str) -> Optional[Dict]:
         """
         会話から目標を抽出
         「3ヶ月後までに英語でプレゼンできるようになりたい」→ 目標化
         """
         
-        goal_keywords = [
-            "なりたい", "達成したい", "目指す", "目標",
-            "できるようになりたい", "マスターしたい"
-        ]
-        
-        has_goal = any(kw in user_message for kw in goal_keywords)
-        
-        if not has_goal:
+        if not self.may_have_goal(user_message):
             return None
         
-        prompt = f"""以下のメッセージから目標情報を抽出してください。
-
-メッセージ: {user_message}
-
-以下のJSON形式で返してください（JSONのみ）:
-{{
-  "has_goal": true/false,
-  "title": "目標のタイトル",
-  "description": "詳細説明",
-  "category": "skill/health/career/finance/hobby/personal",
-  "target_date": "YYYY-MM-DD形式または相対期間",
-  "estimated_months": 3,
-  "key_milestones": ["マイルストーン1", "マイルストーン2"]
-}}
-
-現在日付: {datetime.now().strftime('%Y-%m-%d')}
-"""
+        prompt = _GOAL_EXTRACT_TMPL.substitute(
+            today=request_now().date().isoformat(),
+            message=user_message
+        )
         
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.3}
+            content = _cached_chat(
+                self, self.extract_model, prompt, 0.3,
+                json_object=True, num_predict=_GOAL_EXTRACT_NUM_PREDICT
             )
             
-            content = response['message']['content']
+            return self._parse_goal(content)
             
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group())
-                return result if result.get("has_goal") else None
+        except Exception as e:
+            print(f"⚠️ 目標抽出エラー: {e}")
+        
+        return None
+    
+    async def aextract_goal_from_text(self, user_message: str) -> Optional[Dict]:
+        """extract_goal_from_text の非同期版（他のLLM呼び出しと並行できる）"""
+        
+        if not self.may_have_goal(user_message):
+            return None
+        
+        prompt = _GOAL_EXTRACT_TMPL.substitute(
+            today=request_now().date().isoformat(),
+            message=user_message
+        )
+        
+        try:
+            content = await _acached_chat(
+                self, self.extract_model, prompt, 0.3,
+                json_object=True, num_predict=_GOAL_EXTRACT_NUM_PREDICT
+            )
+            return self._parse_goal(content)
             
         except Exception as e:
             print(f"⚠️ 目標抽出エラー: {e}")
         
         return None
     
+    def _parse_goal(self, content: str) -> Optional[Dict]:
+        """目標抽出の応答を解析（目標でなければNone）"""
+        json_str = _extract_json(content)
+        if json_str:
+            return self.check_goal(json.loads(json_str))
+        return None
+    
+    @staticmethod
+    def check_goal(result) -> Optional[Dict]:
+        """
+        抽出した目標を検証（目標でない・登録に必要な項目がなければNone）
+        
+        title は空でない文字列、key_milestones は文字列のリストに揃える
+        """
+        if not isinstance(result, dict) or not result.get("has_goal"):
+            return None
+        
+        title = result.get("title")
+        if not isinstance(title, str) or not title.strip():
+            print("⚠️ 目標判定: タイトルがないため除外")
+            return None
+        
+        milestones = result.get("key_milestones")
+        result["key_milestones"] = [
+            m for m in milestones if isinstance(m, str) and m.strip()
+        ] if isinstance(milestones, list) else []
+        
+        return result
+    
     def create_goal_plan(self, goal_title: str, goal_description: str, months: int) -> Dict:
         """
         目標達成のための計画を生成
@@ -173,56 +918,51 @@ class GoalManager:
         - 必要なアクション
         """
         
-        prompt = f"""以下の目標を{months}ヶ月で達成するための計画を立ててください。
-
-目標: {goal_title}
-詳細: {goal_description}
-期間: {months}ヶ月
-
-以下のJSON形式で返してください（JSONのみ）:
-{{
-  "milestones": [
-    {{"month": 1, "title": "マイルストーン1", "description": "詳細"}},
-    {{"month": 2, "title": "マイルストーン2", "description": "詳細"}}
-  ],
-  "weekly_actions": [
-    "週次アクション1",
-    "週次アクション2"
-  ],
-  "key_habits": [
-    "習慣1",
-    "習慣2"
-  ],
-  "success_metrics": [
-    "成功指標1",
-    "成功指標2"
-  ],
-  "potential_challenges": [
-    "課題1",
-    "課題2"
-  ]
-}}
-"""
+        prompt = self._goal_plan_prompt(goal_title, goal_description, months)
         
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.6}
-            )
-            
-            content = response['message']['content']
+            content = _cached_chat(self, self.model, prompt, 0.6, json_object=True)
+            return self._parse_goal_plan(content)
             
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
+        except Exception as e:
+            print(f"⚠️ 計画生成エラー: {e}")
+        
+        return {"milestones": [], "weekly_actions": []}
+    
+    async def acreate_goal_plan(
+        self,
+        goal_title: str,
+        goal_description: str,
+        months: int
+    ) -> Dict:
+        """create_goal_plan の非同期版"""
+        
+        prompt = self._goal_plan_prompt(goal_title, goal_description, months)
+        
+        try:
+            content = await _acached_chat(
+                self, self.model, prompt, 0.6, json_object=True
+            )
+            return self._parse_goal_plan(content)
             
         except Exception as e:
             print(f"⚠️ 計画生成エラー: {e}")
         
         return {"milestones": [], "weekly_actions": []}
     
+    def _goal_plan_prompt(self, goal_title: str, goal_description: str, months: int) -> str:
+        """計画生成プロンプト"""
+        return _GOAL_PLAN_TMPL.substitute(
+            title=goal_title, description=goal_description, months=months
+        )
+    
+    def _parse_goal_plan(self, content: str) -> Dict:
+        """計画生成の応答を解析（JSONがなければ空の計画）"""
+        json_str = _extract_json(content)
+        if json_str:
+            return json.loads(json_str)
+        return {"milestones": [], "weekly_actions": []}
+    
     def add_milestone(
         self,
         goal_id: int,
@@ -231,61 +971,42 @@ class GoalManager:
         target_date: Optional[str] = None
     ) -> int:
         """マイルストーン追加"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            INSERT INTO milestones
-            (goal_id, title, description, target_date)
-            VALUES (?, ?, ?, ?)
-        """, (goal_id, title, description, target_date))
-        
-        milestone_id = c.lastrowid
-        self.conn.commit()
+        with self.batch() as conn:
+            c = conn.execute(
+                _SQL_INSERT_MILESTONE, (goal_id, title, description, target_date)
+            )
         
-        return milestone_id
+        return c.lastrowid
     
-    def complete_milestone(self, milestone_id: int) -> bool:
-        """マイルストーン達成"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            UPDATE milestones
-            SET completed = 1, completed_at = ?
-            WHERE id = ?
-        """, (datetime.now().isoformat(), milestone_id))
+    def add_milestones_bulk(self, goal_id: int, milestones: List[Dict]) -> int:
+        """
+        マイルストーンをまとめて追加（1トランザクション）
         
-        self.conn.commit()
+        Args:
+            goal_id: 目標ID
+            milestones: [{"title": ..., "description": ..., "target_date": ...}, ...]
         
-        # 目標の進捗率を更新
-        c.execute("SELECT goal_id FROM milestones WHERE id = ?", (milestone_id,))
-        row = c.fetchone()
-        if row:
-            self._update_goal_progress_from_milestones(row[0])
+        Returns:
+            追加した件数
+        """
+        rows = [
+            (goal_id, m["title"], m.get("description", ""), m.get("target_date"))
+            for m in milestones
+        ]
+        if rows:
+            with self.batch() as conn:
+                conn.executemany(_SQL_INSERT_MILESTONE, rows)
         
-        return c.rowcount > 0
+        return len(rows)
     
-    def _update_goal_progress_from_milestones(self, goal_id: int):
-        """マイルストーンの達成状況から目標の進捗率を計算"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            SELECT COUNT(*), SUM(completed)
-            FROM milestones
-            WHERE goal_id = ?
-        """, (goal_id,))
-        
-        total, completed = c.fetchone()
+    def complete_milestone(self, milestone_id: int) -> bool:
+        """マイルストーン達成（目標の進捗率はトリガーが同じトランザクションで更新）"""
+        with self.batch() as conn:
+            c = conn.execute(
+                _SQL_COMPLETE_MILESTONE, (_now_iso(), milestone_id)
+            )
         
-        if total > 0:
-            progress = int((completed / total) * 100)
-            
-            c.execute("""
-                UPDATE goals
-                SET progress_percentage = ?
-                WHERE id = ?
-            """, (progress, goal_id))
-            
-            self.conn.commit()
+        return c.rowcount > 0
     
     def update_goal_progress(
         self,
@@ -296,83 +1017,59 @@ class GoalManager:
         challenges: List[str] = None
     ) -> int:
         """目標の進捗を記録"""
-        c = self.conn.cursor()
-        
-        # 進捗ログ追加
-        c.execute("""
-            INSERT INTO goal_progress
-            (goal_id, timestamp, progress_percentage, notes, achievements, challenges)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            goal_id,
-            datetime.now().isoformat(),
-            progress_percentage,
-            notes,
-            json.dumps(achievements or []),
-            json.dumps(challenges or [])
-        ))
-        
-        progress_id = c.lastrowid
-        
-        # 目標の進捗率を更新
-        c.execute("""
-            UPDATE goals
-            SET progress_percentage = ?
-            WHERE id = ?
-        """, (progress_percentage, goal_id))
-        
-        # 100%達成したら完了にする
-        if progress_percentage >= 100:
-            c.execute("""
-                UPDATE goals
-                SET status = 'completed', completed_at = ?
-                WHERE id = ?
-            """, (datetime.now().isoformat(), goal_id))
-        
-        self.conn.commit()
+        now = _now_iso()
+        with self.batch() as conn:
+            # 進捗ログ追加
+            c = conn.execute(_SQL_INSERT_GOAL_PROGRESS, (
+                goal_id,
+                now,
+                progress_percentage,
+                notes,
+                # 空なら NULL（読み出し側は空リストとして扱う）
+                json.dumps(achievements) if achievements else None,
+                json.dumps(challenges) if challenges else None
+            ))
+            
+            # 目標の進捗率を更新（100%達成なら完了にする）
+            conn.execute(_SQL_UPDATE_GOAL_PROGRESS, (
+                progress_percentage, progress_percentage, progress_percentage,
+                now, goal_id
+            ))
         
-        return progress_id
+        return c.lastrowid
     
     def get_active_goals(self, user_id: str) -> List[Dict]:
-        """アクティブな目標一覧"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            SELECT id, title, description, category, target_date, 
-                   progress_percentage, created_at
-            FROM goals
-            WHERE user_id = ? AND status = 'active'
-            ORDER BY created_at DESC
-        """, (user_id,))
+        """アクティブな目標一覧（マイルストーンはJOINで同時に取得）"""
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.row_factory = sqlite3.Row
+            result = c.execute(
+                _SQL_ACTIVE_GOALS_WITH_MILESTONES, (user_id,)
+            ).fetchall()
         
         goals = []
-        for row in c.fetchall():
-            goal_id = row[0]
-            
-            # マイルストーン取得
-            c.execute("""
-                SELECT id, title, completed, target_date
-                FROM milestones
-                WHERE goal_id = ?
-                ORDER BY target_date ASC
-            """, (goal_id,))
+        for goal_id, rows in groupby(result, key=lambda r: r["id"]):
+            row = next(rows)
             
+            # マイルストーンがない目標は m.* が NULL の1行だけになる
             milestones = [
                 {
-                    "id": m[0], "title": m[1], 
-                    "completed": bool(m[2]), "target_date": m[3]
+                    "id": m["milestone_id"], "title": m["milestone_title"],
+                    "completed": bool(m["milestone_completed"]),
+                    "target_date": m["milestone_target_date"]
                 }
-                for m in c.fetchall()
+                for m in (row, *rows)
+                if m["milestone_id"] is not None
             ]
             
             goals.append({
                 "id": goal_id,
-                "title": row[1],
-                "description": row[2],
-                "category": row[3],
-                "target_date": row[4],
-                "progress_percentage": row[5],
-                "created_at": row[6],
+                "title": row["title"],
+                "description": row["description"],
+                "category": row["category"],
+                "target_date": row["target_date"],
+                "progress_percentage": row["progress_percentage"],
+                "created_at": row["created_at"],
                 "milestones": milestones
             })
         
@@ -382,24 +1079,37 @@ class GoalManager:
     
     def analyze_goal_progress(self, goal_id: int) -> Dict:
         """目標の進捗を分析"""
-        c = self.conn.cursor()
-        
-        # 目標情報取得
-        c.execute("""
-            SELECT title, created_at, target_date, progress_percentage
-            FROM goals
-            WHERE id = ?
-        """, (goal_id,))
-        
-        goal_info = c.fetchone()
-        if not goal_info:
-            return {}
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.row_factory = sqlite3.Row
+            
+            # 目標情報取得
+            c.execute("""
+                SELECT title, created_at, target_date, progress_percentage
+                FROM goals
+                WHERE id = ?
+            """, (goal_id,))
+            
+            goal_info = c.fetchone()
+            if not goal_info:
+                return {}
+            
+            # 進捗履歴取得
+            c.execute("""
+                SELECT timestamp AS date, progress_percentage AS progress, notes
+                FROM goal_progress
+                WHERE goal_id = ?
+                ORDER BY timestamp DESC
+                LIMIT 5
+            """, (goal_id,))
+            
+            recent_progress = [dict(r) for r in c]
         
         title, created_at, target_date, current_progress = goal_info
         
         # 経過時間計算
         start_date = datetime.fromisoformat(created_at)
-        today = datetime.now()
+        today = request_now()
         days_elapsed = (today - start_date).days
         
         # 予想到達日計算
@@ -416,20 +1126,6 @@ class GoalManager:
             status = "unknown"
             progress_gap = 0
         
-        # 進捗履歴取得
-        c.execute("""
-            SELECT timestamp, progress_percentage, notes
-            FROM goal_progress
-            WHERE goal_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 5
-        """, (goal_id,))
-        
-        recent_progress = [
-            {"date": r[0], "progress": r[1], "notes": r[2]}
-            for r in c.fetchall()
-        ]
-        
         return {
             "goal_id": goal_id,
             "title": title,
@@ -448,108 +1144,85 @@ class GoalManager:
         if not analysis:
             return "目標が見つかりません。"
         
-        prompt = f"""以下の目標の進捗を分析して、アドバイスをください。
-
-目標: {analysis['title']}
-現在の進捗: {analysis['current_progress']}%
-経過日数: {analysis['days_elapsed']}日
-ステータス: {analysis['status']}
-進捗ギャップ: {analysis['progress_gap']}%
-
-最近の進捗:
-{json.dumps(analysis['recent_progress'], ensure_ascii=False, indent=2)}
-
-以下の形式で簡潔に（3-4文で）回答してください:
-1. 現状の評価
-2. 具体的なアドバイス
-3. 励ましのメッセージ
-"""
-        
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.7}
+            return _cached_chat(
+                self, self.model, self._insights_prompt(analysis), 0.7
             )
             
-            return response['message']['content']
-            
         except Exception as e:
             print(f"⚠️ インサイト生成エラー: {e}")
+            return self._insights_fallback(analysis)
+    
+    async def agenerate_progress_insights(self, goal_id: int) -> str:
+        """generate_progress_insights の非同期版"""
+        
+        analysis = self.analyze_goal_progress(goal_id)
+        
+        if not analysis:
+            return "目標が見つかりません。"
+        
+        try:
+            return await _acached_chat(
+                self, self.model, self._insights_prompt(analysis), 0.7
+            )
             
-            # フォールバック
-            if analysis['status'] == 'ahead':
-                return f"素晴らしいペースです！予定より進んでいます。この調子で頑張りましょう。"
-            elif analysis['status'] == 'behind':
-                return f"少しペースを上げる必要があります。小さな一歩でも毎日続けることが大切です。"
-            else:
-                return f"順調に進んでいます。計画通りのペースを維持しましょう。"
+        except Exception as e:
+            print(f"⚠️ インサイト生成エラー: {e}")
+            return self._insights_fallback(analysis)
+    
+    async def bulk_insights(
+        self,
+        goal_ids: List[int],
+        max_concurrency: int = 4
+    ) -> Dict[int, str]:
+        """
+        複数の目標のインサイトを並行して生成
+        
+        Ollamaへの同時リクエスト数は max_concurrency までに抑える
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def one(goal_id: int) -> str:
+            async with semaphore:
+                return await self.agenerate_progress_insights(goal_id)
+        
+        results = await asyncio.gather(*(one(goal_id) for goal_id in goal_ids))
+        return dict(zip(goal_ids, results))
+    
+    def _insights_prompt(self, analysis: Dict) -> str:
+        """進捗インサイトのプロンプト"""
+        return _INSIGHT_TMPL.substitute(
+            title=analysis['title'],
+            progress=analysis['current_progress'],
+            days=analysis['days_elapsed'],
+            status=analysis['status'],
+            gap=analysis['progress_gap'],
+            recent=json.dumps(analysis['recent_progress'], ensure_ascii=False)
+        )
+    
+    def _insights_fallback(self, analysis: Dict) -> str:
+        """LLMが使えない場合のインサイト"""
+        if analysis['status'] == 'ahead':
+            return f"素晴らしいペースです！予定より進んでいます。この調子で頑張りましょう。"
+        elif analysis['status'] == 'behind':
+            return f"少しペースを上げる必要があります。小さな一歩でも毎日続けることが大切です。"
+        else:
+            return f"順調に進んでいます。計画通りのペースを維持しましょう。"
 
 
-class JournalSystem:
+class JournalSystem(_SqliteStore):
     """日記・記録システム"""
     
-    def __init__(self, db_connection, model: str = "qwen2.5:7b"):
-        self.conn = db_connection
+    def __init__(
+        self,
+        db_connection,
+        model: str = "qwen2.5:7b",
+        extract_model: str = "gemma3:4b"
+    ):
         self.model = model
-        if self.conn is not None:  # ← この行を追加
-            self._init_tables()
-    
-    def _init_tables(self):
-        """テーブル初期化"""
-        c = self.conn.cursor()
-        
-        # 日記テーブル
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS journal_entries (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                date TEXT NOT NULL,
-                entry_type TEXT DEFAULT 'daily',
-                content TEXT NOT NULL,
-                mood TEXT,
-                energy_level INTEGER,
-                highlights TEXT,
-                challenges TEXT,
-                gratitude TEXT,
-                tomorrow_plans TEXT,
-                created_at TEXT NOT NULL,
-                metadata TEXT
-            )
-        """)
-        
-        # アクティビティログ
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS activity_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                activity_type TEXT NOT NULL,
-                description TEXT,
-                duration_minutes INTEGER,
-                related_goal_id INTEGER,
-                notes TEXT
-            )
-        """)
-        
-        # 週次・月次振り返り
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS periodic_reviews (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                review_type TEXT NOT NULL,
-                period_start TEXT NOT NULL,
-                period_end TEXT NOT NULL,
-                content TEXT NOT NULL,
-                insights TEXT,
-                wins TEXT,
-                learnings TEXT,
-                next_actions TEXT,
-                created_at TEXT NOT NULL
-            )
-        """)
-        
-        self.conn.commit()
+        # JSON抽出だけの処理は小さいモデルで十分（文章の質が要る生成は model を使う）
+        self.extract_model = extract_model
+        super().__init__(db_connection)
     
     # ==================== 日記作成 ====================
     
@@ -565,27 +1238,18 @@ class JournalSystem:
         gratitude: List[str] = None
     ) -> int:
         """日記エントリ作成"""
-        c = self.conn.cursor()
-        
-        entry_date = date or datetime.now().date().isoformat()
-        
-        c.execute("""
-            INSERT INTO journal_entries
-            (user_id, date, content, mood, energy_level, highlights, 
-             challenges, gratitude, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id, entry_date, content, mood, energy_level,
-            json.dumps(highlights or []),
-            json.dumps(challenges or []),
-            json.dumps(gratitude or []),
-            datetime.now().isoformat()
-        ))
-        
-        entry_id = c.lastrowid
-        self.conn.commit()
-        
-        return entry_id
+        entry_date = date or request_now().date().isoformat()
+        
+        with self.batch() as conn:
+            c = conn.execute(_SQL_INSERT_JOURNAL_ENTRY, (
+                user_id, entry_date, content, mood, energy_level,
+                json.dumps(highlights or []),
+                json.dumps(challenges or []),
+                json.dumps(gratitude or []),
+                _now_iso()
+            ))
+        
+        return c.lastrowid
     
     def extract_journal_from_conversation(
         self,
@@ -595,14 +1259,16 @@ class JournalSystem:
         """
         会話履歴から日記を自動生成
         その日何をしたか、何を感じたかをAIが要約
+        
+        conversation_history は timestamp（ISO形式）の昇順に並んでいること
         """
         
-        # 今日の会話を抽出
-        today = datetime.now().date().isoformat()
-        today_conversations = [
-            c for c in conversation_history
-            if c.get("timestamp", "").startswith(today)
-        ]
+        # 今日の会話を抽出（今日の分は末尾にまとまっているので、後ろから辿る）
+        today = request_now().date().isoformat()
+        start = len(conversation_history)
+        while start > 0 and conversation_history[start - 1]["timestamp"] >= today:
+            start -= 1
+        today_conversations = conversation_history[start:start + 10]
         
         if not today_conversations:
             return {}
@@ -610,38 +1276,20 @@ class JournalSystem:
         # 会話をテキストに変換
         conversation_text = "\n".join([
             f"ユーザー: {c['user_message']}\nAI: {c['ai_response']}"
-            for c in today_conversations[:10]  # 最新10件
+            for c in today_conversations
         ])
         
-        prompt = f"""以下は今日のユーザーとの会話です。この会話から日記エントリを作成してください。
-
-{conversation_text}
-
-以下のJSON形式で返してください（JSONのみ）:
-{{
-  "summary": "今日の出来事の要約（3-4文）",
-  "mood": "happy/productive/tired/stressed/peaceful/excited",
-  "energy_level": 1-10,
-  "highlights": ["ハイライト1", "ハイライト2"],
-  "challenges": ["課題1", "課題2"],
-  "achievements": ["達成したこと1", "達成したこと2"],
-  "gratitude": ["感謝すること1", "感謝すること2"]
-}}
-"""
+        prompt = _JOURNAL_TMPL.substitute(conversations=conversation_text)
         
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.6}
+            content = _cached_chat(
+                self, self.extract_model, prompt, 0.6,
+                json_object=True, num_predict=_JOURNAL_EXTRACT_NUM_PREDICT
             )
             
-            content = response['message']['content']
-            
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
+            json_str = _extract_json(content)
+            if json_str:
+                return json.loads(json_str)
             
         except Exception as e:
             print(f"⚠️ 日記生成エラー: {e}")
@@ -650,122 +1298,86 @@ class JournalSystem:
     
     def get_journal_entry(self, user_id: str, date: Optional[str] = None) -> Optional[Dict]:
         """特定日の日記取得"""
-        c = self.conn.cursor()
-        
-        target_date = date or datetime.now().date().isoformat()
-        
-        c.execute("""
-            SELECT id, date, content, mood, energy_level, 
-                   highlights, challenges, gratitude
-            FROM journal_entries
-            WHERE user_id = ? AND date = ?
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (user_id, target_date))
-        
-        row = c.fetchone()
+        target_date = date or request_now().date().isoformat()
+        
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.row_factory = sqlite3.Row
+            row = c.execute("""
+                SELECT id, date, content, mood, energy_level, 
+                       highlights, challenges, gratitude
+                FROM journal_entries
+                WHERE user_id = ? AND date = ?
+                ORDER BY created_at DESC
+                LIMIT 1
+            """, (user_id, target_date)).fetchone()
         
         if not row:
             return None
         
-        return {
-            "id": row[0],
-            "date": row[1],
-            "content": row[2],
-            "mood": row[3],
-            "energy_level": row[4],
-            "highlights": json.loads(row[5]) if row[5] else [],
-            "challenges": json.loads(row[6]) if row[6] else [],
-            "gratitude": json.loads(row[7]) if row[7] else []
-        }
+        entry = dict(row)
+        for key in ("highlights", "challenges", "gratitude"):
+            entry[key] = json.loads(entry[key]) if entry[key] else []
+        return entry
     
     def get_recent_entries(self, user_id: str, days: int = 7) -> List[Dict]:
         """最近の日記エントリ取得"""
-        c = self.conn.cursor()
-        
-        start_date = (datetime.now().date() - timedelta(days=days)).isoformat()
-        
-        c.execute("""
-            SELECT id, date, content, mood, energy_level
-            FROM journal_entries
-            WHERE user_id = ? AND date >= ?
-            ORDER BY date DESC
-        """, (user_id, start_date))
-        
-        return [
-            {
-                "id": r[0], "date": r[1], "content": r[2],
-                "mood": r[3], "energy_level": r[4]
-            }
-            for r in c.fetchall()
-        ]
+        start_date = (request_now().date() - timedelta(days=days)).isoformat()
+        
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.row_factory = sqlite3.Row
+            c.execute("""
+                SELECT id, date, content, mood, energy_level
+                FROM journal_entries
+                WHERE user_id = ? AND date >= ?
+                ORDER BY date DESC
+            """, (user_id, start_date))
+            
+            return [dict(r) for r in c]
     
     # ==================== 振り返り ====================
     
     def create_weekly_review(self, user_id: str) -> Dict:
         """週次振り返りを生成"""
         
-        # 過去7日間の日記取得
-        entries = self.get_recent_entries(user_id, days=7)
+        now = request_now()
+        week_start = (now.date() - timedelta(days=7)).isoformat()
+        week_end = now.date().isoformat()
         
-        if not entries:
+        # 過去7日間の日記（要約済みの文字列としてSQLで組み立てる）
+        with self._connection() as conn:
+            entries_summary = conn.execute(
+                _SQL_WEEKLY_REVIEW_ENTRIES, (user_id, week_start)
+            ).fetchone()[0]
+        
+        if not entries_summary:
             return {"message": "この週は日記エントリがありません。"}
         
         # AIに分析させる
-        entries_summary = "\n".join([
-            f"{e['date']}: {e['mood']} (エネルギー: {e['energy_level']}/10)"
-            for e in entries
-        ])
-        
-        prompt = f"""以下は過去1週間の日記データです。週次振り返りを作成してください。
-
-{entries_summary}
-
-以下のJSON形式で返してください（JSONのみ）:
-{{
-  "overall_mood": "全体的な気分",
-  "highlights": ["今週のハイライト1", "ハイライト2"],
-  "patterns": ["気づいたパターン1", "パターン2"],
-  "improvements": ["改善できること1", "改善できること2"],
-  "next_week_focus": ["来週の焦点1", "焦点2"],
-  "encouragement": "励ましのメッセージ"
-}}
-"""
+        prompt = _WEEKLY_REVIEW_TMPL.substitute(entries=entries_summary)
         
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.7}
-            )
+            content = _cached_chat(self, self.model, prompt, 0.7, json_object=True)
             
-            content = response['message']['content']
-            
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                review = json.loads(json_match.group())
+            json_str = _extract_json(content)
+            if json_str:
+                review = json.loads(json_str)
                 
                 # DBに保存
-                c = self.conn.cursor()
-                
-                week_start = (datetime.now().date() - timedelta(days=7)).isoformat()
-                week_end = datetime.now().date().isoformat()
-                
-                c.execute("""
-                    INSERT INTO periodic_reviews
-                    (user_id, review_type, period_start, period_end, 
-                     content, insights, wins, created_at)
-                    VALUES (?, 'weekly', ?, ?, ?, ?, ?, ?)
-                """, (
-                    user_id, week_start, week_end,
-                    json.dumps(review, ensure_ascii=False),
-                    json.dumps(review.get("patterns", [])),
-                    json.dumps(review.get("highlights", [])),
-                    datetime.now().isoformat()
-                ))
-                
-                self.conn.commit()
+                with self.batch() as conn:
+                    conn.execute("""
+                        INSERT INTO periodic_reviews
+                        (user_id, review_type, period_start, period_end, 
+                         content, insights, wins, created_at)
+                        VALUES (?, 'weekly', ?, ?, ?, ?, ?, ?)
+                    """, (
+                        user_id, week_start, week_end,
+                        json.dumps(review, ensure_ascii=False),
+                        json.dumps(review.get("patterns", [])),
+                        json.dumps(review.get("highlights", [])),
+                        now.isoformat()
+                    ))
                 
                 return review
             
@@ -783,55 +1395,34 @@ class JournalSystem:
         related_goal_id: Optional[int] = None
     ) -> int:
         """アクティビティをログ"""
-        c = self.conn.cursor()
-        
-        c.execute("""
-            INSERT INTO activity_log
-            (user_id, timestamp, activity_type, description, 
-             duration_minutes, related_goal_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            user_id, datetime.now().isoformat(), activity_type,
-            description, duration_minutes, related_goal_id
-        ))
+        with self.batch() as conn:
+            c = conn.execute(_SQL_INSERT_ACTIVITY, (
+                user_id, _now_iso(), activity_type,
+                description, duration_minutes, related_goal_id
+            ))
         
-        activity_id = c.lastrowid
-        self.conn.commit()
-        
-        return activity_id
+        return c.lastrowid
     
     def get_activity_summary(self, user_id: str, days: int = 7) -> Dict:
         """アクティビティサマリー"""
-        c = self.conn.cursor()
-        
-        start_date = (datetime.now() - timedelta(days=days)).isoformat()
-        
-        # アクティビティタイプ別の集計
-        c.execute("""
-            SELECT activity_type, COUNT(*), SUM(duration_minutes)
-            FROM activity_log
-            WHERE user_id = ? AND timestamp >= ?
-            GROUP BY activity_type
-            ORDER BY COUNT(*) DESC
-        """, (user_id, start_date))
-        
-        activities = {}
-        for row in c.fetchall():
-            activities[row[0]] = {
-                "count": row[1],
-                "total_minutes": row[2] or 0
-            }
+        start_date = (request_now() - timedelta(days=days)).isoformat()
+        
+        # アクティビティタイプ別の集計（JSONオブジェクトとして1行で受け取る）
+        with self._connection() as conn:
+            row = conn.execute(
+                _SQL_ACTIVITY_SUMMARY, (user_id, start_date)
+            ).fetchone()
         
         return {
             "period_days": days,
-            "activities": activities
+            "activities": json.loads(row[0] or "{}")
         }
 
 
 # ==================== 使用例 ====================
 
 if __name__ == "__main__":
-    conn = sqlite3.connect("partner_ai.db")
+    conn = sqlite3.connect("partner_ai.db", cached_statements=256)
     
     goal_mgr = GoalManager(conn)
     journal_sys = JournalSystem(conn)
@@ -858,6 +1449,10 @@ if __name__ == "__main__":
     
     print(f"📋 計画:\n{json.dumps(plan, ensure_ascii=False, indent=2)}")
     
+    # 計画のマイルストーンを一括登録
+    added = goal_mgr.add_milestones_bulk(goal_id, plan.get("milestones", []))
+    print(f"🏁 マイルストーン追加: {added}件")
+    
     # 日記作成
     entry_id = journal_sys.create_journal_entry(
         user_id=user_id,
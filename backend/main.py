@@ -3,11 +3,11 @@
 FastAPI + Ollama + SQLite
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict
-import ollama
 import sqlite3
 import json
 from datetime import datetime
@@ -17,11 +17,14 @@ import asyncio
 # 全てのインポート
 from analyzer import ConversationAnalyzer, ProfileManager
 from rag_system import RAGSystem, SelfImprovementSystem
+from response_cache import ResponseCache
 from finetuning import FineTuningSystem
 from schedule_manager import ScheduleManager
 from assistant_brain import AssistantBrain
-from goal_journal_system import GoalManager, JournalSystem
+from goal_journal_system import GoalManager, JournalSystem, SqlitePool
 from active_partner_system import ConversationInitiator, MessagePriority
+from request_context import bind_request_now, reset_request_now
+from _ollama_pool import async_client
 
 # FastAPIアプリ初期化
 app = FastAPI(title="パートナーAI API")
@@ -35,6 +38,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def bind_request_time(request: Request, call_next):
+    """リクエスト開始時刻を固定（各モジュールは request_now() で参照）"""
+    token = bind_request_now()
+    try:
+        return await call_next(request)
+    finally:
+        reset_request_now(token)
+
 # データベースファイル
 DB_PATH = "partner_ai.db"
 
@@ -46,6 +59,7 @@ assistant_brain = None
 goal_manager = None
 journal_system = None
 conversation_initiator = None
+response_cache = None
 
 # ==================== データベース初期化 ====================
 
@@ -79,6 +93,18 @@ def init_db():
         )
     """)
     
+    # 履歴・統計用の索引（finetuning.py / active_partner_system.py と同じ定義）
+    # WHERE user_id = ? ORDER BY timestamp DESC を索引の逆順走査だけで処理する
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_ts
+        ON conversations(user_id, timestamp)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_rating
+        ON conversations(user_id, rating)
+    """)
+    c.execute("ANALYZE conversations")
+    
     conn.commit()
     conn.close()
     print("✅ データベース初期化完了")
@@ -86,11 +112,16 @@ def init_db():
 # アプリ起動時に実行
 init_db()
 
+# 全エンドポイントと目標・日記システムが共有する接続プール
+# リクエストごとに接続を開閉せず、WAL設定とページキャッシュを使い回す
+db_pool = SqlitePool(DB_PATH)
+
 
 # グローバルインスタンス
 analyzer = ConversationAnalyzer(model="gemma3:4b")
 rag_system = RAGSystem(persist_directory="./chroma_db")
 print(f"✅ RAGシステム初期化完了")
+tuning_system = FineTuningSystem(DB_PATH)
 
 # ==================== Pydanticモデル ====================
 
@@ -123,12 +154,52 @@ class FineTuneRequest(BaseModel):
 
 def get_user_profile(user_id: str) -> Dict:
     """ユーザープロファイル取得"""
-    conn = sqlite3.connect(DB_PATH)
-    profile_manager = ProfileManager(conn)
-    profile = profile_manager.get_profile(user_id)
-    conn.close()
+    with db_pool.acquire() as conn:
+        profile_manager = ProfileManager(conn)
+        profile = profile_manager.get_profile(user_id)
     return profile
 
+def update_user_profile(user_id: str, analysis: Dict, conversations: int = 1):
+    """会話の分析結果でプロファイルを更新"""
+    with db_pool.acquire() as conn:
+        profile_manager = ProfileManager(conn)
+        profile_manager.update_profile(user_id, analysis, conversations)
+
+# プロファイル更新をまとめる待ち時間（秒）
+PROFILE_UPDATE_DELAY_SECONDS = 30
+
+# ユーザーID -> 分析待ちの (ユーザーメッセージ, AI応答)
+_pending_profile_updates: Dict[str, List[tuple]] = {}
+
+async def update_profile_in_background(user_id: str, user_message: str, ai_response: str):
+    """
+    会話の分析とプロファイル更新（応答を返した後に BackgroundTasks で実行）
+    
+    同じユーザーの会話が待ち時間内に続いた場合は、まとめて1回だけ分析する
+    """
+    pending = _pending_profile_updates.get(user_id)
+    if pending is not None:
+        # 先に待っているタスクがまとめて処理する
+        pending.append((user_message, ai_response))
+        return
+    
+    pending = _pending_profile_updates[user_id] = [(user_message, ai_response)]
+    await asyncio.sleep(PROFILE_UPDATE_DELAY_SECONDS)
+    del _pending_profile_updates[user_id]
+    
+    # 待っている間に経過した分、時刻を取り直す
+    token = bind_request_now()
+    try:
+        analysis = await analyzer.aanalyze_conversation(
+            "\n".join(u for u, _ in pending),
+            "\n".join(a for _, a in pending)
+        )
+        await asyncio.to_thread(update_user_profile, user_id, analysis, len(pending))
+    except Exception as e:
+        print(f"⚠️ プロファイル更新エラー: {e}")
+    finally:
+        reset_request_now(token)
+
 def save_conversation(
     user_id: str,
     user_msg: str,
@@ -137,39 +208,115 @@ def save_conversation(
     metadata: Dict = None
 ) -> int:
     """会話を保存"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    timestamp = datetime.now().isoformat()
-    metadata_json = json.dumps(metadata, ensure_ascii=False) if metadata else "{}"
-    
-    c.execute("""
-        INSERT INTO conversations 
-        (user_id, timestamp, user_message, ai_response, model_used, metadata)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (user_id, timestamp, user_msg, ai_msg, model, metadata_json))
-    
-    conv_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        timestamp = datetime.now().isoformat()
+        metadata_json = json.dumps(metadata, ensure_ascii=False) if metadata else "{}"
+        
+        c.execute("""
+            INSERT INTO conversations 
+            (user_id, timestamp, user_message, ai_response, model_used, metadata)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, timestamp, user_msg, ai_msg, model, metadata_json))
+        
+        conv_id = c.lastrowid
+        conn.commit()
     
     return conv_id
 
+def fetch_history_rows(user_id: str, limit: int) -> List[tuple]:
+    """会話履歴の行を新しい順に取得（/api/history 用）"""
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        c.execute("""
+            SELECT id, timestamp, user_message, ai_response, model_used, rating, metadata
+            FROM conversations
+            WHERE user_id = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        """, (user_id, limit))
+        
+        return c.fetchall()
+
+def save_feedback(req: FeedbackRequest):
+    """フィードバックを保存し、低評価なら自己改良を実行"""
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        c.execute("SELECT metadata FROM conversations WHERE id = ?", (req.conversation_id,))
+        row = c.fetchone()
+        
+        metadata = json.loads(row[0]) if row and row[0] else {}
+        
+        metadata["feedback_rating"] = req.rating
+        if req.comment:
+            metadata["feedback_comment"] = req.comment
+        metadata["feedback_timestamp"] = datetime.now().isoformat()
+        
+        c.execute("""
+            UPDATE conversations
+            SET rating = ?, metadata = ?
+            WHERE id = ?
+        """, (req.rating, json.dumps(metadata, ensure_ascii=False), req.conversation_id))
+        
+        conn.commit()
+        
+        if req.rating <= 2:
+            c.execute("SELECT user_id FROM conversations WHERE id = ?", (req.conversation_id,))
+            user_row = c.fetchone()
+            
+            if user_row:
+                user_id = user_row[0]
+                improvement_system = SelfImprovementSystem(conn)
+                improvements = improvement_system.analyze_feedback(user_id)
+                
+                if improvements["suggestions"]:
+                    improvement_system.apply_improvements(user_id, improvements)
+                    print(f"✅ 自己改良実行: {improvements['suggestions']}")
+
+def fetch_user_stats(user_id: str) -> tuple:
+    """会話数・平均評価・最多使用モデルを取得"""
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        c.execute("SELECT COUNT(*) FROM conversations WHERE user_id = ?", (user_id,))
+        total_conversations = c.fetchone()[0]
+        
+        c.execute("""
+            SELECT AVG(rating) 
+            FROM conversations 
+            WHERE user_id = ? AND rating IS NOT NULL
+        """, (user_id,))
+        avg_rating = c.fetchone()[0] or 0
+        
+        c.execute("""
+            SELECT model_used, COUNT(*) as count
+            FROM conversations
+            WHERE user_id = ?
+            GROUP BY model_used
+            ORDER BY count DESC
+            LIMIT 1
+        """, (user_id,))
+        most_used_model = c.fetchone()
+        
+        return total_conversations, avg_rating, most_used_model
+
 def get_recent_history(user_id: str, limit: int = 5) -> List[Dict]:
     """最近の会話履歴を取得"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute("""
-        SELECT user_message, ai_response, timestamp
-        FROM conversations
-        WHERE user_id = ?
-        ORDER BY timestamp DESC
-        LIMIT ?
-    """, (user_id, limit))
-    
-    rows = c.fetchall()
-    conn.close()
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        c.execute("""
+            SELECT user_message, ai_response, timestamp
+            FROM conversations
+            WHERE user_id = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        """, (user_id, limit))
+        
+        rows = c.fetchall()
     
     history = []
     for row in reversed(rows):  # 古い順に並べ替え
@@ -182,11 +329,17 @@ def get_recent_history(user_id: str, limit: int = 5) -> List[Dict]:
     return history
 
 def build_system_prompt(profile: Dict) -> str:
-    """ユーザープロファイルからシステムプロンプト生成"""
+    """
+    ユーザープロファイルからシステムプロンプト生成
+    
+    Ollamaは前回と先頭が一致する部分のKVキャッシュを再利用するので、
+    プロフィールが実質変わらなければ同じ文字列になるようにする
+    （興味は件数順だと順位の入れ替わりで変わるため名前順にする）
+    """
     base = "あなたは親しみやすく、有能なAIアシスタントです。\n"
     
     if profile.get("interests"):
-        interests = ", ".join(profile["interests"])
+        interests = ", ".join(sorted(profile["interests"]))
         base += f"\nユーザーは以下のトピックに興味があります: {interests}\n"
     
     if profile.get("memories"):
@@ -232,73 +385,76 @@ async def root():
         "version": "1.0.0"
     }
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
+async def build_chat_messages(req: ChatRequest) -> tuple:
     """
-    チャットAPI - 高性能版
-    スケジュール・タスク・目標を自動抽出して登録
+    チャットの入力メッセージを組み立てる
+    
+    Returns:
+        (LLMに渡すメッセージ, 発言の埋め込み, 関連する記憶)
     """
-    try:
-        profile = get_user_profile(req.user_id)
-        history = get_recent_history(req.user_id, limit=5)
-        
-        relevant_memories = rag_system.search_relevant_memories(
-            user_id=req.user_id,
-            query=req.message,
-            n_results=3
-        )
-        
-        system_prompt = build_system_prompt(profile)
-        
-        if relevant_memories:
-            system_prompt += "\n\n過去の関連する会話:\n"
-            for mem in relevant_memories:
-                system_prompt += f"- {mem['user_message'][:100]}...\n"
-        
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        for h in history:
-            messages.append({"role": "user", "content": h["user"]})
-            messages.append({"role": "assistant", "content": h["ai"]})
-        
-        messages.append({"role": "user", "content": req.message})
-        
-        print(f"🤖 モデル {req.model} で推論中...")
-        response = ollama.chat(
-            model=req.model,
-            messages=messages,
-            options={
-                "temperature": 0.7,
-                "num_ctx": 8192,
-            }
+    # SQLite・埋め込み・ChromaDBは同期APIなので、スレッドで実行してイベントループを止めない
+    profile, history, query_embedding = await asyncio.gather(
+        asyncio.to_thread(get_user_profile, req.user_id),
+        asyncio.to_thread(get_recent_history, req.user_id, 5),
+        # 埋め込みは記憶検索と応答キャッシュで共用する
+        asyncio.to_thread(response_cache.embed, req.message)
+    )
+    
+    relevant_memories = await asyncio.to_thread(
+        rag_system.search_relevant_memories,
+        user_id=req.user_id,
+        query=req.message,
+        n_results=3,
+        query_embedding=query_embedding
+    )
+    
+    system_prompt = build_system_prompt(profile)
+    
+    # 発言ごとに変わる関連記憶はシステムプロンプトではなく最後のユーザー発言に付ける
+    # （システムプロンプトと履歴の先頭が前回と一致し、Ollamaのプレフィックスキャッシュが効く）
+    user_content = req.message
+    if relevant_memories:
+        memory_lines = "".join(
+            f"- {mem['user_message'][:100]}...\n"
+            for mem in sorted(relevant_memories, key=lambda m: m['user_message'])
         )
-        
-        ai_response = response['message']['content']
-        tags = analyzer.extract_topics_simple(f"{req.message} {ai_response}")
-        
-        metadata = {
-            "tags": tags,
-            "relevant_memories_count": len(relevant_memories),
-            "auto_extractions": []  # 自動抽出した項目を記録
-        }
-        
-        # ==================== 自動抽出処理 ====================
-        
-        conn = sqlite3.connect(DB_PATH)
+        user_content = f"過去の関連する会話:\n{memory_lines}\n{req.message}"
+    
+    messages = [{"role": "system", "content": system_prompt}]
+    
+    for h in history:
+        messages.append({"role": "user", "content": h["user"]})
+        messages.append({"role": "assistant", "content": h["ai"]})
+    
+    messages.append({"role": "user", "content": user_content})
+    
+    return messages, query_embedding, relevant_memories
+
+def register_extractions(
+    user_id: str,
+    schedule_data: Optional[Dict],
+    task_data: Optional[Dict],
+    goal_data: Optional[Dict]
+) -> tuple:
+    """
+    自動抽出した予定・タスク・目標を登録する（同期処理なのでスレッドで呼ぶ）
+    
+    Returns:
+        (登録した項目のリスト, 応答に追記するメッセージのリスト)
+    """
+    auto_extractions = []  # 自動抽出した項目を記録
+    extraction_messages = []  # 追加メッセージを格納
+    
+    with db_pool.acquire() as conn:
         schedule_manager.conn = conn
-        goal_manager.conn = conn
-        
-        extraction_messages = []  # 追加メッセージを格納
         
         # 🔍 1. スケジュール抽出
         try:
-            schedule_data = schedule_manager.extract_schedule_from_text(req.message)
-            
             if schedule_data and schedule_data.get("has_schedule"):
                 print(f"📅 スケジュール検出: {schedule_data['title']}")
                 
                 schedule_id = schedule_manager.create_schedule(
-                    user_id=req.user_id,
+                    user_id=user_id,
                     title=schedule_data['title'],
                     start_time=schedule_data['start_time'],
                     end_time=schedule_data.get('end_time'),
@@ -307,7 +463,7 @@ async def chat(req: ChatRequest):
                     attendees=schedule_data.get('attendees', [])
                 )
                 
-                metadata["auto_extractions"].append({
+                auto_extractions.append({
                     "type": "schedule",
                     "id": schedule_id,
                     "title": schedule_data['title']
@@ -321,31 +477,20 @@ async def chat(req: ChatRequest):
         
         # 🔍 2. タスク抽出
         try:
-            task_data = schedule_manager.extract_task_from_text(req.message)
-            
             if task_data and task_data.get("has_task"):
                 print(f"✅ タスク検出: {task_data['title']}")
                 
                 task_id = schedule_manager.create_task(
-                    user_id=req.user_id,
+                    user_id=user_id,
                     title=task_data['title'],
                     description=task_data.get('description', ''),
                     due_date=task_data.get('due_date'),
                     priority=task_data.get('priority', 'medium'),
-                    estimated_minutes=task_data.get('estimated_minutes')
+                    estimated_minutes=task_data.get('estimated_minutes'),
+                    subtasks=task_data.get('subtasks')
                 )
                 
-                # サブタスクがあれば追加
-                if task_data.get('subtasks'):
-                    c = conn.cursor()
-                    for subtask_title in task_data['subtasks']:
-                        c.execute("""
-                            INSERT INTO subtasks (task_id, title)
-                            VALUES (?, ?)
-                        """, (task_id, subtask_title))
-                    conn.commit()
-                
-                metadata["auto_extractions"].append({
+                auto_extractions.append({
                     "type": "task",
                     "id": task_id,
                     "title": task_data['title'],
@@ -366,28 +511,21 @@ async def chat(req: ChatRequest):
         
         # 🔍 3. 目標抽出
         try:
-            goal_data = goal_manager.extract_goal_from_text(req.message)
-            
             if goal_data and goal_data.get("has_goal"):
                 print(f"🎯 目標検出: {goal_data['title']}")
                 
                 goal_id = goal_manager.create_goal(
-                    user_id=req.user_id,
+                    user_id=user_id,
                     title=goal_data['title'],
                     description=goal_data.get('description', ''),
                     category=goal_data.get('category', 'personal'),
-                    target_date=goal_data.get('target_date')
+                    target_date=goal_data.get('target_date'),
+                    milestones=[
+                        {"title": title} for title in goal_data.get('key_milestones') or []
+                    ]
                 )
                 
-                # マイルストーンがあれば追加
-                if goal_data.get('key_milestones'):
-                    for milestone_title in goal_data['key_milestones']:
-                        goal_manager.add_milestone(
-                            goal_id=goal_id,
-                            title=milestone_title
-                        )
-                
-                metadata["auto_extractions"].append({
+                auto_extractions.append({
                     "type": "goal",
                     "id": goal_id,
                     "title": goal_data['title']
@@ -398,44 +536,139 @@ async def chat(req: ChatRequest):
                 )
         except Exception as e:
             print(f"⚠️ 目標抽出エラー: {e}")
-        
-        # 接続をクリア
-        conn.close()
-        schedule_manager.conn = None
-        goal_manager.conn = None
-        
-        # AI応答に抽出結果を追記
-        if extraction_messages:
-            ai_response += "\n\n" + "\n".join(extraction_messages)
-        
-        # ==================== 会話保存 ====================
-        
-        conv_id = save_conversation(
-            user_id=req.user_id,
-            user_msg=req.message,
-            ai_msg=ai_response,
-            model=req.model,
-            metadata=metadata
+    
+    # 接続をクリア（スレッドごとの接続なので他のリクエストには影響しない）
+    schedule_manager.conn = None
+    
+    return auto_extractions, extraction_messages
+
+async def finish_chat(
+    req: ChatRequest,
+    ai_response: str,
+    extracted: Optional[Dict],
+    relevant_memories: List[Dict],
+    background_tasks: BackgroundTasks
+) -> tuple:
+    """
+    応答生成後の処理（自動抽出した項目の登録・会話保存）
+    
+    Args:
+        extracted: aextract_all の結果（抽出しなかった場合はNone）
+    
+    Returns:
+        (会話ID, 抽出結果を追記した応答, タグ)
+    """
+    schedule_data = extracted["schedule"] if extracted else None
+    task_data = extracted["task"] if extracted else None
+    goal_data = extracted["goal"] if extracted else None
+    
+    tags = analyzer.extract_topics_simple(f"{req.message} {ai_response}")
+    
+    metadata = {
+        "tags": tags,
+        "relevant_memories_count": len(relevant_memories),
+        "auto_extractions": []  # 自動抽出した項目を記録
+    }
+    
+    # ==================== 自動抽出処理 ====================
+    
+    if schedule_data or task_data or goal_data:
+        metadata["auto_extractions"], extraction_messages = await asyncio.to_thread(
+            register_extractions, req.user_id, schedule_data, task_data, goal_data
         )
-        
-        # RAGに追加
-        rag_system.add_memory(
-            user_id=req.user_id,
-            conversation_id=conv_id,
-            user_message=req.message,
-            ai_response=ai_response,
-            metadata={"tags": tags}
+    else:
+        extraction_messages = []
+    
+    # AI応答に抽出結果を追記
+    if extraction_messages:
+        ai_response += "\n\n" + "\n".join(extraction_messages)
+    
+    # ==================== 会話保存 ====================
+    
+    conv_id = await asyncio.to_thread(
+        save_conversation,
+        user_id=req.user_id,
+        user_msg=req.message,
+        ai_msg=ai_response,
+        model=req.model,
+        metadata=metadata
+    )
+    
+    # RAGへの追加とプロファイル更新は応答を返した後に行う
+    background_tasks.add_task(
+        rag_system.add_memory,
+        user_id=req.user_id,
+        conversation_id=conv_id,
+        user_message=req.message,
+        ai_response=ai_response,
+        metadata={"tags": tags}
+    )
+    
+    background_tasks.add_task(
+        update_profile_in_background, req.user_id, req.message, ai_response
+    )
+    
+    return conv_id, ai_response, tags
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest, background_tasks: BackgroundTasks):
+    """
+    チャットAPI - 高性能版
+    スケジュール・タスク・目標を自動抽出して登録
+    """
+    try:
+        messages, query_embedding, relevant_memories = await build_chat_messages(req)
+        
+        # 予定・タスク・目標を含みうる発言は応答キャッシュを使わない
+        use_cache = not ResponseCache.may_extract(req.message, goal_manager)
+        # messages は [システムプロンプト, 履歴..., 今回の発言]
+        system_prompt = messages[0]["content"]
+        cache_key = ResponseCache.make_key(
+            req.user_id, req.model, system_prompt, req.message
+        )
+        cache_context = ResponseCache.make_context(system_prompt, messages[1:-1])
+        cached_response = (
+            await asyncio.to_thread(
+                response_cache.get,
+                cache_key, cache_context, req.user_id, req.model, query_embedding
+            )
+            if use_cache else None
         )
         
-        # プロファイル更新
-        try:
-            analysis = analyzer.analyze_conversation(req.message, ai_response)
-            conn = sqlite3.connect(DB_PATH)
-            profile_manager = ProfileManager(conn)
-            profile_manager.update_profile(req.user_id, analysis)
-            conn.close()
-        except Exception as e:
-            print(f"⚠️ プロファイル更新エラー: {e}")
+        if cached_response is not None:
+            print("⚡ 応答キャッシュを使用")
+            ai_response = cached_response
+            extracted = None
+        else:
+            print(f"🤖 モデル {req.model} で推論中...")
+            
+            # 応答生成と自動抽出は互いに独立なので並行して待つ
+            # （Ollama側で OLLAMA_NUM_PARALLEL を上げておくと同時に処理される）
+            # 抽出側は失敗しても None を返すので、ここで例外になるのは応答生成だけ
+            response, extracted = await asyncio.gather(
+                async_client.chat(
+                    model=req.model,
+                    messages=messages,
+                    options={
+                        "temperature": 0.7,
+                        "num_ctx": 8192,
+                    }
+                ),
+                schedule_manager.aextract_all(req.message, goal_manager)
+            )
+            
+            ai_response = response['message']['content']
+            
+            if use_cache:
+                await asyncio.to_thread(
+                    response_cache.put,
+                    cache_key, cache_context, req.user_id, req.model,
+                    req.message, query_embedding, ai_response
+                )
+        
+        conv_id, ai_response, tags = await finish_chat(
+            req, ai_response, extracted, relevant_memories, background_tasks
+        )
         
         return ChatResponse(
             conversation_id=conv_id,
@@ -451,23 +684,83 @@ async def chat(req: ChatRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+def _sse_event(data: Dict) -> str:
+    """Server-Sent Events の1イベント（改行を含む本文もJSONで1行にする）"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest, background_tasks: BackgroundTasks):
+    """
+    チャットAPI - ストリーミング版
+    
+    応答をトークンごとに Server-Sent Events で送り、生成が終わってから
+    自動抽出した項目の登録と会話保存を行う。イベントは次の3種類:
+    - {"type": "token", "content": ...}: 応答の断片
+    - {"type": "done", "conversation_id": ..., "extras": ..., "tags": [...]}:
+      extras は応答の末尾に追記した自動抽出の結果
+    - {"type": "error", "detail": ...}
+    """
+    try:
+        messages, _, relevant_memories = await build_chat_messages(req)
+    except Exception as e:
+        print(f"❌ エラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    async def event_stream():
+        # 自動抽出は応答の生成と並行して進める
+        extraction = asyncio.create_task(
+            schedule_manager.aextract_all(req.message, goal_manager)
+        )
+        chunks = []
+        
+        try:
+            print(f"🤖 モデル {req.model} でストリーミング推論中...")
+            
+            async for part in await async_client.chat(
+                model=req.model,
+                messages=messages,
+                stream=True,
+                options={
+                    "temperature": 0.7,
+                    "num_ctx": 8192,
+                }
+            ):
+                content = part['message']['content']
+                if content:
+                    chunks.append(content)
+                    yield _sse_event({"type": "token", "content": content})
+            
+            ai_response = "".join(chunks)
+            extracted = await extraction
+            
+            conv_id, full_response, tags = await finish_chat(
+                req, ai_response, extracted, relevant_memories, background_tasks
+            )
+            
+            yield _sse_event({
+                "type": "done",
+                "conversation_id": conv_id,
+                "extras": full_response[len(ai_response):],
+                "model_used": req.model,
+                "timestamp": datetime.now().isoformat(),
+                "tags": tags
+            })
+            
+        except Exception as e:
+            print(f"❌ ストリーミングエラー: {str(e)}")
+            yield _sse_event({"type": "error", "detail": str(e)})
+        finally:
+            # クライアントの切断（GeneratorExit / CancelledError）でも抽出を止める
+            if not extraction.done():
+                extraction.cancel()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/api/history/{user_id}", response_model=HistoryResponse)
 async def get_history(user_id: str, limit: int = 50):
     """会話履歴取得"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("""
-            SELECT id, timestamp, user_message, ai_response, model_used, rating, metadata
-            FROM conversations
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        """, (user_id, limit))
-        
-        rows = c.fetchall()
-        conn.close()
+        rows = await asyncio.to_thread(fetch_history_rows, user_id, limit)
         
         conversations = []
         for row in rows:
@@ -495,41 +788,8 @@ async def get_history(user_id: str, limit: int = 50):
 async def submit_feedback(req: FeedbackRequest):
     """フィードバック保存"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("SELECT metadata FROM conversations WHERE id = ?", (req.conversation_id,))
-        row = c.fetchone()
-        
-        metadata = json.loads(row[0]) if row and row[0] else {}
-        
-        metadata["feedback_rating"] = req.rating
-        if req.comment:
-            metadata["feedback_comment"] = req.comment
-        metadata["feedback_timestamp"] = datetime.now().isoformat()
-        
-        c.execute("""
-            UPDATE conversations
-            SET rating = ?, metadata = ?
-            WHERE id = ?
-        """, (req.rating, json.dumps(metadata, ensure_ascii=False), req.conversation_id))
-        
-        conn.commit()
-        
-        if req.rating <= 2:
-            c.execute("SELECT user_id FROM conversations WHERE id = ?", (req.conversation_id,))
-            user_row = c.fetchone()
-            
-            if user_row:
-                user_id = user_row[0]
-                improvement_system = SelfImprovementSystem(conn)
-                improvements = improvement_system.analyze_feedback(user_id)
-                
-                if improvements["suggestions"]:
-                    improvement_system.apply_improvements(user_id, improvements)
-                    print(f"✅ 自己改良実行: {improvements['suggestions']}")
+        await asyncio.to_thread(save_feedback, req)
         
-        conn.close()
         print(f"✅ フィードバック保存 (ID: {req.conversation_id}, Rating: {req.rating})")
         
         return {"status": "success", "message": "フィードバックを保存しました"}
@@ -541,28 +801,8 @@ async def submit_feedback(req: FeedbackRequest):
 async def list_models():
     """利用可能なモデル一覧"""
     try:
-        result = ollama.list()
-        models = []
-        # ListResponseオブジェクトから直接modelsを取得
-        model_list = result.models if hasattr(result, 'models') else []
-
-        for m in model_list:
-            # Modelオブジェクトから属性を取得
-            name = m.model if hasattr(m, 'model') else str(m)
-            size = m.size if hasattr(m, 'size') else 0
-
-            # 詳細情報を取得
-            details = m.details if hasattr(m, 'details') else None
-            param_size = details.parameter_size if details and hasattr(details, 'parameter_size') else ''
-            quant = details.quantization_level if details and hasattr(details, 'quantization_level') else ''
-            
-            models.append({
-                "name": name,
-                "size": size,
-                "size_gb": round(size / (1024**3), 1),
-                "parameter_size": param_size,
-                "quantization": quant
-            })
+        # キャッシュ切れのときはOllamaへの問い合わせになるのでスレッドで実行する
+        models = await asyncio.to_thread(tuning_system.list_available_models)
         
         return {"models": models}
 
@@ -577,30 +817,9 @@ async def list_models():
 async def get_stats(user_id: str):
     """ユーザー統計"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("SELECT COUNT(*) FROM conversations WHERE user_id = ?", (user_id,))
-        total_conversations = c.fetchone()[0]
-        
-        c.execute("""
-            SELECT AVG(rating) 
-            FROM conversations 
-            WHERE user_id = ? AND rating IS NOT NULL
-        """, (user_id,))
-        avg_rating = c.fetchone()[0] or 0
-        
-        c.execute("""
-            SELECT model_used, COUNT(*) as count
-            FROM conversations
-            WHERE user_id = ?
-            GROUP BY model_used
-            ORDER BY count DESC
-            LIMIT 1
-        """, (user_id,))
-        most_used_model = c.fetchone()
-        
-        conn.close()
+        total_conversations, avg_rating, most_used_model = await asyncio.to_thread(
+            fetch_user_stats, user_id
+        )
         
         return {
             "total_conversations": total_conversations,
@@ -615,8 +834,10 @@ async def get_stats(user_id: str):
 async def get_profile_endpoint(user_id: str):
     """ユーザープロファイル取得"""
     try:
-        profile = get_user_profile(user_id)
-        memory_count = rag_system.get_memory_count(user_id)
+        profile, memory_count = await asyncio.gather(
+            asyncio.to_thread(get_user_profile, user_id),
+            asyncio.to_thread(rag_system.get_memory_count, user_id)
+        )
         profile["rag_memories"] = memory_count
         
         return {"profile": profile}
@@ -626,11 +847,9 @@ async def get_profile_endpoint(user_id: str):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/conversation/{conversation_id}/tags")
-async def update_conversation_tags(conversation_id: int, tags: List[str]):
-    """会話のタグを更新"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
+def update_tags(conversation_id: int, tags: List[str]):
+    """会話のタグを更新（メタデータ内の tags を置き換える）"""
+    with db_pool.acquire() as conn:
         c = conn.cursor()
         
         c.execute("SELECT metadata FROM conversations WHERE id = ?", (conversation_id,))
@@ -650,7 +869,12 @@ async def update_conversation_tags(conversation_id: int, tags: List[str]):
         """, (json.dumps(metadata, ensure_ascii=False), conversation_id))
         
         conn.commit()
-        conn.close()
+
+@app.post("/api/conversation/{conversation_id}/tags")
+async def update_conversation_tags(conversation_id: int, tags: List[str]):
+    """会話のタグを更新"""
+    try:
+        await asyncio.to_thread(update_tags, conversation_id, tags)
         
         return {"status": "success", "tags": tags}
         
@@ -663,8 +887,7 @@ async def update_conversation_tags(conversation_id: int, tags: List[str]):
 async def get_available_base_models():
     """ファインチューニング用の利用可能なベースモデル一覧"""
     try:
-        result = ollama.list()
-        model_list = result.models if hasattr(result, 'models') else []
+        model_list = await asyncio.to_thread(tuning_system.list_available_models)
         
         recommended_models = [
             {
@@ -726,7 +949,7 @@ async def get_available_base_models():
             },
         ]
         
-        installed_model_names = [m.model if hasattr(m, 'model') else str(m) for m in model_list]
+        installed_model_names = {m["name"] for m in model_list}
         
         for model in recommended_models:
             model["installed"] = model["value"] in installed_model_names
@@ -748,8 +971,7 @@ async def get_available_base_models():
 async def check_finetuning_readiness(user_id: str):
     """ファインチューニングの準備状況をチェック"""
     try:
-        tuning_system = FineTuningSystem()
-        readiness = tuning_system.get_tuning_readiness(user_id)
+        readiness = await asyncio.to_thread(tuning_system.get_tuning_readiness, user_id)
         return readiness
         
     except Exception as e:
@@ -759,24 +981,29 @@ async def check_finetuning_readiness(user_id: str):
 async def trigger_finetuning(user_id: str, req: FineTuneRequest):
     """ユーザー専用モデルを作成"""
     try:
-        tuning_system = FineTuningSystem()
-        training_data = tuning_system.collect_training_data(user_id)
+        # 件数だけをSQLで集計する（学習に使う件数と同じく直近100件まで）
+        readiness = await asyncio.to_thread(tuning_system.get_tuning_readiness, user_id)
+        training_size = readiness["usable_for_training"]
         
-        if len(training_data) < 10:
+        if not readiness["ready"]:
             return {
                 "status": "insufficient_data",
-                "message": f"データが不足しています。現在{len(training_data)}件、最低10件必要です。",
-                "current_count": len(training_data),
-                "required_count": 10
+                "message": f"データが不足しています。現在{training_size}件、最低{readiness['required']}件必要です。",
+                "current_count": training_size,
+                "required_count": readiness["required"]
             }
         
-        model_name = tuning_system.fine_tune(user_id, req.base_model)
+        # ollama create は数分かかることがあるのでスレッドで待つ
+        # （準備状況は確認済みなので渡して再集計させない）
+        model_name = await asyncio.to_thread(
+            tuning_system.fine_tune, user_id, req.base_model, readiness
+        )
         
         return {
             "status": "success",
             "model_name": model_name,
             "message": f"ファインチューニング完了: {model_name}",
-            "training_size": len(training_data)
+            "training_size": training_size
         }
         
     except ValueError as e:
@@ -791,7 +1018,6 @@ async def trigger_finetuning(user_id: str, req: FineTuneRequest):
 async def list_custom_models(user_id: str):
     """ユーザーが作成したカスタムモデル一覧"""
     try:
-        tuning_system = FineTuningSystem()
         models = tuning_system.list_user_models(user_id)
         return {"models": models}
         
@@ -802,7 +1028,6 @@ async def list_custom_models(user_id: str):
 async def get_active_custom_model(user_id: str):
     """現在アクティブなカスタムモデルを取得"""
     try:
-        tuning_system = FineTuningSystem()
         model_name = tuning_system.get_active_model(user_id)
         
         return {
@@ -817,7 +1042,6 @@ async def get_active_custom_model(user_id: str):
 async def delete_custom_model(user_id: str, model_name: str):
     """カスタムモデルを削除"""
     try:
-        tuning_system = FineTuningSystem()
         tuning_system.delete_model(user_id, model_name)
         
         return {
@@ -836,8 +1060,9 @@ async def evaluate_custom_model(
 ):
     """カスタムモデルを評価"""
     try:
-        tuning_system = FineTuningSystem()
-        evaluation = tuning_system.evaluate_model(model_name, test_prompts)
+        evaluation = await asyncio.to_thread(
+            tuning_system.evaluate_model, model_name, test_prompts
+        )
         return evaluation
         
     except Exception as e:
@@ -853,18 +1078,17 @@ async def periodic_message_check():
     while True:
         try:
             # 全ユーザーのメッセージをチェック
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # アクティブなユーザーを取得
-            c.execute("""
-                SELECT DISTINCT user_id
-                FROM conversations
-                WHERE timestamp >= datetime('now', '-30 days')
-            """)
-            
-            users = [row[0] for row in c.fetchall()]
-            conn.close()
+            with db_pool.acquire() as conn:
+                c = conn.cursor()
+                
+                # アクティブなユーザーを取得
+                c.execute("""
+                    SELECT DISTINCT user_id
+                    FROM conversations
+                    WHERE timestamp >= datetime('now', '-30 days')
+                """)
+                
+                users = [row[0] for row in c.fetchall()]
             
             for user_id in users:
                 # メッセージをキューに追加
@@ -881,6 +1105,25 @@ async def periodic_message_check():
 
 # ==================== AIからのメッセージAPI ====================
 
+def collect_ready_messages(user_id: str) -> List[Dict]:
+    """送信待ちのうち今送ってよいメッセージを取り出し、送信済みにする"""
+    messages = conversation_initiator.get_pending_messages(user_id)
+    
+    # 送信可能なメッセージをフィルタ
+    ready_messages = []
+    for msg in messages:
+        if conversation_initiator.should_send_message_now(
+            user_id,
+            msg['message_type'],
+            msg['scheduled_time']
+        ):
+            ready_messages.append(msg)
+    
+    # 送信済みにマーク（まとめて1回のトランザクション）
+    conversation_initiator.mark_messages_sent([msg['id'] for msg in ready_messages])
+    
+    return ready_messages
+
 @app.get("/api/messages/{user_id}/pending")
 async def get_pending_messages_endpoint(user_id: str):
     """
@@ -888,19 +1131,7 @@ async def get_pending_messages_endpoint(user_id: str):
     フロントエンドがポーリングするか、WebSocketで使用
     """
     try:
-        messages = conversation_initiator.get_pending_messages(user_id)
-        
-        # 送信可能なメッセージをフィルタ
-        ready_messages = []
-        for msg in messages:
-            if conversation_initiator.should_send_message_now(
-                user_id,
-                msg['message_type'],
-                msg['scheduled_time']
-            ):
-                ready_messages.append(msg)
-                # 送信済みにマーク
-                conversation_initiator.mark_message_sent(msg['id'])
+        ready_messages = await asyncio.to_thread(collect_ready_messages, user_id)
         
         return {
             "has_messages": len(ready_messages) > 0,
@@ -912,15 +1143,13 @@ async def get_pending_messages_endpoint(user_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/messages/{user_id}/{message_id}/acknowledge")
-async def acknowledge_message_endpoint(user_id: str, message_id: int):
-    """ユーザーがメッセージを確認したことを記録"""
-    try:
-        success = conversation_initiator.mark_message_acknowledged(message_id)
-        
-        if success:
-            # 会話開始履歴に記録
-            conn = sqlite3.connect(DB_PATH)
+def acknowledge_message(user_id: str, message_id: int) -> bool:
+    """メッセージを確認済みにし、会話開始履歴に記録する"""
+    success = conversation_initiator.mark_message_acknowledged(message_id)
+    
+    if success:
+        # 会話開始履歴に記録
+        with db_pool.acquire() as conn:
             c = conn.cursor()
             
             # メッセージ情報を取得
@@ -942,9 +1171,16 @@ async def acknowledge_message_endpoint(user_id: str, message_id: int):
                 """, (user_id, sent_at, message_type))
                 
                 conn.commit()
-            
-            conn.close()
-            
+    
+    return success
+
+@app.post("/api/messages/{user_id}/{message_id}/acknowledge")
+async def acknowledge_message_endpoint(user_id: str, message_id: int):
+    """ユーザーがメッセージを確認したことを記録"""
+    try:
+        success = await asyncio.to_thread(acknowledge_message, user_id, message_id)
+        
+        if success:
             return {"status": "success", "message": "確認しました"}
         
         return {"status": "failed", "message": "メッセージが見つかりません"}
@@ -953,6 +1189,43 @@ async def acknowledge_message_endpoint(user_id: str, message_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def fetch_ai_message(message_id: int) -> Optional[tuple]:
+    """AIからのメッセージを取得 (message_type, message_content, metadata)"""
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        c.execute("""
+            SELECT message_type, message_content, metadata
+            FROM ai_messages_queue
+            WHERE id = ?
+        """, (message_id,))
+        
+        return c.fetchone()
+
+def record_ai_message_response(user_id: str, message_id: int, message_type: str):
+    """AIからのメッセージを確認済みにし、応答時間を記録する"""
+    conversation_initiator.mark_message_acknowledged(message_id)
+    
+    with db_pool.acquire() as conn:
+        c = conn.cursor()
+        
+        c.execute("""
+            SELECT sent_at FROM ai_messages_queue WHERE id = ?
+        """, (message_id,))
+        
+        row = c.fetchone()
+        if row:
+            sent_at = datetime.fromisoformat(row[0])
+            response_time = int((datetime.now() - sent_at).total_seconds())
+            
+            c.execute("""
+                INSERT INTO conversation_initiations
+                (user_id, initiated_at, message_type, user_responded, response_time_seconds)
+                VALUES (?, ?, ?, 1, ?)
+            """, (user_id, sent_at.isoformat(), message_type, response_time))
+            
+            conn.commit()
+
 @app.post("/api/messages/{user_id}/{message_id}/respond")
 async def respond_to_ai_message_endpoint(
     user_id: str,
@@ -965,17 +1238,7 @@ async def respond_to_ai_message_endpoint(
     """
     try:
         # メッセージを取得
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("""
-            SELECT message_type, message_content, metadata
-            FROM ai_messages_queue
-            WHERE id = ?
-        """, (message_id,))
-        
-        row = c.fetchone()
-        conn.close()
+        row = await asyncio.to_thread(fetch_ai_message, message_id)
         
         if not row:
             raise HTTPException(status_code=404, detail="メッセージが見つかりません")
@@ -991,12 +1254,12 @@ async def respond_to_ai_message_endpoint(
         
         # 既存のチャットAPIを呼び出し（内部的に）
         # ここでは簡易版
-        profile = get_user_profile(user_id)
+        profile = await asyncio.to_thread(get_user_profile, user_id)
         
         system_prompt = build_system_prompt(profile)
         system_prompt += f"\n\nあなたは先ほどユーザーに「{ai_message}」と聞きました。"
         
-        ollama_response = ollama.chat(
+        ollama_response = await async_client.chat(
             model="qwen2.5:7b",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1008,7 +1271,8 @@ async def respond_to_ai_message_endpoint(
         ai_response = ollama_response['message']['content']
         
         # 会話を保存
-        conv_id = save_conversation(
+        conv_id = await asyncio.to_thread(
+            save_conversation,
             user_id=user_id,
             user_msg=user_message,
             ai_msg=ai_response,
@@ -1016,31 +1280,8 @@ async def respond_to_ai_message_endpoint(
             metadata={"triggered_by_ai": True, "message_type": message_type}
         )
         
-        # メッセージを確認済みにマーク
-        conversation_initiator.mark_message_acknowledged(message_id)
-        
-        # 応答時間を記録
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("""
-            SELECT sent_at FROM ai_messages_queue WHERE id = ?
-        """, (message_id,))
-        
-        row = c.fetchone()
-        if row:
-            sent_at = datetime.fromisoformat(row[0])
-            response_time = int((datetime.now() - sent_at).total_seconds())
-            
-            c.execute("""
-                INSERT INTO conversation_initiations
-                (user_id, initiated_at, message_type, user_responded, response_time_seconds)
-                VALUES (?, ?, ?, 1, ?)
-            """, (user_id, sent_at.isoformat(), message_type, response_time))
-            
-            conn.commit()
-        
-        conn.close()
+        # メッセージを確認済みにマークし、応答時間を記録
+        await asyncio.to_thread(record_ai_message_response, user_id, message_id, message_type)
         
         # 日記の自動生成判定
         if message_type == "evening_reflection":
@@ -1051,7 +1292,8 @@ async def respond_to_ai_message_endpoint(
                 "energy_level": 5
             }
             
-            entry_id = journal_system.create_journal_entry(
+            entry_id = await asyncio.to_thread(
+                journal_system.create_journal_entry,
                 user_id=user_id,
                 content=user_message
             )
@@ -1072,47 +1314,46 @@ async def respond_to_ai_message_endpoint(
 async def get_message_stats_endpoint(user_id: str):
     """AIからのメッセージ統計"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 総メッセージ数
-        c.execute("""
-            SELECT COUNT(*)
-            FROM ai_messages_queue
-            WHERE user_id = ? AND sent = 1
-        """, (user_id,))
-        
-        total_sent = c.fetchone()[0]
-        
-        # 確認されたメッセージ数
-        c.execute("""
-            SELECT COUNT(*)
-            FROM ai_messages_queue
-            WHERE user_id = ? AND acknowledged = 1
-        """, (user_id,))
-        
-        acknowledged = c.fetchone()[0]
-        
-        # 平均応答時間
-        c.execute("""
-            SELECT AVG(response_time_seconds)
-            FROM conversation_initiations
-            WHERE user_id = ? AND user_responded = 1
-        """, (user_id,))
-        
-        avg_response_time = c.fetchone()[0] or 0
-        
-        # メッセージタイプ別の統計
-        c.execute("""
-            SELECT message_type, COUNT(*)
-            FROM ai_messages_queue
-            WHERE user_id = ? AND sent = 1
-            GROUP BY message_type
-        """, (user_id,))
-        
-        by_type = {row[0]: row[1] for row in c.fetchall()}
-        
-        conn.close()
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            # 総メッセージ数
+            c.execute("""
+                SELECT COUNT(*)
+                FROM ai_messages_queue
+                WHERE user_id = ? AND sent = 1
+            """, (user_id,))
+            
+            total_sent = c.fetchone()[0]
+            
+            # 確認されたメッセージ数
+            c.execute("""
+                SELECT COUNT(*)
+                FROM ai_messages_queue
+                WHERE user_id = ? AND acknowledged = 1
+            """, (user_id,))
+            
+            acknowledged = c.fetchone()[0]
+            
+            # 平均応答時間
+            c.execute("""
+                SELECT AVG(response_time_seconds)
+                FROM conversation_initiations
+                WHERE user_id = ? AND user_responded = 1
+            """, (user_id,))
+            
+            avg_response_time = c.fetchone()[0] or 0
+            
+            # メッセージタイプ別の統計
+            c.execute("""
+                SELECT message_type, COUNT(*)
+                FROM ai_messages_queue
+                WHERE user_id = ? AND sent = 1
+                GROUP BY message_type
+            """, (user_id,))
+            
+            by_type = {row[0]: row[1] for row in c.fetchall()}
+            
         
         return {
             "total_sent": total_sent,
@@ -1143,25 +1384,32 @@ async def get_user_patterns_endpoint(user_id: str):
 async def update_user_patterns_endpoint(user_id: str, patterns: Dict):
     """ユーザーの好みを更新"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("""
-            INSERT OR REPLACE INTO user_activity_patterns
-            (user_id, typical_morning_time, typical_evening_time,
-             quiet_hours_start, quiet_hours_end, last_updated)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            user_id,
-            patterns.get('typical_morning_time', '08:00'),
-            patterns.get('typical_evening_time', '20:00'),
-            patterns.get('quiet_hours_start'),
-            patterns.get('quiet_hours_end'),
-            datetime.now().isoformat()
-        ))
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            c.execute("""
+                INSERT INTO user_activity_patterns
+                (user_id, typical_morning_time, typical_evening_time,
+                 quiet_hours_start, quiet_hours_end, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    typical_morning_time = excluded.typical_morning_time,
+                    typical_evening_time = excluded.typical_evening_time,
+                    quiet_hours_start = excluded.quiet_hours_start,
+                    quiet_hours_end = excluded.quiet_hours_end,
+                    last_updated = excluded.last_updated
+            """, (
+                user_id,
+                patterns.get('typical_morning_time', '08:00'),
+                patterns.get('typical_evening_time', '20:00'),
+                patterns.get('quiet_hours_start'),
+                patterns.get('quiet_hours_end'),
+                datetime.now().isoformat()
+            ))
+            
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        conversation_initiator.invalidate_user_patterns(user_id)
         
         return {"status": "success", "message": "パターンを更新しました"}
         
@@ -1236,16 +1484,15 @@ async def get_daily_dashboard(user_id: str):
     """ダッシュボード用データ取得"""
     try:
         # DB接続を作成
-        conn = sqlite3.connect(DB_PATH)
-        
-        # schedule_managerに一時的に接続を渡す
-        schedule_manager.conn = conn
-        
-        # データ取得
-        plan = schedule_manager.suggest_daily_plan(user_id)
-        
-        # 接続をクローズ
-        conn.close()
+        with db_pool.acquire() as conn:
+            
+            # schedule_managerに一時的に接続を渡す
+            schedule_manager.conn = conn
+            
+            # データ取得
+            plan = schedule_manager.suggest_daily_plan(user_id)
+            
+            # 接続をクローズ
         schedule_manager.conn = None
         
         return plan
@@ -1261,16 +1508,15 @@ async def get_habits(user_id: str):
     """習慣一覧取得"""
     try:
         # DB接続を作成
-        conn = sqlite3.connect(DB_PATH)
-        
-        # schedule_managerに一時的に接続を渡す
-        schedule_manager.conn = conn
-        
-        # データ取得
-        habits = schedule_manager.get_habits(user_id)
-        
-        # 接続をクローズ
-        conn.close()
+        with db_pool.acquire() as conn:
+            
+            # schedule_managerに一時的に接続を渡す
+            schedule_manager.conn = conn
+            
+            # データ取得
+            habits = schedule_manager.get_habits(user_id)
+            
+            # 接続をクローズ
         schedule_manager.conn = None
         
         return {"habits": habits}
@@ -1286,16 +1532,15 @@ async def complete_habit(user_id: str, habit_id: int):
     """習慣完了チェック"""
     try:
         # DB接続を作成
-        conn = sqlite3.connect(DB_PATH)
-        
-        # schedule_managerに一時的に接続を渡す
-        schedule_manager.conn = conn
-        
-        # 習慣完了処理
-        success = schedule_manager.mark_habit_completed(habit_id)
-        
-        # 接続をクローズ
-        conn.close()
+        with db_pool.acquire() as conn:
+            
+            # schedule_managerに一時的に接続を渡す
+            schedule_manager.conn = conn
+            
+            # 習慣完了処理
+            success = schedule_manager.mark_habit_completed(habit_id)
+            
+            # 接続をクローズ
         schedule_manager.conn = None
         
         return {"status": "success", "updated": success}
@@ -1311,6 +1556,7 @@ async def startup_event():
     """アプリケーション起動時の初期化 - 全て統合"""
     global analyzer, rag_system, schedule_manager, assistant_brain
     global goal_manager, journal_system, conversation_initiator
+    global response_cache
     
     print("=" * 50)
     print("🚀 パートナーAI システム起動中...")
@@ -1323,6 +1569,10 @@ async def startup_event():
     rag_system = RAGSystem(persist_directory="./chroma_db")
     print("✅ RAGシステム初期化完了")
     
+    # 埋め込みモデルとChromaDBはRAGシステムのものを使う
+    response_cache = ResponseCache(rag_system)
+    print("✅ 応答キャッシュ初期化完了")
+    
     # 2. DB必要なシステム（Noneで初期化）
     schedule_manager = ScheduleManager(None)
     print("✅ スケジュール管理システム初期化完了")
@@ -1330,36 +1580,28 @@ async def startup_event():
     assistant_brain = AssistantBrain(schedule_manager)
     print("✅ AIアシスタント脳初期化完了")
     
-    goal_manager = GoalManager(None)
+    # 目標・日記も共有の接続プールから操作のたびに接続を借りる（テーブルもここで初期化）
+    goal_manager = GoalManager(db_pool)
     print("✅ 目標管理システム初期化完了")
     
-    journal_system = JournalSystem(None)
+    journal_system = JournalSystem(db_pool)
     print("✅ 日記システム初期化完了")
     
+    # 書き込み1本 + 読み取りプールの接続を自前で持つ（テーブルもここで初期化）
     conversation_initiator = ConversationInitiator(
-        None, goal_manager, journal_system, schedule_manager
+        DB_PATH, goal_manager, journal_system, schedule_manager
     )
     print("✅ 能動的会話システム初期化完了")
     
     # 3. データベーステーブル初期化（1回だけ実行）
     print("📊 データベーステーブル初期化中...")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        
-        # 各システムに一時的に接続を渡してテーブル作成
-        schedule_manager.conn = conn
-        schedule_manager._init_tables()
-        
-        goal_manager.conn = conn
-        goal_manager._init_tables()
-        
-        journal_system.conn = conn
-        journal_system._init_tables()
-        
-        conversation_initiator.conn = conn
-        conversation_initiator._init_tables()
-        
-        conn.close()
+        with db_pool.acquire() as conn:
+            
+            # スケジュール管理に一時的に接続を渡してテーブル作成
+            schedule_manager.conn = conn
+            schedule_manager._init_tables()
+            
         print("✅ データベーステーブル初期化完了")
         
     except Exception as e:
@@ -1369,9 +1611,6 @@ async def startup_event():
     finally:
         # 接続をNoneに戻す（各APIで必要時に再接続）
         schedule_manager.conn = None
-        goal_manager.conn = None
-        journal_system.conn = None
-        conversation_initiator.conn = None
     
     # 4. バックグラウンドタスク開始
     asyncio.create_task(periodic_message_check())
@@ -1430,12 +1669,11 @@ async def create_schedule_endpoint(user_id: str, schedule: Dict):
 async def get_schedules(user_id: str, days: int = 7):
     """スケジュール一覧取得"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        schedule_manager.conn = conn
-        
-        schedules = schedule_manager.get_upcoming_schedules(user_id, days=days)
-        
-        conn.close()
+        with db_pool.acquire() as conn:
+            schedule_manager.conn = conn
+            
+            schedules = schedule_manager.get_upcoming_schedules(user_id, days=days)
+            
         schedule_manager.conn = None
         
         return {"schedules": schedules, "total": len(schedules)}
@@ -1447,30 +1685,30 @@ async def get_schedules(user_id: str, days: int = 7):
 async def update_schedule(schedule_id: int, data: Dict):
     """スケジュール更新"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 更新可能なフィールド
-        allowed_fields = ['title', 'description', 'start_time', 'end_time', 'location']
-        
-        updates = []
-        values = []
-        for field in allowed_fields:
-            if field in data:
-                updates.append(f"{field} = ?")
-                values.append(data[field])
-        
-        if updates:
-            values.append(schedule_id)
-            c.execute(f"""
-                UPDATE schedules
-                SET {', '.join(updates)}
-                WHERE id = ?
-            """, values)
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            # 更新可能なフィールド
+            allowed_fields = ['title', 'description', 'start_time', 'end_time', 'location']
+            
+            updates = []
+            values = []
+            for field in allowed_fields:
+                if field in data:
+                    updates.append(f"{field} = ?")
+                    values.append(data[field])
+            
+            if updates:
+                values.append(schedule_id)
+                c.execute(f"""
+                    UPDATE schedules
+                    SET {', '.join(updates)}
+                    WHERE id = ?
+                """, values)
+                
+                conn.commit()
+                schedule_manager.mark_changed()
             
-            conn.commit()
-        
-        conn.close()
         
         return {"status": "success", "message": "スケジュールを更新しました"}
     except Exception as e:
@@ -1481,12 +1719,12 @@ async def update_schedule(schedule_id: int, data: Dict):
 async def delete_schedule(schedule_id: int):
     """スケジュール削除"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
-        conn.commit()
-        conn.close()
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            c.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
+            conn.commit()
+        schedule_manager.mark_changed()
         
         return {"status": "success", "message": "スケジュールを削除しました"}
     except Exception as e:
@@ -1499,12 +1737,11 @@ async def delete_schedule(schedule_id: int):
 async def get_tasks(user_id: str):
     """タスク一覧取得"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        schedule_manager.conn = conn
-        
-        tasks = schedule_manager.get_pending_tasks(user_id)
-        
-        conn.close()
+        with db_pool.acquire() as conn:
+            schedule_manager.conn = conn
+            
+            tasks = schedule_manager.get_pending_tasks(user_id)
+            
         schedule_manager.conn = None
         
         return {"tasks": tasks, "total": len(tasks)}
@@ -1516,30 +1753,30 @@ async def get_tasks(user_id: str):
 async def update_task(task_id: int, data: Dict):
     """タスク更新"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 更新可能なフィールド
-        allowed_fields = ['title', 'description', 'due_date', 'priority', 'status']
-        
-        updates = []
-        values = []
-        for field in allowed_fields:
-            if field in data:
-                updates.append(f"{field} = ?")
-                values.append(data[field])
-        
-        if updates:
-            values.append(task_id)
-            c.execute(f"""
-                UPDATE tasks
-                SET {', '.join(updates)}
-                WHERE id = ?
-            """, values)
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            # 更新可能なフィールド
+            allowed_fields = ['title', 'description', 'due_date', 'priority', 'status']
+            
+            updates = []
+            values = []
+            for field in allowed_fields:
+                if field in data:
+                    updates.append(f"{field} = ?")
+                    values.append(data[field])
+            
+            if updates:
+                values.append(task_id)
+                c.execute(f"""
+                    UPDATE tasks
+                    SET {', '.join(updates)}
+                    WHERE id = ?
+                """, values)
+                
+                conn.commit()
+                schedule_manager.mark_changed()
             
-            conn.commit()
-        
-        conn.close()
         
         return {"status": "success", "message": "タスクを更新しました"}
     except Exception as e:
@@ -1550,12 +1787,11 @@ async def update_task(task_id: int, data: Dict):
 async def complete_task_endpoint(task_id: int):
     """タスク完了"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        schedule_manager.conn = conn
-        
-        success = schedule_manager.complete_task(task_id)
-        
-        conn.close()
+        with db_pool.acquire() as conn:
+            schedule_manager.conn = conn
+            
+            success = schedule_manager.complete_task(task_id)
+            
         schedule_manager.conn = None
         
         return {"status": "success", "completed": success}
@@ -1567,12 +1803,12 @@ async def complete_task_endpoint(task_id: int):
 async def delete_task(task_id: int):
     """タスク削除"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
-        conn.commit()
-        conn.close()
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            c.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            conn.commit()
+        schedule_manager.mark_changed()
         
         return {"status": "success", "message": "タスクを削除しました"}
     except Exception as e:
@@ -1585,14 +1821,8 @@ async def delete_task(task_id: int):
 async def get_goals(user_id: str):
     """目標一覧取得"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        goal_manager.conn = conn
-        
         goals = goal_manager.get_active_goals(user_id)
         
-        conn.close()
-        goal_manager.conn = None
-        
         return {"goals": goals, "total": len(goals)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1602,29 +1832,28 @@ async def get_goals(user_id: str):
 async def update_goal(goal_id: int, data: Dict):
     """目標更新"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        allowed_fields = ['title', 'description', 'target_date', 'status', 'progress_percentage']
-        
-        updates = []
-        values = []
-        for field in allowed_fields:
-            if field in data:
-                updates.append(f"{field} = ?")
-                values.append(data[field])
-        
-        if updates:
-            values.append(goal_id)
-            c.execute(f"""
-                UPDATE goals
-                SET {', '.join(updates)}
-                WHERE id = ?
-            """, values)
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            allowed_fields = ['title', 'description', 'target_date', 'status', 'progress_percentage']
+            
+            updates = []
+            values = []
+            for field in allowed_fields:
+                if field in data:
+                    updates.append(f"{field} = ?")
+                    values.append(data[field])
+            
+            if updates:
+                values.append(goal_id)
+                c.execute(f"""
+                    UPDATE goals
+                    SET {', '.join(updates)}
+                    WHERE id = ?
+                """, values)
+                
+                conn.commit()
             
-            conn.commit()
-        
-        conn.close()
         
         return {"status": "success", "message": "目標を更新しました"}
     except Exception as e:
@@ -1635,12 +1864,11 @@ async def update_goal(goal_id: int, data: Dict):
 async def delete_goal(goal_id: int):
     """目標削除"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("DELETE FROM goals WHERE id = ?", (goal_id,))
-        conn.commit()
-        conn.close()
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            
+            c.execute("DELETE FROM goals WHERE id = ?", (goal_id,))
+            conn.commit()
         
         return {"status": "success", "message": "目標を削除しました"}
     except Exception as e:
@@ -1657,49 +1885,46 @@ async def test_trigger_messages(user_id: str):
     開発時のテスト用なので、本番では削除推奨
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conversation_initiator.conn = conn
-        
-        # 朝のチェックインを生成
-        morning_msg = conversation_initiator.generate_morning_checkin(user_id)
-        morning_id = conversation_initiator.queue_message(
-            user_id=user_id,
-            message_type=morning_msg['type'],
-            priority=morning_msg['priority'],
-            content=morning_msg['content'],
-            scheduled_time=datetime.now().isoformat()
-        )
-        conversation_initiator.mark_message_sent(morning_id)
-        
-        # 夜の振り返りを生成
-        evening_msg = conversation_initiator.generate_evening_reflection(user_id)
-        evening_id = conversation_initiator.queue_message(
-            user_id=user_id,
-            message_type=evening_msg['type'],
-            priority=evening_msg['priority'],
-            content=evening_msg['content'],
-            scheduled_time=datetime.now().isoformat()
-        )
-        conversation_initiator.mark_message_sent(evening_id)
-        
-        # タスクリマインダーを生成（タスクがあれば）
-        schedule_manager.conn = conn
-        tasks = schedule_manager.get_pending_tasks(user_id)
-        
-        if tasks:
-            task = tasks[0]
-            reminder_msg = conversation_initiator.generate_task_reminder(user_id, task)
-            reminder_id = conversation_initiator.queue_message(
+        with db_pool.acquire() as conn:
+            
+            # 朝のチェックインを生成
+            morning_msg = conversation_initiator.generate_morning_checkin(user_id)
+            morning_id = conversation_initiator.queue_message(
                 user_id=user_id,
-                message_type=reminder_msg['type'],
-                priority=reminder_msg['priority'],
-                content=reminder_msg['content'],
+                message_type=morning_msg['type'],
+                priority=morning_msg['priority'],
+                content=morning_msg['content'],
                 scheduled_time=datetime.now().isoformat()
             )
-            conversation_initiator.mark_message_sent(reminder_id)
-        
-        conn.close()
-        conversation_initiator.conn = None
+            conversation_initiator.mark_message_sent(morning_id)
+            
+            # 夜の振り返りを生成
+            evening_msg = conversation_initiator.generate_evening_reflection(user_id)
+            evening_id = conversation_initiator.queue_message(
+                user_id=user_id,
+                message_type=evening_msg['type'],
+                priority=evening_msg['priority'],
+                content=evening_msg['content'],
+                scheduled_time=datetime.now().isoformat()
+            )
+            conversation_initiator.mark_message_sent(evening_id)
+            
+            # タスクリマインダーを生成（タスクがあれば）
+            schedule_manager.conn = conn
+            tasks = schedule_manager.get_pending_tasks(user_id)
+            
+            if tasks:
+                task = tasks[0]
+                reminder_msg = conversation_initiator.generate_task_reminder(user_id, task)
+                reminder_id = conversation_initiator.queue_message(
+                    user_id=user_id,
+                    message_type=reminder_msg['type'],
+                    priority=reminder_msg['priority'],
+                    content=reminder_msg['content'],
+                    scheduled_time=datetime.now().isoformat()
+                )
+                conversation_initiator.mark_message_sent(reminder_id)
+            
         schedule_manager.conn = None
         
         return {
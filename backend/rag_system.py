@@ -7,7 +7,7 @@ RAG（Retrieval-Augmented Generation）システム
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict
+from typing import List, Dict, Optional
 import json
 from datetime import datetime
 
@@ -87,12 +87,17 @@ class RAGSystem:
         self,
         user_id: str,
         query: str,
-        n_results: int = 5
+        n_results: int = 5,
+        query_embedding: Optional[List[float]] = None
     ) -> List[Dict]:
-        """関連する記憶を検索"""
+        """
+        関連する記憶を検索
+        query_embedding: 計算済みのクエリの埋め込み（あれば再計算しない）
+        """
         
         # クエリの埋め込み
-        query_embedding = self.embedding_model.encode(query).tolist()
+        if query_embedding is None:
+            query_embedding = self.embedding_model.encode(query).tolist()
         
         # 検索実行
         try:
@@ -240,16 +245,12 @@ class SelfImprovementSystem:
         now = datetime.now().isoformat()
         
         c.execute("""
-            UPDATE user_profiles
-            SET profile_data = ?, updated_at = ?
-            WHERE user_id = ?
-        """, (profile_json, now, user_id))
-        
-        if c.rowcount == 0:
-            c.execute("""
-                INSERT INTO user_profiles (user_id, profile_data, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, profile_json, now, now))
+            INSERT INTO user_profiles (user_id, profile_data, created_at, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                profile_data = excluded.profile_data,
+                updated_at = excluded.updated_at
+        """, (user_id, profile_json, now, now))
         
         self.conn.commit()
         
@@ -0,0 +1,28 @@
+"""
+request_context.py
+リクエスト単位で共有する値
+1リクエスト内で何度も datetime.now() を呼ばず、開始時刻を使い回す
+"""
+
+from contextvars import ContextVar, Token
+from datetime import datetime
+from typing import Optional
+
+
+_request_now: ContextVar[Optional[datetime]] = ContextVar("request_now", default=None)
+
+
+def request_now() -> datetime:
+    """リクエスト開始時刻を返す（リクエスト外では現在時刻）"""
+    now = _request_now.get()
+    return now if now is not None else datetime.now()
+
+
+def bind_request_now(now: Optional[datetime] = None) -> Token:
+    """現在のコンテキストの時刻を固定する（戻り値は reset_request_now に渡す）"""
+    return _request_now.set(now or datetime.now())
+
+
+def reset_request_now(token: Token):
+    """bind_request_now で固定した時刻を解除"""
+    _request_now.reset(token)
@@ -0,0 +1,154 @@
+"""
+response_cache.py
+チャット応答のキャッシュ
+同じ入力（完全一致）や言い換え（意味的に近い入力）にはLLMを呼ばずに過去の応答を返す
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import schedule_manager
+
+
+class ResponseCache:
+    """
+    2段階の応答キャッシュ
+    
+    1. 完全一致: ユーザー・モデル・システムプロンプト・発言のハッシュ（プロセス内LRU）
+    2. 意味的一致: RAGと同じ埋め込みモデルで、同じユーザー・モデル・会話文脈
+       （システムプロンプトと直近の履歴）の過去の入力とコサイン距離が
+       max_distance 以下なら、その応答を返す（ChromaDBに永続化）
+    
+    同じ言い換えでも文脈が違えば別の応答が必要なので、意味的一致は文脈が同じ場合に限り、
+    有効期間も短くする
+    """
+    
+    def __init__(
+        self,
+        rag_system,
+        max_entries: int = 1024,
+        ttl_seconds: int = 86400,
+        semantic_ttl_seconds: int = 3600,
+        max_distance: float = 0.05
+    ):
+        self.embedding_model = rag_system.embedding_model
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.semantic_ttl_seconds = semantic_ttl_seconds
+        self.max_distance = max_distance
+        # キー -> (保存時刻, 応答)
+        self._exact: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # 意味的キャッシュ用のコレクション（距離はコサイン）
+        self.collection = rag_system.client.get_or_create_collection(
+            name="response_cache",
+            metadata={"hnsw:space": "cosine"}
+        )
+    
+    @staticmethod
+    def may_extract(message: str, goal_manager=None) -> bool:
+        """
+        自動抽出が起こりうる発言か（True ならキャッシュを使わない）
+        
+        抽出側の前段判定と同じものを使う（キャッシュから返すと抽出・登録が行われないため）
+        """
+        return schedule_manager.may_extract(message, goal_manager)
+    
+    @staticmethod
+    def _hash(obj) -> str:
+        canonical = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def make_key(user_id: str, model: str, system_prompt: str, message: str) -> str:
+        """完全一致用のキー（ユーザー・モデル・システムプロンプト・発言のハッシュ）"""
+        return ResponseCache._hash([user_id, model, system_prompt, message])
+    
+    @staticmethod
+    def make_context(system_prompt: str, history: List[Dict]) -> str:
+        """意味的一致の範囲を決める会話文脈（システムプロンプトと直近の履歴のハッシュ）"""
+        return ResponseCache._hash([system_prompt, history])
+    
+    def embed(self, text: str) -> List[float]:
+        """意味的キャッシュ用の埋め込み"""
+        return self.embedding_model.encode(text).tolist()
+    
+    def get(
+        self,
+        key: str,
+        context: str,
+        user_id: str,
+        model: str,
+        embedding: List[float]
+    ) -> Optional[str]:
+        """キャッシュされた応答（なければNone）"""
+        now = time.time()
+        
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl_seconds:
+                    self._exact.move_to_end(key)
+                    return entry[1]
+                del self._exact[key]
+        
+        try:
+            results = self.collection.query(
+                query_embeddings=[embedding],
+                n_results=1,
+                where={"$and": [
+                    {"user_id": user_id},
+                    {"model": model},
+                    {"context": context},
+                    {"created_at": {"$gte": now - self.semantic_ttl_seconds}}
+                ]}
+            )
+        except Exception as e:
+            print(f"⚠️ 応答キャッシュ検索エラー: {e}")
+            return None
+        
+        if results["ids"] and results["ids"][0]:
+            if results["distances"][0][0] <= self.max_distance:
+                return results["metadatas"][0][0]["ai_response"]
+        
+        return None
+    
+    def put(
+        self,
+        key: str,
+        context: str,
+        user_id: str,
+        model: str,
+        message: str,
+        embedding: List[float],
+        ai_response: str
+    ):
+        """応答を両方の段に保存"""
+        now = time.time()
+        
+        with self._lock:
+            self._exact[key] = (now, ai_response)
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+        
+        try:
+            self.collection.upsert(
+                ids=[key],
+                embeddings=[embedding],
+                documents=[message],
+                metadatas=[{
+                    "user_id": user_id,
+                    "model": model,
+                    "context": context,
+                    "created_at": now,
+                    "ai_response": ai_response
+                }]
+            )
+        except Exception as e:
+            print(f"⚠️ 応答キャッシュ保存エラー: {e}")
@@ -4,23 +4,86 @@ schedule_manager.py
 AIが秘書のように働く
 """
 
+import asyncio
 import sqlite3
+import threading
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
 import json
-import ollama
+from _ollama_pool import async_client, client
 import re
 
 
+# 抽出の前段判定（含まなければLLMに渡さない）
+# 取りこぼすと登録されないので、外れても構わない広めの条件にする
+
+# 予定: 時刻・日付・曜日・時間帯の表現
+_SCHEDULE_HINT_RE = re.compile(
+    r"[0-9０-９]|[一二三四五六七八九十]+時|"
+    + "|".join(map(re.escape, [
+        "今日", "明日", "明後日", "あさって", "今週", "来週", "再来週", "来月",
+        "曜", "週末", "午前", "午後", "正午", "朝", "昼", "夕方", "夜", "今晩", "今夜",
+    ]))
+)
+
+# タスク: 義務・期限・用事の表現（「する」「したい」など一般的な語尾は含めない）
+_TASK_HINT_RE = re.compile("|".join(map(re.escape, [
+    "やる", "やら", "やっておく", "やること", "する必要", "しないと", "しなきゃ",
+    "しなくちゃ", "しなければ", "なきゃ", "までに", "期限", "締め切り", "締切", "〆切",
+    "タスク", "TODO", "ToDo", "todo", "買う", "買わ", "買い", "提出", "予約", "返信",
+    "準備", "忘れずに",
+])))
+
+
+def may_extract(message: str, goal_manager=None) -> bool:
+    """
+    予定・タスク・目標のいずれかの抽出が起こりうる発言か（aextract_all と同じ判定）
+    
+    goal_manager（GoalManager）を渡すと目標の前段判定も含める
+    """
+    return bool(
+        _SCHEDULE_HINT_RE.search(message)
+        or _TASK_HINT_RE.search(message)
+        or (goal_manager is not None and goal_manager.may_have_goal(message))
+    )
+
+
+# まとめて抽出するときの各項目の指示（キー名 -> 指示とJSON形式）
+_COMBINED_SECTIONS = {
+    "schedule": """- schedule: 時刻や日時が明確な予定（「明日14時に」「来週の月曜に」など）
+  「〇〇をする」だけの場合や、start_timeの時刻が特定できない場合は has_schedule: false
+  {"has_schedule": true/false, "title": "予定のタイトル", "description": "詳細説明",
+   "start_time": "YYYY-MM-DD HH:MM形式（必須）", "end_time": "YYYY-MM-DD HH:MM形式（あれば）",
+   "location": "場所（あれば）", "attendees": ["参加者リスト"]}""",
+    "task": """- task: やるべきこと（「〇〇する」「〇〇しないと」「〇〇したい」）
+  優先度は「急ぎ」「すぐに」「今日中」→ high、「来週まで」「そのうち」→ medium、「いつか」「できれば」→ low
+  {"has_task": true/false, "title": "タスクのタイトル", "description": "詳細説明",
+   "due_date": "YYYY-MM-DD形式（期限があれば）", "priority": "high/medium/low",
+   "estimated_minutes": 60, "subtasks": ["サブタスク1", "サブタスク2"]}""",
+}
+
+
 class ScheduleManager:
     """スケジュール・タスク・習慣統合管理システム"""
     
     def __init__(self, db_connection, model: str = "gemma3:4b"):
+        self._local = threading.local()
         self.conn = db_connection
         self.model = model
+        # 予定・タスクが変更されるたびに増える（日次計画などのキャッシュ判定用）
+        self.data_version = 0
         if self.conn is not None: # ← この行を追加
             self._init_tables()
     
+    @property
+    def conn(self):
+        """現在のスレッドで使う接続（スレッドごとに別々に差し替えられる）"""
+        return getattr(self._local, "conn", None)
+    
+    @conn.setter
+    def conn(self, value):
+        self._local.conn = value
+    
     def _init_tables(self):
         """テーブル初期化"""
         c = self.conn.cursor()
@@ -116,15 +179,160 @@ class ScheduleManager:
             )
         """)
         
+        # インデックス（直近の予定・期限付きタスクの範囲検索用）
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_schedules_user_status_start
+            ON schedules(user_id, status, start_time)
+        """)
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_tasks_user_status_due
+            ON tasks(user_id, status, due_date)
+        """)
+        
         self.conn.commit()
     
+    def mark_changed(self):
+        """予定・タスクの変更を通知（外部で直接SQLを実行した場合も呼ぶ）"""
+        self.data_version += 1
+    
     # ==================== スケジュール管理 ====================
     
     def extract_schedule_from_text(self, user_message: str) -> Optional[Dict]:
         """自然言語からスケジュール情報を抽出（改善版）"""
         
+        if not _SCHEDULE_HINT_RE.search(user_message):
+            return None
+        
+        try:
+            response = client.chat(
+                model=self.model,
+                messages=[{"role": "user", "content": self._schedule_prompt(user_message)}],
+                options={"temperature": 0.2}  # より確実な判定のため低めに
+            )
+            return self._parse_schedule(response['message']['content'])
+            
+        except Exception as e:
+            print(f"⚠️ スケジュール抽出エラー: {e}")
+        
+        return None
+    
+    async def aextract_schedule_from_text(self, user_message: str) -> Optional[Dict]:
+        """extract_schedule_from_text の非同期版（他のLLM呼び出しと並行できる）"""
+        
+        if not _SCHEDULE_HINT_RE.search(user_message):
+            return None
+        
+        try:
+            response = await async_client.chat(
+                model=self.model,
+                messages=[{"role": "user", "content": self._schedule_prompt(user_message)}],
+                options={"temperature": 0.2}  # より確実な判定のため低めに
+            )
+            return self._parse_schedule(response['message']['content'])
+            
+        except Exception as e:
+            print(f"⚠️ スケジュール抽出エラー: {e}")
+        
+        return None
+    
+    async def aextract_all(self, user_message: str, goal_manager=None) -> Dict[str, Optional[Dict]]:
+        """
+        予定・タスク・目標をまとめて抽出
+        
+        予定とタスクの前段判定が両方該当すれば1回のLLM呼び出しでまとめて抽出する
+        （メッセージのプロンプト処理が1回で済む）。片方だけなら個別の抽出を使う。
+        目標は GoalManager の抽出（前段判定・抽出用モデル・検証・キャッシュ込み）に
+        任せ、並行して待つ
+        
+        Args:
+            user_message: ユーザーの発言
+            goal_manager: GoalManager（Noneなら目標は抽出しない）
+        
+        Returns:
+            {"schedule": ..., "task": ..., "goal": ...}（該当しなければNone）
+        """
+        result = {"schedule": None, "task": None, "goal": None}
+        
+        if goal_manager is not None and goal_manager.may_have_goal(user_message):
+            schedule_task, result["goal"] = await asyncio.gather(
+                self._aextract_schedule_task(user_message),
+                goal_manager.aextract_goal_from_text(user_message)
+            )
+        else:
+            schedule_task = await self._aextract_schedule_task(user_message)
+        
+        result.update(schedule_task)
+        return result
+    
+    async def _aextract_schedule_task(self, user_message: str) -> Dict[str, Optional[Dict]]:
+        """予定・タスクを抽出（両方の前段判定に該当すれば1回の呼び出しでまとめる）"""
+        result = {"schedule": None, "task": None}
+        
+        kinds = [
+            kind for kind, hit in (
+                ("schedule", _SCHEDULE_HINT_RE.search(user_message)),
+                ("task", _TASK_HINT_RE.search(user_message)),
+            )
+            if hit
+        ]
+        
+        if kinds == ["schedule"]:
+            result["schedule"] = await self.aextract_schedule_from_text(user_message)
+            return result
+        if kinds == ["task"]:
+            result["task"] = await self.aextract_task_from_text(user_message)
+            return result
+        if not kinds:
+            return result
+        
+        try:
+            response = await async_client.chat(
+                model=self.model,
+                messages=[{"role": "user", "content": self._combined_prompt(user_message, kinds)}],
+                format="json",
+                options={"temperature": 0.2}
+            )
+            extracted = json.loads(response['message']['content'])
+        except Exception as e:
+            print(f"⚠️ まとめて抽出エラー: {e}")
+            return result
+        
+        for kind in kinds:
+            item = extracted.get(kind)
+            if not isinstance(item, dict):
+                continue
+            try:
+                if kind == "schedule":
+                    result["schedule"] = self._check_schedule(item)
+                else:
+                    result["task"] = self._check_task(item)
+            except Exception as e:
+                print(f"⚠️ 抽出結果の検証エラー ({kind}): {e}")
+        
+        return result
+    
+    def _combined_prompt(self, user_message: str, kinds: List[str]) -> str:
+        """まとめて抽出するプロンプト（固定の指示を先頭、メッセージを末尾に置く）"""
+        
+        sections = "\n".join(_COMBINED_SECTIONS[kind] for kind in kinds)
+        
+        return f"""末尾のメッセージから以下の項目を抽出し、{", ".join(kinds)} をキーとする1つのJSONで返してください（JSONのみ）。
+該当しない項目も has_〇〇: false として必ず含めてください。
+
+{sections}
+
+現在時刻: {datetime.now().strftime('%Y-%m-%d %H:%M')}
+明日の日付: {(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')}
+来週: {(datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')}
+
+メッセージ: {user_message}
+"""
+    
+    def _schedule_prompt(self, user_message: str) -> str:
+        """スケジュール抽出プロンプト"""
+        
         # より詳細なプロンプト
-        prompt = f"""以下のメッセージからスケジュール情報を抽出してください。
+        return f"""以下のメッセージからスケジュール情報を抽出してください。
 
     メッセージ: {user_message}
 
@@ -153,42 +361,34 @@ class ScheduleManager:
     今日の日付: {datetime.now().strftime('%Y-%m-%d')}
     明日の日付: {(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')}
     """
+    
+    def _parse_schedule(self, content: str) -> Optional[Dict]:
+        """スケジュール抽出の応答を解析・検証（予定でなければNone）"""
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
+        if not json_match:
+            return None
         
-        try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.2}  # より確実な判定のため低めに
-            )
-            
-            content = response['message']['content']
+        return self._check_schedule(json.loads(json_match.group()))
+    
+    def _check_schedule(self, result: Dict) -> Optional[Dict]:
+        """抽出したスケジュールを検証（予定でなければNone）"""
+        # start_timeの検証
+        if result.get("has_schedule"):
+            start_time = result.get("start_time", "")
             
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group())
-                
-                # start_timeの検証
-                if result.get("has_schedule"):
-                    start_time = result.get("start_time", "")
-                    
-                    # 時刻が含まれているか確認（HH:MMフォーマット）
-                    if not re.search(r'\d{2}:\d{2}', start_time):
-                        print(f"⚠️ スケジュール判定: 時刻が不明確なため除外 - {result.get('title')}")
-                        return None
-                    
-                    # 日付の妥当性確認
-                    try:
-                        datetime.fromisoformat(start_time)
-                    except:
-                        print(f"⚠️ スケジュール判定: 日時形式が不正 - {start_time}")
-                        return None
-                
-                return result if result.get("has_schedule") else None
+            # 時刻が含まれているか確認（HH:MMフォーマット）
+            if not re.search(r'\d{2}:\d{2}', start_time):
+                print(f"⚠️ スケジュール判定: 時刻が不明確なため除外 - {result.get('title')}")
+                return None
             
-        except Exception as e:
-            print(f"⚠️ スケジュール抽出エラー: {e}")
-        
-        return None
+            # 日付の妥当性確認
+            try:
+                datetime.fromisoformat(start_time)
+            except:
+                print(f"⚠️ スケジュール判定: 日時形式が不正 - {start_time}")
+                return None
+        
+        return result if result.get("has_schedule") else None
     
     def create_schedule(
         self,
@@ -221,6 +421,7 @@ class ScheduleManager:
         
         schedule_id = c.lastrowid
         self.conn.commit()
+        self.mark_changed()
         
         return schedule_id
     
@@ -280,6 +481,46 @@ class ScheduleManager:
             for r in c.fetchall()
         ]
     
+    def get_next_schedule_within(self, user_id: str, minutes: int = 15) -> Optional[Dict]:
+        """
+        指定分数以内に始まる直近の予定を1件取得
+        
+        start_time は "YYYY-MM-DD HH:MM" と ISO形式（T区切り）が混在しうるため、
+        日付範囲でインデックスを絞ってから datetime() で正規化して比較する
+        """
+        c = self.conn.cursor()
+        
+        now = datetime.now()
+        until = now + timedelta(minutes=minutes)
+        
+        c.execute("""
+            SELECT id, title, start_time, end_time, location
+            FROM schedules
+            WHERE user_id = ?
+              AND status = 'scheduled'
+              AND start_time >= ?
+              AND start_time < ?
+              AND datetime(start_time) > datetime(?)
+              AND datetime(start_time) <= datetime(?)
+            ORDER BY datetime(start_time) ASC
+            LIMIT 1
+        """, (
+            user_id,
+            now.date().isoformat(),
+            (until.date() + timedelta(days=1)).isoformat(),
+            now.isoformat(sep=" ", timespec="seconds"),
+            until.isoformat(sep=" ", timespec="seconds")
+        ))
+        
+        r = c.fetchone()
+        if not r:
+            return None
+        
+        return {
+            "id": r[0], "title": r[1], "start_time": r[2],
+            "end_time": r[3], "location": r[4]
+        }
+    
     def check_schedule_conflicts(
         self, 
         user_id: str, 
@@ -317,7 +558,45 @@ class ScheduleManager:
     def extract_task_from_text(self, user_message: str) -> Optional[Dict]:
         """自然言語からタスク情報を抽出（改善版）"""
         
-        prompt = f"""以下のメッセージからタスク情報を抽出してください。
+        if not _TASK_HINT_RE.search(user_message):
+            return None
+        
+        try:
+            response = client.chat(
+                model=self.model,
+                messages=[{"role": "user", "content": self._task_prompt(user_message)}],
+                options={"temperature": 0.3}
+            )
+            return self._parse_task(response['message']['content'])
+            
+        except Exception as e:
+            print(f"⚠️ タスク抽出エラー: {e}")
+        
+        return None
+    
+    async def aextract_task_from_text(self, user_message: str) -> Optional[Dict]:
+        """extract_task_from_text の非同期版（他のLLM呼び出しと並行できる）"""
+        
+        if not _TASK_HINT_RE.search(user_message):
+            return None
+        
+        try:
+            response = await async_client.chat(
+                model=self.model,
+                messages=[{"role": "user", "content": self._task_prompt(user_message)}],
+                options={"temperature": 0.3}
+            )
+            return self._parse_task(response['message']['content'])
+            
+        except Exception as e:
+            print(f"⚠️ タスク抽出エラー: {e}")
+        
+        return None
+    
+    def _task_prompt(self, user_message: str) -> str:
+        """タスク抽出プロンプト"""
+        
+        return f"""以下のメッセージからタスク情報を抽出してください。
 
     メッセージ: {user_message}
 
@@ -348,39 +627,31 @@ class ScheduleManager:
     明日: {(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')}
     来週: {(datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')}
     """
+    
+    def _parse_task(self, content: str) -> Optional[Dict]:
+        """タスク抽出の応答を解析・検証（タスクでなければNone）"""
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
+        if not json_match:
+            return None
         
-        try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.3}
-            )
-            
-            content = response['message']['content']
-            
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group())
-                
-                # due_dateの妥当性確認
-                if result.get("has_task") and result.get("due_date"):
-                    try:
-                        due_date = datetime.fromisoformat(result["due_date"])
-                        # 過去の日付は今日に修正
-                        if due_date.date() < datetime.now().date():
-                            result["due_date"] = datetime.now().date().isoformat()
-                            print(f"⚠️ タスク期限を今日に修正: {result['title']}")
-                    except:
-                        # 日付が不正な場合は削除
-                        result["due_date"] = None
-                        print(f"⚠️ タスク期限が不正なため削除: {result.get('title')}")
-                
-                return result if result.get("has_task") else None
-            
-        except Exception as e:
-            print(f"⚠️ タスク抽出エラー: {e}")
-        
-        return None
+        return self._check_task(json.loads(json_match.group()))
+    
+    def _check_task(self, result: Dict) -> Optional[Dict]:
+        """抽出したタスクを検証（タスクでなければNone）"""
+        # due_dateの妥当性確認
+        if result.get("has_task") and result.get("due_date"):
+            try:
+                due_date = datetime.fromisoformat(result["due_date"])
+                # 過去の日付は今日に修正
+                if due_date.date() < datetime.now().date():
+                    result["due_date"] = datetime.now().date().isoformat()
+                    print(f"⚠️ タスク期限を今日に修正: {result['title']}")
+            except:
+                # 日付が不正な場合は削除
+                result["due_date"] = None
+                print(f"⚠️ タスク期限が不正なため削除: {result.get('title')}")
+        
+        return result if result.get("has_task") else None
     
     def create_task(
         self,
@@ -390,9 +661,10 @@ class ScheduleManager:
         due_date: Optional[str] = None,
         priority: str = "medium",
         estimated_minutes: Optional[int] = None,
-        parent_task_id: Optional[int] = None
+        parent_task_id: Optional[int] = None,
+        subtasks: List[str] = None
     ) -> int:
-        """タスク作成"""
+        """タスク作成（サブタスクがあれば同じトランザクションでまとめて追加）"""
         c = self.conn.cursor()
         
         c.execute("""
@@ -406,7 +678,15 @@ class ScheduleManager:
         ))
         
         task_id = c.lastrowid
+        
+        if subtasks:
+            c.executemany("""
+                INSERT INTO subtasks (task_id, title)
+                VALUES (?, ?)
+            """, [(task_id, subtask_title) for subtask_title in subtasks])
+        
         self.conn.commit()
+        self.mark_changed()
         
         return task_id
     
@@ -443,6 +723,43 @@ class ScheduleManager:
         
         return tasks
     
+    def get_task_due_today(self, user_id: str) -> Optional[Dict]:
+        """今日が期限の未着手タスクを優先度順に1件取得"""
+        c = self.conn.cursor()
+        
+        today = datetime.now().date()
+        
+        c.execute("""
+            SELECT id, title, description, due_date, priority,
+                   estimated_minutes, created_at, parent_task_id
+            FROM tasks
+            WHERE user_id = ? AND status = 'pending'
+              AND due_date >= ? AND due_date < ?
+            ORDER BY 
+                CASE priority
+                    WHEN 'high' THEN 1
+                    WHEN 'medium' THEN 2
+                    WHEN 'low' THEN 3
+                END,
+                due_date ASC
+            LIMIT 1
+        """, (user_id, today.isoformat(), (today + timedelta(days=1)).isoformat()))
+        
+        row = c.fetchone()
+        if not row:
+            return None
+        
+        return {
+            "id": row[0],
+            "title": row[1],
+            "description": row[2],
+            "due_date": row[3],
+            "priority": row[4],
+            "estimated_minutes": row[5],
+            "created_at": row[6],
+            "parent_task_id": row[7]
+        }
+    
     def check_overdue_tasks(self, user_id: str) -> List[Dict]:
         """期限切れタスクをチェック"""
         c = self.conn.cursor()
@@ -473,6 +790,7 @@ class ScheduleManager:
         """, (datetime.now().isoformat(), task_id))
         
         self.conn.commit()
+        self.mark_changed()
         return c.rowcount > 0
     
     def complete_task(self, task_id: int, actual_minutes: Optional[int] = None) -> bool:
@@ -488,6 +806,7 @@ class ScheduleManager:
         """, (datetime.now().isoformat(), actual_minutes, task_id))
         
         self.conn.commit()
+        self.mark_changed()
         return c.rowcount > 0
     
     def update_task_progress(
@@ -604,7 +923,7 @@ class ScheduleManager:
 """
         
         try:
-            response = ollama.chat(
+            response = client.chat(
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 options={"temperature": 0.5}
@@ -646,7 +965,7 @@ class ScheduleManager:
 """
         
         try:
-            response = ollama.chat(
+            response = client.chat(
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 options={"temperature": 0.7}
@@ -676,7 +995,7 @@ class ScheduleManager:
 """
         
         try:
-            response = ollama.chat(
+            response = client.chat(
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 options={"temperature": 0.3}